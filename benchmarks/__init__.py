@@ -0,0 +1,5 @@
+# coding=utf-8
+"""
+Synthetic benchmarks of the server (update, compare) and the client (checkout).
+Run them with `python -m benchmarks.run --help`.
+"""
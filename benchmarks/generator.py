@@ -0,0 +1,202 @@
+# coding=utf-8
+import io
+import json
+import logging
+import random
+import zipfile
+
+import networkx
+from typing import Any, Dict
+
+from bireus.server import patching_strategies
+from bireus.shared import *
+
+logger = logging.getLogger(__name__)
+
+_WORDS = [b'unit ', b'weapon ', b'speed ', b'armor ', b'health ', b'damage ', b'range ', b'texture ', b'mesh ',
+          b'blueprint ', b'= { ', b'}, ', b'true ', b'false ', b'0.25 ', b'1024 ', b'\n', b'\t']
+
+
+class GeneratorSettings(object):
+    """
+    Shape of a synthetic repository. Sizes are in bytes, ratios are fractions of the files per version.
+    """
+
+    def __init__(self, files: int = 200, min_size: int = 1024, max_size: int = 256 * 1024,
+                 distribution: str = 'lognormal', binary_ratio: float = 0.3, change_ratio: float = 0.2,
+                 rename_ratio: float = 0.05, add_ratio: float = 0.05, remove_ratio: float = 0.05, zip_files: int = 5,
+                 zip_members: int = 20, zip_depth: int = 1, versions: int = 3, directories: int = 10,
+                 seed: int = 42):
+        if distribution not in ('uniform', 'lognormal'):
+            raise ValueError("size distribution must be `uniform` or `lognormal`, got %s" % distribution)
+
+        self.files = files
+        self.min_size = min_size
+        self.max_size = max_size
+        self.distribution = distribution  # lognormal: many small files, few large ones (like game data)
+        self.binary_ratio = binary_ratio  # incompressible files, the rest is text-like
+        self.change_ratio = change_ratio
+        self.rename_ratio = rename_ratio
+        self.add_ratio = add_ratio
+        self.remove_ratio = remove_ratio
+        self.zip_files = zip_files
+        self.zip_members = zip_members
+        self.zip_depth = zip_depth  # 1: zip files contain files only, 2: zip files contain zip files, ...
+        self.versions = versions
+        self.directories = directories
+        self.seed = seed
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(self.__dict__)
+
+    @staticmethod
+    def load_dict(data: Dict[str, Any]) -> 'GeneratorSettings':
+        return GeneratorSettings(**data)
+
+
+class RepositoryGenerator(object):
+    """
+    Generates a server repository with several versions. Each version modifies, renames, adds and removes
+    a share of the files of its predecessor. The result only depends on the settings (including the seed).
+    """
+
+    def __init__(self, settings: GeneratorSettings):
+        self.settings = settings
+        self._random = random.Random(settings.seed)
+
+    def generate(self, path: Path, name: str = 'benchmark', strategy: str = 'inst-bi', protocol: int = 1,
+                 repository_settings: Dict[str, Any] = None) -> Path:
+        """
+        Writes the repository below path, the versions are not patched yet
+        :param repository_settings: additional settings for the info.json (i.e. the codec policy)
+        :return: path of the repository
+        """
+        repo_path = path.joinpath(name)
+        if repo_path.exists():
+            remove_folder(repo_path)
+        repo_path.mkdir(parents=True)
+
+        version_names = ['v%03d' % i for i in range(1, self.settings.versions + 1)]
+
+        files = self._initial_files()
+        self._write_version(repo_path.joinpath(version_names[0]), files)
+        for version_name in version_names[1:]:
+            files = self._next_version(files)
+            self._write_version(repo_path.joinpath(version_name), files)
+
+        info_json = dict(repository_settings or dict())
+        info_json.update({
+            'name': name,
+            'first_version': version_names[0],
+            'latest_version': version_names[0],
+            'strategy': strategy,
+            'protocol': protocol
+        })
+        with repo_path.joinpath('info.json').open('w+') as file:
+            json.dump(info_json, file)
+
+        version_graph = patching_strategies[strategy].new_repo(version_names[0])  # type: networkx.DiGraph
+        networkx.write_gml(version_graph, str(repo_path.joinpath('versions.gml')))
+
+        logger.info('Generated repository %s with %s versions of %s files', name, len(version_names), len(files))
+        return repo_path
+
+    def _initial_files(self) -> Dict[str, bytes]:
+        files = dict()  # type: Dict[str, bytes]
+        for i in range(self.settings.files):
+            path = self._new_path(i)
+            files[path] = self._content(self._size(), _is_binary(path))
+        for i in range(self.settings.zip_files):
+            files['zip%s/archive%s.zip' % (i % self.settings.directories, i)] = self._zip(self.settings.zip_depth)
+        return files
+
+    def _next_version(self, files: Dict[str, bytes]) -> Dict[str, bytes]:
+        result = dict(files)
+        paths = sorted(files)
+
+        for path in self._random.sample(paths, int(len(paths) * self.settings.change_ratio)):
+            result[path] = self._change(path, result[path])
+
+        for path in self._random.sample(paths, int(len(paths) * self.settings.rename_ratio)):
+            if path in result and not path.endswith('.zip'):
+                content = result.pop(path)
+                result['moved%s/%s' % (self._random.randrange(self.settings.directories), Path(path).name)] = content
+
+        for path in self._random.sample(paths, int(len(paths) * self.settings.remove_ratio)):
+            result.pop(path, None)
+
+        for i in range(int(len(paths) * self.settings.add_ratio)):
+            path = self._new_path(self._random.randrange(10 ** 9))
+            result[path] = self._content(self._size(), _is_binary(path))
+
+        return result
+
+    def _change(self, path: str, content: bytes) -> bytes:
+        if path.endswith('.zip'):
+            # re-create the zip file with some changed members
+            return self._zip(self.settings.zip_depth, content)
+
+        # replace a few regions, insert and cut some bytes
+        data = bytearray(content)
+        for _ in range(self._random.randint(1, 4)):
+            position = self._random.randrange(max(1, len(data)))
+            length = self._random.randint(1, max(1, len(data) // 50))
+            data[position:position + length] = self._content(self._random.randint(0, 2 * length), _is_binary(path))
+        return bytes(data)
+
+    def _new_path(self, number: int) -> str:
+        extension = '.bin' if self._random.random() < self.settings.binary_ratio else '.txt'
+        return 'dir%s/file%s%s' % (self._random.randrange(self.settings.directories), number, extension)
+
+    def _size(self) -> int:
+        if self.settings.distribution == 'uniform':
+            size = self._random.randint(self.settings.min_size, self.settings.max_size)
+        else:
+            # the median file is about 4x the minimum size
+            size = int(self.settings.min_size * self._random.lognormvariate(1.4, 1.2))
+        return max(self.settings.min_size, min(self.settings.max_size, size))
+
+    def _content(self, size: int, binary: bool) -> bytes:
+        if binary:
+            return self._random.getrandbits(size * 8).to_bytes(size, 'little') if size > 0 else b''
+
+        # words are at least 2 bytes long
+        return b''.join(self._random.choice(_WORDS) for _ in range(size // 2 + 1))[:size]
+
+    def _zip(self, depth: int, previous: bytes = None) -> bytes:
+        members = dict()  # type: Dict[str, bytes]
+        if previous is not None:
+            with zipfile.ZipFile(io.BytesIO(previous)) as zip_file:
+                for name in zip_file.namelist():
+                    members[name] = zip_file.read(name)
+
+            for name in self._random.sample(sorted(members), max(1, int(len(members) * self.settings.change_ratio))):
+                if name.endswith('.zip'):
+                    members[name] = self._zip(depth - 1, members[name])
+                else:
+                    members[name] = self._change(name, members[name])
+        else:
+            for i in range(self.settings.zip_members):
+                members['member%s/file%s.txt' % (i % 3, i)] = self._content(self._size(), False)
+            if depth > 1:
+                members['nested.zip'] = self._zip(depth - 1)
+
+        result = io.BytesIO()
+        with zipfile.ZipFile(result, 'w') as zip_file:
+            for name in sorted(members):
+                # fixed timestamps, so unchanged zip files stay byte identical
+                info = zipfile.ZipInfo(name, date_time=(2017, 1, 1, 0, 0, 0))
+                info.compress_type = zipfile.ZIP_DEFLATED
+                zip_file.writestr(info, members[name])
+        return result.getvalue()
+
+    @staticmethod
+    def _write_version(version_path: Path, files: Dict[str, bytes]) -> None:
+        for path, content in files.items():
+            file_path = version_path.joinpath(path)
+            file_path.parent.mkdir(parents=True, exist_ok=True)
+            file_path.write_bytes(content)
+
+
+def _is_binary(path: str) -> bool:
+    return path.endswith('.bin')
@@ -0,0 +1,303 @@
+# coding=utf-8
+"""
+Runs the synthetic benchmark and writes a json report, i.e.
+
+    python -m benchmarks.run --files 2000 --versions 5 --jobs 4 --output report.json
+    python -m benchmarks.run --files 2000 --versions 5 --jobs 4 --baseline report.json
+
+With --baseline the run fails if a phase got slower than the baseline by more than the tolerance.
+"""
+import argparse
+import filecmp
+import io
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import time
+import zipfile
+
+from typing import Any, Callable, Dict, List, Optional
+
+from benchmarks.generator import GeneratorSettings, RepositoryGenerator
+from bireus.client.notification_service import NotificationService
+from bireus.client.repository import ClientRepository
+from bireus.server.compare_tasks.base import CompareTask
+from bireus.server.delta_cache import get_cache_path
+from bireus.server.repository import ServerRepository
+from bireus.shared import *
+from bireus.shared.instrumentation import Instrumentation
+
+try:
+    import resource
+except ImportError:  # not available on windows
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+REPORT_VERSION = 2
+WORK_FOLDER = 'bireus-benchmark'  # the benchmark only ever removes this folder of --work-dir
+TIMED_METRICS = ['wall_time']  # compared against the baseline
+
+
+def peak_rss() -> Optional[int]:
+    """
+    :return: highest resident set size in bytes of this process or one of its finished children so far
+    """
+    if resource is None:
+        return None
+
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # linux reports kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def directory_size(path: Path) -> Dict[str, int]:
+    files = 0
+    size = 0
+    for directory, _, filenames in os.walk(str(path)):
+        for filename in filenames:
+            files += 1
+            size += os.path.getsize(os.path.join(directory, filename))
+    return {'files': files, 'bytes': size}
+
+
+def _measure(phase: Callable[[], Any], bytes_processed: int, files_processed: int) -> Dict[str, Any]:
+    start = time.perf_counter()
+    phase()
+    wall_time = time.perf_counter() - start
+
+    return {
+        'wall_time': wall_time,
+        'bytes': bytes_processed,
+        'files': files_processed,
+        'mb_per_second': bytes_processed / 1024 / 1024 / wall_time if wall_time > 0 else None,
+        'files_per_second': files_processed / wall_time if wall_time > 0 else None
+    }
+
+
+class SilentNotificationService(NotificationService):
+    """
+    Keeps the progress of the checkout off stdout, which is where the report goes
+    """
+
+    def notify(self, message: str, line_break: bool = True, indent: bool = True) -> None:
+        pass
+
+
+def _same_zip(expected: bytes, actual: bytes) -> bool:
+    """
+    The client re-packs patched zip files (with entries for the directories), so only their files have to match
+    """
+    with zipfile.ZipFile(io.BytesIO(expected)) as expected_zip, zipfile.ZipFile(io.BytesIO(actual)) as actual_zip:
+        names = sorted(name for name in expected_zip.namelist() if not name.endswith('/'))
+        if names != sorted(name for name in actual_zip.namelist() if not name.endswith('/')):
+            return False
+
+        for name in names:
+            expected_member, actual_member = expected_zip.read(name), actual_zip.read(name)
+            if expected_member != actual_member and not (name.endswith('.zip') and
+                                                         _same_zip(expected_member, actual_member)):
+                return False
+
+    return True
+
+
+def _assert_same_tree(expected: Path, actual: Path) -> None:
+    comparison = filecmp.dircmp(str(expected), str(actual), ignore=['.bireus'])
+    pending = [comparison]
+    while len(pending) > 0:
+        comparison = pending.pop()
+        if comparison.left_only or comparison.right_only or comparison.funny_files:
+            raise AssertionError("Checkout differs from the server version in %s" % comparison.left)
+
+        for name in comparison.common_files:
+            expected_path, actual_path = Path(comparison.left, name), Path(comparison.right, name)
+            if filecmp.cmp(str(expected_path), str(actual_path), shallow=False):
+                continue
+            if not (name.endswith('.zip') and _same_zip(expected_path.read_bytes(), actual_path.read_bytes())):
+                raise AssertionError("Checkout differs from the server version: %s" % expected_path)
+
+        pending.extend(comparison.subdirs.values())
+
+
+def run_benchmark(work_dir: Path, settings: GeneratorSettings, jobs: int = 1, protocol: int = 1,
+                  strategy: str = 'inst-bi', repository_settings: Dict[str, Any] = None) -> Dict[str, Any]:
+    """
+    Generates a repository and measures the server update, a single compare of the first and the latest version
+    and a client checkout from the latest back to the first version. The client reads the server repository
+    through a file:// url, so no web server is needed and the timings contain no network transfer.
+    :param work_dir: empty directory for the server and the client repository
+    :param repository_settings: additional settings for the info.json of the server repository
+    :return: the report
+    """
+    name = 'benchmark'
+    phases = dict()  # type: Dict[str, Dict[str, Any]]
+
+    generator = RepositoryGenerator(settings)
+    start = time.perf_counter()
+    repo_path = generator.generate(work_dir.joinpath('server'), name, strategy, protocol, repository_settings)
+    versions = sorted(path.name for path in repo_path.iterdir() if path.is_dir())
+    version_sizes = {version: directory_size(repo_path.joinpath(version)) for version in versions}
+    total = {key: sum(size[key] for size in version_sizes.values()) for key in ('files', 'bytes')}
+    phases['generate'] = {'wall_time': time.perf_counter() - start, 'bytes': total['bytes'], 'files': total['files']}
+
+    repository = ServerRepository(repo_path)
+    repository.instrumentation = Instrumentation(name)
+    phases['server_update'] = _measure(lambda: repository.update(jobs), total['bytes'], total['files'])
+    phases['server_update'].update({
+        'delta_cache_hits': repository.delta_cache_hits,
+        'delta_cache_misses': repository.delta_cache_misses,
+        'deltas_checked': repository.deltas_checked,
+        'delta_fallbacks': repository.delta_fallbacks
+    })
+
+    patches_path = repo_path.joinpath('__patches__')
+    patches = {path.name: path.stat().st_size for path in sorted(patches_path.iterdir())}
+    latest_archive = repo_path.joinpath('latest.tar.xz').stat().st_size
+
+    client_path = work_dir.joinpath('client', name)
+    latest = version_sizes[versions[-1]]
+    client = []  # type: List[ClientRepository]
+    phases['client_init'] = _measure(
+        lambda: client.append(ClientRepository.get_from_url(client_path, repo_path.as_uri(), file_logging=False)),
+        latest['bytes'], latest['files'])
+
+    client[0].notification_service = SilentNotificationService(client[0])
+    client[0].instrumentation = Instrumentation(name)
+    first = version_sizes[versions[0]]
+    phases['client_checkout'] = _measure(lambda: client[0].checkout_version(versions[0]), first['bytes'],
+                                         first['files'])
+    _assert_same_tree(repo_path.joinpath(versions[0]), client_path)
+
+    # a single compare with a cold delta cache, its patch isn't part of the version graph
+    remove_folder(get_cache_path(repo_path))
+    compare_task = CompareTask.get_factory(protocol)(repo_path, name, versions[0], versions[-1], jobs=jobs)
+    phases['compare'] = _measure(compare_task.generate_diff, first['bytes'] + latest['bytes'],
+                                 first['files'] + latest['files'])
+    compare_patch = patches_path.joinpath('%s_to_%s.tar.xz' % (versions[0], versions[-1]))
+    phases['compare']['patch_size'] = compare_patch.stat().st_size
+    if compare_patch.name not in patches:
+        compare_patch.unlink()
+
+    return {
+        'report_version': REPORT_VERSION,
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'jobs': jobs,
+            'protocol': protocol,
+            'strategy': strategy
+        },
+        'settings': settings.to_dict(),
+        'repository_settings': repository_settings or dict(),
+        'versions': version_sizes,
+        'phases': phases,
+        # ru_maxrss is a high watermark over the whole process, it can't be split into phases
+        'peak_rss': peak_rss(),
+        'patches': patches,
+        'patch_bytes': sum(patches.values()),
+        'latest_archive': latest_archive,
+        'instrumentation': {
+            'server_update': repository.instrumentation.to_dict(),
+            'client_checkout': client[0].instrumentation.to_dict()
+        }
+    }
+
+
+def compare_reports(baseline: Dict[str, Any], report: Dict[str, Any], tolerance: float) -> List[str]:
+    """
+    :param tolerance: allowed slowdown, i.e. 0.1 for 10%
+    :return: a description of every phase that got slower than allowed
+    """
+    regressions = []  # type: List[str]
+    for phase, result in sorted(report['phases'].items()):
+        if phase == 'generate' or phase not in baseline['phases']:
+            continue
+
+        for metric in TIMED_METRICS:
+            before = baseline['phases'][phase][metric]
+            after = result[metric]
+            if before and after > before * (1 + tolerance):
+                regressions.append('%s %s: %.3f -> %.3f (+%.0f%%)' % (phase, metric, before, after,
+                                                                        (after / before - 1) * 100))
+
+    if report['patch_bytes'] > baseline['patch_bytes'] * (1 + tolerance):
+        regressions.append('patch_bytes: %s -> %s' % (baseline['patch_bytes'], report['patch_bytes']))
+
+    return regressions
+
+
+def main(argv: List[str] = None) -> int:
+    defaults = GeneratorSettings()
+    parser = argparse.ArgumentParser(description="BiReUS synthetic benchmark of server updates and client checkouts")
+
+    parser.add_argument("--files", type=int, default=defaults.files, help="number of files per version")
+    parser.add_argument("--min-size", type=int, default=defaults.min_size, help="minimum file size in bytes")
+    parser.add_argument("--max-size", type=int, default=defaults.max_size, help="maximum file size in bytes")
+    parser.add_argument("--distribution", default=defaults.distribution, choices=['uniform', 'lognormal'])
+    parser.add_argument("--binary-ratio", type=float, default=defaults.binary_ratio)
+    parser.add_argument("--change-ratio", type=float, default=defaults.change_ratio)
+    parser.add_argument("--rename-ratio", type=float, default=defaults.rename_ratio)
+    parser.add_argument("--add-ratio", type=float, default=defaults.add_ratio)
+    parser.add_argument("--remove-ratio", type=float, default=defaults.remove_ratio)
+    parser.add_argument("--zip-files", type=int, default=defaults.zip_files)
+    parser.add_argument("--zip-members", type=int, default=defaults.zip_members)
+    parser.add_argument("--zip-depth", type=int, default=defaults.zip_depth, help="nesting of zip files in zip files")
+    parser.add_argument("--versions", type=int, default=defaults.versions)
+    parser.add_argument("--directories", type=int, default=defaults.directories)
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+
+    parser.add_argument("--jobs", "-j", type=int, default=1, help="number of patches generated in parallel")
+    parser.add_argument("--protocol", type=int, default=1, help="protocol version of the patches")
+    parser.add_argument("--strategy", default="inst-bi", help="update strategy")
+    parser.add_argument("--work-dir", default=None,
+                        help="keep the repositories in the folder %s of this directory instead of a temp directory"
+                             % WORK_FOLDER)
+    parser.add_argument("--output", "-o", default=None, help="write the report to this file instead of stdout")
+    parser.add_argument("--baseline", default=None, help="report of a previous run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="allowed slowdown compared to the baseline (default: 0.1)")
+
+    args = parser.parse_args(argv)
+
+    settings = GeneratorSettings(args.files, args.min_size, args.max_size, args.distribution, args.binary_ratio,
+                                 args.change_ratio, args.rename_ratio, args.add_ratio, args.remove_ratio,
+                                 args.zip_files, args.zip_members, args.zip_depth, args.versions, args.directories,
+                                 args.seed)
+
+    if args.work_dir is None:
+        with tempfile.TemporaryDirectory(prefix='bireus_benchmark_') as tmpdir:
+            report = run_benchmark(Path(tmpdir), settings, args.jobs, args.protocol, args.strategy)
+    else:
+        work_dir = Path(args.work_dir, WORK_FOLDER)
+        if work_dir.exists():
+            remove_folder(work_dir)
+        work_dir.mkdir(parents=True)
+        report = run_benchmark(work_dir, settings, args.jobs, args.protocol, args.strategy)
+
+    if args.output is None:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    else:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2, sort_keys=True)
+
+    if args.baseline is not None:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+
+        regressions = compare_reports(baseline, report, args.tolerance)
+        for regression in regressions:
+            print("Regression: " + regression, file=sys.stderr)
+        if len(regressions) > 0:
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
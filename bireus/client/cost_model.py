@@ -0,0 +1,53 @@
+# coding=utf-8
+"""
+Costs of the patches of a checkout, the client takes the cheapest path through the version graph
+"""
+import logging
+import statistics
+
+import networkx
+from typing import Any, Dict
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HOP_COST = 1024 * 1024  # bytes worth of downloading that match the fixed cost of a patch (request, apply)
+DEFAULT_CACHED_WEIGHT = 0.1  # share of the size a patch in .bireus still costs, it has to be applied anyway
+
+
+def patch_size(data: Dict[str, Any]) -> int:
+    """
+    :param data: attributes of an edge of the version graph with a size
+    :return: size of the patch in bytes, GML stores integers of 2^31 or more as strings
+    """
+    return int(data['size'])
+
+
+class PatchCostModel(object):
+    """
+    A patch costs its size plus a fixed cost per patch, patches that are already downloaded only a share of
+    their size. Versions graphs without sizes (from older servers) cost the fixed cost per patch,
+    which picks the path with the fewest patches.
+    """
+
+    def __init__(self, hop_cost: float = DEFAULT_HOP_COST, cached_weight: float = DEFAULT_CACHED_WEIGHT):
+        """
+        :param hop_cost: fixed cost per patch in bytes
+        :param cached_weight: factor on the size of patches that are already downloaded
+        """
+        self.hop_cost = hop_cost
+        self.cached_weight = cached_weight
+
+    def unknown_size(self, version_graph: networkx.DiGraph) -> float:
+        """
+        :return: size assumed for patches without a size, the median of the known sizes
+        """
+        sizes = [patch_size(data) for version_from, version_to, data in version_graph.edges(data=True)
+                 if 'size' in data]
+        return statistics.median(sizes) if len(sizes) > 0 else 0
+
+    def cost(self, size: float, cached: bool) -> float:
+        """
+        :param size: size of the patch in bytes
+        :param cached: the patch is already downloaded
+        """
+        return self.hop_cost + size * (self.cached_weight if cached else 1.0)
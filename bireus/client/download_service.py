@@ -2,12 +2,14 @@
 import abc
 import logging
 from pathlib import Path
-from urllib.request import urlretrieve
+from urllib.request import Request, urlopen, urlretrieve
 
 from typing import Any
 
 logger = logging.getLogger(__name__)
 
+POST_TIMEOUT = 10  # seconds, posts are reports nobody waits for
+
 
 class DownloadError(Exception):
     def __init__(self, cause: Any, url: str):
@@ -41,6 +43,15 @@ class AbstractDownloadService(abc.ABC):
         """
         pass
 
+    def post(self, url: str, data: bytes) -> None:
+        """
+        Posts json data to a remote url, used for reports to the server. Not supported by default.
+        Needs to throw DownloadError if anything bad happens
+        :param url: url to post to
+        :param data: json encoded body
+        """
+        raise DownloadError(NotImplementedError("post is not supported by %s" % type(self).__name__), url)
+
 
 class BasicDownloadService(AbstractDownloadService):
     """
@@ -61,3 +72,11 @@ class BasicDownloadService(AbstractDownloadService):
             return Path(filename).read_bytes()
         except Exception as e:
             raise DownloadError(e, url)
+
+    def post(self, url: str, data: bytes) -> None:
+        try:
+            logger.debug("Posting to %s", url)
+            with urlopen(Request(url, data, {'Content-Type': 'application/json'}), timeout=POST_TIMEOUT):
+                pass
+        except Exception as e:
+            raise DownloadError(e, url)
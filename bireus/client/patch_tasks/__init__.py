@@ -2,3 +2,4 @@
 
 # import new versions here
 import bireus.client.patch_tasks.v1
+import bireus.client.patch_tasks.v2
@@ -2,12 +2,14 @@
 import abc
 import logging
 import tempfile
+import time
 
 from bireus.client.download_service import AbstractDownloadService
 from bireus.client.notification_service import NotificationService
 from bireus.shared import *
 from bireus.shared.diff_head import DiffHead
 from bireus.shared.diff_item import DiffItem
+from bireus.shared.instrumentation import DISABLED
 from bireus.shared.repository import ProtocolException
 
 logger = logging.getLogger(__name__)
@@ -23,14 +25,20 @@ class PatchTask(abc.ABC):
         self._url = repository_url
         self._repo_path = repo_path
         self._patch_file = patch_file
+        self._patch_root = None  # type: Path
         self._target_version = None
+        self.instrumentation = DISABLED
 
     def run(self) -> None:
+        start = time.perf_counter()
+
         # unpack the patch into a temp folder
         temp_root = self._repo_path.joinpath(".bireus").joinpath("__temp__")
         temp_root.mkdir(parents=True, exist_ok=True)
         tempdir = tempfile.TemporaryDirectory(dir=str(temp_root))
-        unpack_archive(self._patch_file, tempdir.name)
+        with self.instrumentation.timer('unpack'):
+            unpack_archive(self._patch_file, tempdir.name)
+        self._patch_root = Path(tempdir.name)
 
         diff_head = DiffHead.load_json_file(Path(tempdir.name).joinpath('.bireus'))
 
@@ -59,12 +67,24 @@ class PatchTask(abc.ABC):
         finally:
             remove_folder(intermediate_folder)
 
+        self.instrumentation.duration = time.perf_counter() - start
+
+    def _item(self, patch_path: Path) -> str:
+        """
+        :return: name of a file for the instrumentation, the path inside the patch
+        """
+        return patch_path.relative_to(self._patch_root).as_posix()
+
     @classmethod
     def get_factory(cls, protocol: int):
         if cls._patch_tasks is None:
             cls._patch_tasks = dict()
-            for patch_task_version in PatchTask.__subclasses__():
+            # newer protocol versions may extend older ones, so walk the whole class tree
+            patch_task_versions = PatchTask.__subclasses__()
+            while len(patch_task_versions) > 0:
+                patch_task_version = patch_task_versions.pop()
                 cls._patch_tasks[patch_task_version.get_version()] = patch_task_version.create
+                patch_task_versions.extend(patch_task_version.__subclasses__())
 
         if protocol in cls._patch_tasks:
             return cls._patch_tasks[protocol]
@@ -2,13 +2,12 @@
 import logging
 import tempfile
 
-import bsdiff4
-
 from bireus.client.download_service import AbstractDownloadService
 from bireus.client.notification_service import NotificationService
 from bireus.client.patch_tasks.base import PatchTask
 from bireus.client.patch_tasks.errors import CrcMismatchError
 from bireus.shared import *
+from bireus.shared.codecs import Codec
 from bireus.shared.diff_item import DiffItem
 
 logger = logging.getLogger(__name__)
@@ -40,13 +39,11 @@ class PatchTaskV1(PatchTask):
                      str(patch_path))
         self._notification_service.begin_patching_directory(base_path)
 
-        if diff.action == 'add':
-            # do nothing: the new files are already in the patch_path
-            pass
-        elif diff.action == 'remove':
+        if diff.action == 'remove':
             # do nothing: the files don't exist in the patch_path
             pass
-        elif diff.action == 'delta':
+        elif diff.action in ('add', 'delta'):
+            # new files are already in the patch_path, but added directories may contain moved files
             self.patch(diff, base_path, patch_path, inside_zip)
 
         self._notification_service.finish_patching_directory(base_path)
@@ -54,7 +51,7 @@ class PatchTaskV1(PatchTask):
     def patch_file(self, diff: DiffItem, base_path: Path, patch_path: Path, inside_zip: bool) -> None:
         logger.debug('Patching file -> action=%s,  file=%s, path=%s', diff.action, diff.name, str(base_path))
 
-        if diff.action == 'add':
+        if diff.action in ('add', 'replace'):
             # do nothing: the new files are already in the patchPath
             pass
         elif diff.action == 'remove':
@@ -62,43 +59,86 @@ class PatchTaskV1(PatchTask):
             pass
         elif diff.action == 'zipdelta':
             self.patch_zipdelta(diff, base_path, patch_path)
-        elif diff.action == 'bsdiff':
-            self._notification_service.begin_patching_file(base_path)
+        elif diff.action in ('bsdiff', 'blockdiff'):
+            self.patch_delta(diff, base_path, patch_path, inside_zip, Codec.get(diff.action))
+        elif diff.action in ('move', 'copy'):
+            self.patch_move(diff, base_path, patch_path)
+        elif diff.action == 'unchanged':
+            with self.instrumentation.timer('copy'):
+                copy_file(base_path, patch_path)
 
-            # apply the patch onto a temporary file and replace the file in patchPath
-            # if checksum does not fit, load file from server and save in patchPath
+    def patch_delta(self, diff: DiffItem, base_path: Path, patch_path: Path, inside_zip: bool, codec: Codec) -> None:
+        self._notification_service.begin_patching_file(base_path)
 
-            try:
-                crc_before_patching = crc32_from_file(base_path)
-                if diff.base_crc == crc_before_patching:
+        # apply the patch onto a temporary file and replace the file in patchPath
+        # if checksum does not fit, load file from server and save in patchPath
+        # the delta of a moved file applies to its former location
+        source_path = self._source_path(diff, base_path)
+        item = self._item(patch_path)
+
+        try:
+            with self.instrumentation.timer('hash', item):
+                crc_before_patching = crc32_from_file(source_path)
+            if diff.base_crc == crc_before_patching:
+                with self.instrumentation.timer('apply', item):
                     # using bsdiff4.file_patch_inplace not possible until 1.1.5
-                    bsdiff4.file_patch(str(base_path), str(patch_path) + ".patched", str(patch_path))
+                    codec.patch(source_path, Path(str(patch_path) + ".patched"), patch_path)
                     patch_path.unlink()
                     move_file(str(patch_path) + ".patched", patch_path)
 
+                with self.instrumentation.timer('hash', item):
                     crc_after_patching = crc32_from_file(patch_path)
-                    if diff.target_crc != crc_after_patching:
-                        logger.error("Crc mismatch after patching in %s (expected=%s, actual=%s)",
-                                     str(base_path), diff.target_crc, crc_before_patching)
-                        self._notification_service.crc_mismatch(base_path)
-                        raise CrcMismatchError(base_path, diff.base_crc, crc_before_patching)
-                    else:
-                        self._notification_service.finish_patching_file(base_path)
-                else:
-                    logger.error("Crc mismatch in base file %s (expected=%s, actual=%s), patching aborted",
-                                 str(base_path), diff.base_crc, crc_before_patching)
+                if diff.target_crc != crc_after_patching:
+                    logger.error("Crc mismatch after patching in %s (expected=%s, actual=%s)",
+                                 str(base_path), diff.target_crc, crc_before_patching)
                     self._notification_service.crc_mismatch(base_path)
                     raise CrcMismatchError(base_path, diff.base_crc, crc_before_patching)
-            except CrcMismatchError:
-                if inside_zip:
-                    raise
                 else:
-                    logger.info("Emergency fallback: download %s from original source", base_path)
-                    self._download_service.download(
-                        self._url + "/" + self._target_version + "/" + str(
-                            base_path.relative_to(self._repo_path)), patch_path)
-        elif diff.action == 'unchanged':
-            copy_file(base_path, patch_path)
+                    self._notification_service.finish_patching_file(base_path)
+            else:
+                logger.error("Crc mismatch in base file %s (expected=%s, actual=%s), patching aborted",
+                             str(source_path), diff.base_crc, crc_before_patching)
+                self._notification_service.crc_mismatch(base_path)
+                raise CrcMismatchError(source_path, diff.base_crc, crc_before_patching)
+        except CrcMismatchError:
+            if inside_zip:
+                raise
+            else:
+                self.download_target(base_path, patch_path)
+
+    def patch_move(self, diff: DiffItem, base_path: Path, patch_path: Path) -> None:
+        """
+        Takes a moved, renamed or copied file from its location in the base version
+        """
+        self._notification_service.begin_patching_file(base_path)
+        source_path = self._source_path(diff, base_path)
+
+        with self.instrumentation.timer('hash', self._item(patch_path)):
+            crc_before_patching = crc32_from_file(source_path)
+        if diff.base_crc == crc_before_patching:
+            patch_path.parent.mkdir(parents=True, exist_ok=True)
+            with self.instrumentation.timer('copy'):
+                copy_file(source_path, patch_path)
+            self._notification_service.finish_patching_file(base_path)
+        else:
+            logger.error("Crc mismatch in source file %s (expected=%s, actual=%s)",
+                         str(source_path), diff.base_crc, crc_before_patching)
+            self._notification_service.crc_mismatch(base_path)
+            self.download_target(base_path, patch_path)
+
+    def download_target(self, base_path: Path, patch_path: Path) -> None:
+        logger.info("Emergency fallback: download %s from original source", base_path)
+        self.instrumentation.count('fallback_downloads')
+        with self.instrumentation.timer('download', self._item(patch_path)):
+            self._download_service.download(
+                self._url + "/" + self._target_version + "/" + str(
+                    base_path.relative_to(self._repo_path)), patch_path)
+
+    def _source_path(self, diff: DiffItem, base_path: Path) -> Path:
+        if diff.source is not None:
+            return self._repo_path.joinpath(diff.source)
+        else:
+            return base_path
 
     def patch_zipdelta(self, diff: DiffItem, base_path: Path, patch_path: Path) -> None:
         # we need a temporary folder to extract the zip content from the base files
@@ -108,24 +148,26 @@ class PatchTaskV1(PatchTask):
 
         # extract the original files, attention: the patch files aren't zipped anymore
         logger.debug("Extracting files to %s", str(temp_root))
-        unpack_archive(base_path, tempdir.name, 'zip')
+        with self.instrumentation.timer('zip_extract', self._item(patch_path)):
+            unpack_archive(base_path, tempdir.name, 'zip')
 
         # now we can start the patching
         self.patch(diff, Path(tempdir.name), patch_path, inside_zip=True)
 
         # the patched files are now in patchPath
         # therefore we can remove the temporaryFolder
-        logger.debug("Removing the temporary base folder {}", str(patch_path))
+        logger.debug("Removing the temporary base folder %s", str(patch_path))
         tempdir.cleanup()
 
         # patch_path is a folder with the patch files but is supposed to be the zip file,
         # therefore we rename the folder for a second before compressing
-        logger.debug("Re-compressing files at {}", str(patch_path))
+        logger.debug("Re-compressing files at %s", str(patch_path))
         intermediate_folder = Path(str(patch_path) + ".patched")
         patch_path.rename(intermediate_folder)
 
         try:
-            make_archive(str(patch_path), 'zip', str(intermediate_folder))
-            move_file(str(patch_path) + ".zip", patch_path)
+            with self.instrumentation.timer('zip_rezip', self._item(patch_path)):
+                make_archive(str(patch_path), 'zip', str(intermediate_folder))
+                move_file(str(patch_path) + ".zip", patch_path)
         finally:
             remove_folder(intermediate_folder)
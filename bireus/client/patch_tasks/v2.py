@@ -0,0 +1,37 @@
+# coding=utf-8
+import logging
+
+from bireus.client.download_service import AbstractDownloadService
+from bireus.client.notification_service import NotificationService
+from bireus.client.patch_tasks.v1 import PatchTaskV1
+from bireus.shared import *
+from bireus.shared.codecs import Codec
+from bireus.shared.diff_item import DiffItem
+
+logger = logging.getLogger(__name__)
+
+
+class PatchTaskV2(PatchTaskV1):
+    """
+    Protocol 2: changed files have the action `delta` and name their codec
+    """
+
+    @classmethod
+    def get_version(cls) -> int:
+        return 2
+
+    @classmethod
+    def create(cls, notification_service: NotificationService, download_service: AbstractDownloadService,
+               repository_url: str, repo_path: Path, patch_file: Path):
+        logger.debug(
+            "Create PatchTask v2 (download_service=`%s`, repository_url=`%s`, repo_path=`%s`, patch_file=`%s`",
+            repr(download_service), repr(repository_url), repr(repo_path), repr(patch_file))
+        return PatchTaskV2(notification_service, download_service, repository_url, repo_path, patch_file)
+
+    def patch_file(self, diff: DiffItem, base_path: Path, patch_path: Path, inside_zip: bool) -> None:
+        if diff.action == 'delta':
+            logger.debug('Patching file -> action=%s, codec=%s, file=%s, path=%s', diff.action, diff.codec,
+                         diff.name, str(base_path))
+            self.patch_delta(diff, base_path, patch_path, inside_zip, Codec.get(diff.codec))
+        else:
+            super().patch_file(diff, base_path, patch_path, inside_zip)
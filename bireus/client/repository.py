@@ -2,14 +2,19 @@
 import json
 import logging
 import tempfile
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from logging.handlers import RotatingFileHandler
 
 import networkx
+from typing import Any, Dict, List, Tuple
 
+from bireus.client.cost_model import PatchCostModel, patch_size
 from bireus.client.download_service import AbstractDownloadService, BasicDownloadService, DownloadError
 from bireus.client.notification_service import NotificationService
 from bireus.client.patch_tasks.base import PatchTask
 from bireus.shared import *
+from bireus.shared.instrumentation import DISABLED, Instrumentation
 from bireus.shared.repository import BaseRepository
 
 logger = logging.getLogger(__name__)
@@ -52,6 +57,10 @@ class ClientRepository(BaseRepository):
             self._download_service = download_service
 
         self._notification_service = NotificationService(self)
+        self.instrumentation = DISABLED  # type: Instrumentation  # replace it to collect timers and counters
+        self.cost_model = PatchCostModel()  # type: PatchCostModel  # replace it to weigh patch paths differently
+        # patches downloaded concurrently while the earlier ones are applied, 0 downloads each right before applying
+        self.prefetch = 0
 
         logger.info("%s initialized, current version: %s", self.name, self.current_version)
 
@@ -117,7 +126,7 @@ class ClientRepository(BaseRepository):
             raise CheckoutError("Version `%s` is not listed on server", version)
 
         try:
-            patch_path = networkx.shortest_path(self.version_graph, self.current_version, version)
+            patch_path = self.find_patch_path(self.current_version, version)
         except networkx.NetworkXNoPath:
             logger.error("No valid patch path from %s to %s" % (self.current_version, version))
             self._notification_service.no_patch_path(version)
@@ -125,30 +134,65 @@ class ClientRepository(BaseRepository):
 
         logger.debug("Path path: %s", patch_path)
         self._notification_service.found_patch_path(patch_path)
+        start = time.perf_counter()
 
-        i = 1
-        while i < len(patch_path):
-            version_from = patch_path[i - 1]
-            version_to = patch_path[i]
+        executor = ThreadPoolExecutor(max_workers=self.prefetch) if self.prefetch > 0 else None
+        downloads = dict()  # type: Dict[Tuple[str, str], Future]
 
-            delta_file = self.get_patch_path(version_from, version_to)
-            if not delta_file.exists():
-                logger.info("Download deltafile %s_to_%s from server", version_from, version_to)
-                self._download_patch(version_from, version_to)
-            else:
-                logger.info("Deltafile %s_to_%s already on disk", version_from, version_to)
-
-            self._apply_patch(version_from, version_to)
-            i += 1
+        try:
+            if executor is not None:
+                downloads = self._prefetch_patches(executor, patch_path)
+
+            i = 1
+            while i < len(patch_path):
+                version_from = patch_path[i - 1]
+                version_to = patch_path[i]
+
+                download = downloads.get((version_from, version_to))
+                if download is not None:
+                    download.result()  # re-raises a failed download
+                elif not self.get_patch_path(version_from, version_to).exists():
+                    logger.info("Download deltafile %s_to_%s from server", version_from, version_to)
+                    self._download_patch(version_from, version_to)
+                else:
+                    logger.info("Deltafile %s_to_%s already on disk", version_from, version_to)
+
+                self._apply_patch(version_from, version_to)
+                i += 1
+        finally:
+            if executor is not None:
+                for download in downloads.values():
+                    download.cancel()
+                executor.shutdown(wait=True)
 
         # set the new version in the info.json
         self._metadata['current_version'] = version
         with self.info_path.open('w') as info_file:
             json.dump(self._metadata, info_file)
 
+        self.instrumentation.duration += time.perf_counter() - start
+        if self.instrumentation.enabled:
+            logger.info('Instrumentation of %s', self.instrumentation.summary())
+
+        if len(patch_path) > 2:
+            self._report_checkout(patch_path[0], version)
+
         logger.info('Version %s is now checked out', version)
         self._notification_service.finish_checkout_version(version)
 
+    def find_patch_path(self, version_from: str, version_to: str) -> List[str]:
+        """
+        :return: the versions of the cheapest path of patches according to the cost model
+        :raises networkx.NetworkXNoPath: the versions aren't connected
+        """
+        unknown_size = self.cost_model.unknown_size(self.version_graph)
+
+        def weight(patch_from: str, patch_to: str, data: Dict[str, Any]) -> float:
+            return self.cost_model.cost(patch_size(data) if 'size' in data else unknown_size,
+                                        self.get_patch_path(patch_from, patch_to).exists())
+
+        return networkx.dijkstra_path(self.version_graph, version_from, version_to, weight=weight)
+
     def _check_version_exists(self, target_version: str) -> bool:
         if self.has_version(target_version):
             return True
@@ -156,22 +200,52 @@ class ClientRepository(BaseRepository):
             self._update_repo_info()
             return self.has_version(target_version)
 
+    def _prefetch_patches(self, executor: ThreadPoolExecutor,
+                          patch_path: List[str]) -> Dict[Tuple[str, str], Future]:
+        """
+        Starts the downloads of all patches of the path that are not on disk yet, in the order they are applied
+        :return: the download of each of these patches
+        """
+        downloads = dict()  # type: Dict[Tuple[str, str], Future]
+        for version_from, version_to in zip(patch_path, patch_path[1:]):
+            if not self.get_patch_path(version_from, version_to).exists():
+                downloads[(version_from, version_to)] = executor.submit(self._download_patch, version_from,
+                                                                        version_to)
+
+        logger.info("Prefetching %s deltafiles, %s at a time", len(downloads), self.prefetch)
+        return downloads
+
     def _download_patch(self, version_from: str, version_to: str) -> None:
         delta_source = self.url + '/__patches__/%s_to_%s.tar.xz' % (version_from, version_to)
         delta_dest = self.get_patch_path(version_from, version_to)
 
         try:
-            self._download_service.download(delta_source, delta_dest)
+            with self.instrumentation.timer('download', delta_dest.name):
+                self._download_service.download(delta_source, delta_dest)
         except Exception:
             self._notification_service.error("Downloading patch-file failed @ %s" % delta_source)
             logger.error("Downloading patch-file failed @ %s", delta_source)
             raise
 
+    def _report_checkout(self, version_from: str, version_to: str) -> None:
+        """
+        Tells the server about a checkout over several patches, it may add a direct patch for frequent ones
+        """
+        data = json.dumps({'from': version_from, 'to': version_to}).encode('utf-8')
+        try:
+            self._download_service.post(self.url + '/checkouts', data)
+        except DownloadError as e:
+            # a plain file server doesn't take reports
+            logger.debug("Checkout not reported: %s", e)
+
     def _apply_patch(self, version_from: str, version_to: str) -> None:
         self._notification_service.begin_apply_patch(version_from, version_to)
         patch_task = self._patch_task_factory(self.notification_service, self._download_service, self.url,
                                               self._absolute_path, self.get_patch_path(version_from, version_to))
+        if self.instrumentation.enabled:
+            patch_task.instrumentation = Instrumentation('%s_to_%s' % (version_from, version_to))
         patch_task.run()
+        self.instrumentation.merge(patch_task.instrumentation)
         self._notification_service.finish_apply_patch(version_from, version_to)
 
     @classmethod
@@ -9,6 +9,7 @@ import sys
 from pathlib import Path
 
 from bireus.client.repository import ClientRepository
+from bireus.shared.instrumentation import Instrumentation, write_metrics
 
 root = logging.getLogger()
 root.setLevel(logging.DEBUG)
@@ -38,6 +39,11 @@ class Client(object):
         parser_checkout = subparsers.add_parser("checkout")
         parser_checkout.add_argument("version", nargs='?', default="latest")
         parser_checkout.add_argument("--path", "-p", default=os.getcwd())
+        parser_checkout.add_argument("--metrics", default=None,
+                                     help="write timers and counters per phase and file to this file")
+        parser_checkout.add_argument("--metrics-format", default="json", choices=['json', 'prometheus'])
+        parser_checkout.add_argument("--prefetch", type=int, default=0,
+                                     help="number of patches downloaded concurrently while earlier ones are applied")
 
         args = parser.parse_args()
 
@@ -51,12 +57,18 @@ class Client(object):
             ClientRepository.get_from_url(Path(args.path), args.url)
         elif args.command == 'checkout':
             repo = ClientRepository(Path(args.path))
+            repo.prefetch = args.prefetch
+            if args.metrics is not None:
+                repo.instrumentation = Instrumentation(repo.name)
 
             if args.version == 'latest':
                 repo.checkout_latest()
             else:
                 repo.checkout_version(args.version)
 
+            if args.metrics is not None:
+                write_metrics(Path(args.metrics), [repo.instrumentation], args.metrics_format)
+
     def get_loglevel(self, level: str) -> int:
         if level == 'debug':
             return logging.DEBUG
@@ -8,6 +8,7 @@ import sys
 from pathlib import Path
 
 from bireus.server.repository_manager import RepositoryManager
+from bireus.shared.instrumentation import Instrumentation, write_metrics
 
 root = logging.getLogger()
 root.setLevel(logging.DEBUG)
@@ -27,12 +28,22 @@ class Server(object):
         parser_add.add_argument("name", help="name of the repository")
         parser_add.add_argument("--first-version", "-fv", default="1.0.0", help="name of the initial version")
         parser_add.add_argument("--strategy", "-m", default="major-bi", help="update strategy")
+        parser_add.add_argument("--protocol", type=int, default=1, help="protocol version of the patches")
         parser_add.add_argument("--path", "-p", default=os.getcwd(), help="repository root path")
 
         parser_update = subparsers.add_parser("update")
         parser_update.add_argument("--repo", "-r", nargs="?", default=None)
         parser_update.add_argument("--cleanup", "-c", dest="cleanup", action="store_true",
                                    help='cleanup and remove all existing patches')
+        parser_update.add_argument("--jobs", "-j", type=int, default=1,
+                                   help="number of patches generated in parallel")
+        parser_update.add_argument("--cpu-budget", type=int, default=None,
+                                   help="number of cpu cores used by all repositories (default: all)")
+        parser_update.add_argument("--memory-budget", type=int, default=None,
+                                   help="estimated memory in MiB used by all repositories (default: unlimited)")
+        parser_update.add_argument("--metrics", default=None,
+                                   help="write timers and counters per phase, repository and file to this file")
+        parser_update.add_argument("--metrics-format", default="json", choices=['json', 'prometheus'])
         parser_update.add_argument("--path", "-p", default=os.getcwd(), help="repository root path")
 
         args = parser.parse_args()
@@ -51,7 +62,7 @@ class Server(object):
         repo_manager = RepositoryManager(Path(args.path))
 
         if args.command == "add":
-            repo_manager.create(args.name, args.first_version, args.strategy)
+            repo_manager.create(args.name, args.first_version, args.strategy, args.protocol)
             print("Repository %s created, copy your content into %s and run update" % (
             args.name, str(Path(args.path, args.first_version))))
 
@@ -59,7 +70,31 @@ class Server(object):
             if args.cleanup:
                 repo_manager.full_cleanup()
 
-            repo_manager.full_update()
+            if args.metrics is not None:
+                for repo in repo_manager.repositories:
+                    repo.instrumentation = Instrumentation(repo.name)
+
+            memory_budget = args.memory_budget * 1024 * 1024 if args.memory_budget else None
+            results = repo_manager.full_update(args.jobs, args.cpu_budget, memory_budget)
+
+            for repo, result in zip(repo_manager.repositories, results):
+                if result.success:
+                    print("%s: %s new versions in %.1fs, delta cache %s hits, %s misses, "
+                          "%s of %s deltas replaced by the full file" % (
+                              repo.name, len(result.new_versions), result.duration, repo.delta_cache_hits,
+                              repo.delta_cache_misses, repo.delta_fallbacks, repo.deltas_checked))
+                else:
+                    print("%s: update failed (%s)" % (repo.name, repr(result.error)))
+
+                if args.metrics is not None:
+                    print("    " + repo.instrumentation.summary())
+
+            if args.metrics is not None:
+                write_metrics(Path(args.metrics), [repo.instrumentation for repo in repo_manager.repositories],
+                              args.metrics_format)
+
+            if not all(result.success for result in results):
+                sys.exit(1)
 
     def get_loglevel(self, level: str) -> int:
         if level == 'debug':
@@ -5,7 +5,8 @@ from typing import List
 
 
 def get_subdirectory_names(path: Path) -> List[str]:
-    return [d.name for d in path.iterdir() if d.is_dir() and d.name != '.delta_to' and d.name != '__patches__']
+    return [d.name for d in path.iterdir()
+            if d.is_dir() and d.name not in ['.delta_to', '__patches__', '__manifests__', '__deltacache__']]
 
 
 def get_filenames(path: Path) -> List[str]:
@@ -0,0 +1,55 @@
+# coding=utf-8
+"""
+Checkouts reported by the clients to the web server, the frequent ones over several patches get a shortcut patch
+"""
+import json
+import logging
+import os
+import threading
+
+from typing import Dict, Tuple
+
+from bireus.shared import *
+
+logger = logging.getLogger(__name__)
+
+
+class CheckoutLog(object):
+    """
+    Counts the checkouts of a repository per (from, to) version pair, persisted as json
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._counts = dict()  # type: Dict[Tuple[str, str], int]
+        self._save_lock = threading.Lock()  # the web server saves the log on a thread pool
+
+        if path.exists():
+            with path.open('r') as file:
+                for version_from, version_to, count in json.load(file):
+                    self._counts[(version_from, version_to)] = count
+
+    def record(self, version_from: str, version_to: str) -> int:
+        """
+        :return: number of checkouts of this pair so far
+        """
+        key = (version_from, version_to)
+        self._counts[key] = self._counts.get(key, 0) + 1
+        return self._counts[key]
+
+    def counts(self) -> Dict[Tuple[str, str], int]:
+        """
+        :return: a copy of the counts, safe to read while the web server records further checkouts
+        """
+        return dict(self._counts)
+
+    def save(self) -> None:
+        counts = self.counts()
+
+        with self._save_lock:
+            # written to a temporary file and renamed, a crash never leaves half a log behind
+            tmp_path = self.path.with_name(self.path.name + '.tmp')
+            with tmp_path.open('w') as file:
+                json.dump([[version_from, version_to, count]
+                           for (version_from, version_to), count in sorted(counts.items())], file)
+            os.replace(str(tmp_path), str(self.path))
@@ -0,0 +1,119 @@
+# coding=utf-8
+import logging
+
+from typing import Any, Dict, List, Optional, Tuple
+
+from bireus.server.delta_cache import DeltaCache
+from bireus.server.diff_runner import DiffMemoryError, DiffRunner
+from bireus.shared import *
+from bireus.shared.codecs import Codec
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CODECS = ['bsdiff', 'store']
+FALLBACK_CODEC = 'blockdiff'  # used if no other codec is applicable for a file
+
+
+class CodecPolicy(object):
+    """
+    Chooses the delta codec per file, configured by the optional `codec_policy` in info.json, e.g.
+        "codec_policy": {"codecs": ["bsdiff", "blockdiff", "store"], "time_budget": 60}
+    All codecs are tried and the smallest delta wins. If trying them all is estimated to exceed
+    the time budget (in seconds), only the fastest codec is used.
+    """
+
+    def __init__(self, codecs: List[str] = None, time_budget: Optional[float] = None,
+                 bsdiff_max_size: Optional[int] = None):
+        if codecs is None:
+            codecs = DEFAULT_CODECS
+
+        self._codecs = [Codec.get(name) for name in codecs]  # type: List[Codec]
+        self._time_budget = time_budget
+        self._bsdiff_max_size = bsdiff_max_size
+
+    @property
+    def codecs(self) -> List[Codec]:
+        return self._codecs
+
+    @property
+    def time_budget(self) -> Optional[float]:
+        return self._time_budget
+
+    @classmethod
+    def from_settings(cls, settings: Dict[str, Any], bsdiff_max_size: Optional[int] = None) -> 'CodecPolicy':
+        policy = settings.get('codec_policy', dict())
+        return CodecPolicy(policy.get('codecs'), policy.get('time_budget'), bsdiff_max_size)
+
+    def candidates(self, size: int) -> List[Codec]:
+        """
+        :param size: size of the larger file of base and target
+        :return: the codecs to try for a file of this size
+        """
+        codecs = [codec for codec in self._codecs
+                  if codec.name != 'bsdiff' or self._bsdiff_max_size is None or size <= self._bsdiff_max_size]
+
+        if len(codecs) == 0:
+            return [Codec.get(FALLBACK_CODEC)]
+
+        if self._time_budget is not None and sum(codec.estimate_time(size) for codec in codecs) > self._time_budget:
+            return [max(codecs, key=lambda codec: codec.throughput)]
+
+        return codecs
+
+    def estimate_memory(self, size: int) -> int:
+        """
+        :param size: size of the larger file of base and target
+        :return: estimated peak memory in bytes, the candidates are tried one after another
+        """
+        return max(codec.estimate_memory(size) for codec in self.candidates(size))
+
+    def diff(self, basepath: Path, targetpath: Path, base_hash: str, target_hash: str, delta_cache: DeltaCache,
+             persistent_inputs: bool = True, runner: DiffRunner = None) -> Tuple[str, Path]:
+        """
+        Creates the deltas of all candidate codecs (or takes them from the cache) and picks the smallest
+        :param persistent_inputs: False if basepath and targetpath are removed before the delta is used
+        :param runner: runs the diffs within the memory limits, otherwise they run in-process
+        :return: name of the chosen codec and the path of its delta
+        """
+        candidates = self.candidates(max(basepath.stat().st_size, targetpath.stat().st_size))
+        best_codec = None  # type: Codec
+        best_path = None  # type: Path
+        best_size = 0
+
+        for codec in candidates:
+            try:
+                path = self._delta(codec, basepath, targetpath, base_hash, target_hash, delta_cache,
+                                   persistent_inputs, runner)
+            except DiffMemoryError as e:
+                logger.warning("%s, skipping the codec", str(e))
+                continue
+
+            size = path.stat().st_size
+            if best_codec is None or size < best_size:
+                best_codec, best_path, best_size = codec, path, size
+
+        if best_codec is None:
+            # all candidates needed too much memory
+            best_codec = Codec.get(FALLBACK_CODEC)
+            best_path = self._delta(best_codec, basepath, targetpath, base_hash, target_hash, delta_cache,
+                                    persistent_inputs, runner)
+            best_size = best_path.stat().st_size
+
+        logger.debug("Codec %s chosen for `%s` (%s bytes)", best_codec.name, str(targetpath), best_size)
+        return best_codec.name, best_path
+
+    @staticmethod
+    def _delta(codec: Codec, basepath: Path, targetpath: Path, base_hash: str, target_hash: str,
+               delta_cache: DeltaCache, persistent_inputs: bool, runner: Optional[DiffRunner]) -> Path:
+        path = codec.existing_delta(basepath, targetpath) if persistent_inputs else None
+
+        if path is None:
+            path = delta_cache.lookup(base_hash, target_hash, codec.name)
+        if path is None:
+            if runner is not None:
+                path = delta_cache.store(base_hash, target_hash, codec.name,
+                                         lambda temp_path: runner.diff(codec, basepath, targetpath, temp_path))
+            else:
+                path = delta_cache.store(base_hash, target_hash, codec.name,
+                                         lambda temp_path: codec.diff(basepath, targetpath, temp_path))
+        return path
@@ -3,3 +3,4 @@
 # import new versions here
 import bireus.server.compare_tasks.base
 import bireus.server.compare_tasks.v1
+import bireus.server.compare_tasks.v2
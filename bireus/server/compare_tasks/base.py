@@ -1,26 +1,97 @@
 # coding=utf-8
 import abc
+import json
 import logging
+import threading
 
+from typing import Optional
+
+from bireus.server.diff_runner import DEFAULT_ISOLATION_THRESHOLD
+from bireus.server.progress import NO_PROGRESS
 from bireus.shared import *
+from bireus.shared.codecs import BsdiffCodec
+from bireus.shared.instrumentation import DISABLED
 from bireus.shared.repository import ProtocolException
 
 logger = logging.getLogger(__name__)
 
+BSDIFF_MEMORY_FACTOR = BsdiffCodec.memory_factor  # bsdiff needs ~17x the file size in memory
+DEFAULT_BLOCKDIFF_THRESHOLD = 256 * 1024 * 1024
+DEFAULT_MIN_DELTA_SAVINGS = 10  # percent
+
 
 class CompareTask(abc.ABC):
     _compare_tasks = None
 
-    def __init__(self, absolute_path: Path, name: str, base: str, target: str, is_zipdelta: bool = False):
+    def __init__(self, absolute_path: Path, name: str, base: str, target: str, is_zipdelta: bool = False,
+                 jobs: int = 1):
         self._absolute_path = absolute_path
         self.name = name
         self.base = base
         self.target = target
         self.is_zipdelta = is_zipdelta
+        self.jobs = jobs  # number of threads for the file level work
 
         self._basepath = absolute_path.joinpath(self.base)  # type: Path
         self._targetpath = absolute_path.joinpath(self.target)  # type: Path
-        self._deltapath = absolute_path.joinpath(self.base, '.delta_to', self.target)
+        self._settings = self._load_settings(absolute_path.joinpath('info.json'))
+        # estimated memory (in bytes) the concurrently running diffs may use, None for unlimited
+        self.memory_budget = self._settings.get('diff_memory_budget')  # type: Optional[int]
+
+        # statistics of the delta size guard
+        self.deltas_checked = 0
+        self.delta_fallbacks = 0  # deltas that were replaced by the full file
+        self._statistics_lock = threading.Lock()
+
+        self.instrumentation = DISABLED
+        self.progress = NO_PROGRESS
+
+    @staticmethod
+    def _load_settings(info_path: Path) -> dict:
+        try:
+            with info_path.open('r') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return dict()
+
+    @property
+    def blockdiff_threshold(self) -> int:
+        """
+        Files larger than this (in bytes) are diffed block based instead of with bsdiff
+        """
+        return self._settings.get('blockdiff_threshold', DEFAULT_BLOCKDIFF_THRESHOLD)
+
+    @property
+    def blockdiff_action(self) -> bool:
+        """
+        Ship the block based deltas of large files with the `blockdiff` action. It is part of protocol 2 (as codec of
+        `delta`), protocol 1 repositories ship these files in full unless their clients are known to support it.
+        """
+        return self._settings.get('blockdiff_action', self.get_version() >= 2)
+
+    @property
+    def min_delta_savings(self) -> Optional[float]:
+        """
+        Percentage a delta must be smaller than the compressed target file, otherwise the file is shipped in full.
+        None disables the check.
+        """
+        return self._settings.get('min_delta_savings', DEFAULT_MIN_DELTA_SAVINGS)
+
+    @property
+    def diff_isolation_threshold(self) -> Optional[int]:
+        """
+        Diffs estimated to need at least this much memory (in bytes) run in a child process with a memory limit,
+        None runs all diffs in-process
+        """
+        return self._settings.get('diff_isolation_threshold', DEFAULT_ISOLATION_THRESHOLD)
+
+    @property
+    def move_detection(self) -> bool:
+        """
+        Detect moved, renamed, copied and similar files. Their `move` and `copy` actions and `source` fields are
+        part of protocol 2, protocol 1 repositories only get them if their clients are known to support them.
+        """
+        return self._settings.get('move_detection', self.get_version() >= 2)
 
     @abc.abstractclassmethod
     def get_version(cls) -> int:
@@ -28,15 +99,19 @@ class CompareTask(abc.ABC):
 
     @abc.abstractclassmethod
     def create(cls, absolute_path: Path, name: str, base: str, target: str,
-               is_zipdelta: bool = False) -> 'CompareTask':
+               is_zipdelta: bool = False, jobs: int = 1) -> 'CompareTask':
         pass
 
     @classmethod
     def get_factory(cls, protocol: int):
         if cls._compare_tasks is None:
             cls._compare_tasks = dict()
-            for compare_task_version in CompareTask.__subclasses__():
+            # newer protocol versions may extend older ones, so walk the whole class tree
+            compare_task_versions = CompareTask.__subclasses__()
+            while len(compare_task_versions) > 0:
+                compare_task_version = compare_task_versions.pop()
                 cls._compare_tasks[compare_task_version.get_version()] = compare_task_version.create
+                compare_task_versions.extend(compare_task_version.__subclasses__())
 
         if protocol in cls._compare_tasks:
             return cls._compare_tasks[protocol]
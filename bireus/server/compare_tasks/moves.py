@@ -0,0 +1,138 @@
+# coding=utf-8
+import logging
+from pathlib import PurePosixPath
+
+from typing import Dict, List
+
+from bireus.server import get_subdirectory_names, get_filenames
+from bireus.server.compare_tasks.similarity import SIZE_RATIO, SimilarityIndex
+from bireus.server.manifest import VersionManifest
+from bireus.shared import *
+from bireus.shared.checksum import hash_files
+
+logger = logging.getLogger(__name__)
+
+
+class Origin(object):
+    """
+    The file of the base version a new file of the target version is created from
+    """
+
+    def __init__(self, source: str, identical: bool, kept: bool):
+        self.source = source  # path relative to the version directory
+        self.identical = identical  # same content, otherwise the file needs a delta
+        self.kept = kept  # the source still exists in the target version
+
+    @property
+    def action(self) -> str:
+        """
+        :return: action of an identical file, `copy` if the source is still needed and `move` otherwise
+        """
+        return 'copy' if self.kept else 'move'
+
+
+class MoveDetector(object):
+    """
+    Finds moved, renamed and copied files: for each file that only exists in the target version it searches
+    a file of the base version with the same content, or at least with the same name and a similar size,
+    or at least with similar content.
+    Only files with a matching size are hashed, valid manifest entries spare reading them at all.
+    """
+
+    def __init__(self, basepath: Path, targetpath: Path, base_manifest: VersionManifest,
+                 target_manifest: VersionManifest, jobs: int = 1):
+        self._basepath = basepath
+        self._targetpath = targetpath
+        self._base_manifest = base_manifest
+        self._target_manifest = target_manifest
+        self._jobs = jobs
+
+    def detect(self) -> Dict[str, Origin]:
+        """
+        :return: the origin of each new file that has one, keyed by the path relative to the version directory
+        """
+        base_files = _list_files(self._basepath)
+        target_files = _list_files(self._targetpath)
+
+        # empty files cost nothing in the patch
+        added = {path: size for path, size in target_files.items() if path not in base_files and size > 0}
+        removed = {path: size for path, size in base_files.items() if path not in target_files and size > 0}
+
+        added_sizes = set(added.values())
+        sources = {path: size for path, size in base_files.items() if size in added_sizes}
+        source_sizes = set(sources.values())
+        candidates = {path: size for path, size in added.items() if size in source_sizes}
+
+        base_hashes = self._hash(self._basepath, self._base_manifest, sources)
+        target_hashes = self._hash(self._targetpath, self._target_manifest, candidates)
+
+        sources_by_hash = dict()  # type: Dict[str, List[str]]
+        for path in sources:
+            sources_by_hash.setdefault(base_hashes[path], []).append(path)
+
+        result = dict()  # type: Dict[str, Origin]
+
+        for path in candidates:
+            matches = sources_by_hash.get(target_hashes[path])
+            if matches is not None:
+                # prefer sources that are gone from the target version and sources with the same name
+                name = PurePosixPath(path).name
+                source = min(matches, key=lambda match: (match not in removed, PurePosixPath(match).name != name,
+                                                         match))
+                result[path] = Origin(source, identical=True, kept=source not in removed)
+
+        removed_by_name = dict()  # type: Dict[str, List[str]]
+        for path in removed:
+            removed_by_name.setdefault(PurePosixPath(path).name, []).append(path)
+
+        for path, size in added.items():
+            if path in result or PurePosixPath(path).name not in removed_by_name:
+                continue
+
+            source = min(removed_by_name[PurePosixPath(path).name],
+                         key=lambda match: (abs(removed[match] - size), match))
+            if min(size, removed[source]) >= SIZE_RATIO * max(size, removed[source]):
+                result[path] = Origin(source, identical=False, kept=False)
+
+        # variants of existing files (i.e. `unit_v2.bp` next to `unit.bp`)
+        index = SimilarityIndex(self._basepath, base_files)
+        for path, size in sorted(added.items()):
+            if path not in result:
+                source = index.closest(self._targetpath.joinpath(path), size)
+                if source is not None:
+                    result[path] = Origin(source, identical=False, kept=source in target_files)
+
+        logger.debug("%s of %s new files in `%s` have an origin in `%s`", len(result), len(added),
+                     self._targetpath.name, self._basepath.name)
+        return result
+
+    def _hash(self, version_path: Path, manifest: VersionManifest, files: Dict[str, int]) -> Dict[str, str]:
+        result = dict()  # type: Dict[str, str]
+        stale = []  # type: List[str]
+
+        for path in files:
+            entry = manifest.get(Path(path))
+            if entry is not None:
+                result[path] = entry.sha256
+            else:
+                stale.append(path)
+
+        for path, (crc32, sha256) in zip(stale, hash_files([version_path.joinpath(path) for path in stale],
+                                                            self._jobs)):
+            result[path] = sha256
+
+        return result
+
+
+def _list_files(version_path: Path, relative_path: Path = Path("")) -> Dict[str, int]:
+    """
+    :return: size of every file in the version directory, keyed by the relative path
+    """
+    path = version_path.joinpath(relative_path)
+    result = {relative_path.joinpath(file).as_posix(): path.joinpath(file).stat().st_size
+              for file in get_filenames(path)}
+
+    for directory in get_subdirectory_names(path):
+        result.update(_list_files(version_path, relative_path.joinpath(directory)))
+
+    return result
@@ -0,0 +1,88 @@
+# coding=utf-8
+import logging
+import threading
+
+from typing import BinaryIO, Callable, ContextManager, List, Optional
+
+from bireus.server.compare_tasks.work_queue import WorkItem, WorkQueue
+from bireus.server.compression import ArchiveWriter
+from bireus.server.progress import NO_PROGRESS, UpdateProgress
+from bireus.shared import *
+from bireus.shared.instrumentation import DISABLED, Instrumentation
+
+logger = logging.getLogger(__name__)
+
+
+class PatchWriter(object):
+    """
+    Collects the entries of a patch archive while a compare task is planned. The entries are written
+    in that order straight into the archive, each one as soon as the work item producing it is done.
+    """
+
+    def __init__(self, instrumentation: Instrumentation = DISABLED, progress: UpdateProgress = NO_PROGRESS):
+        self._entries = []  # type: List[Callable[[ArchiveWriter], None]]
+        self._error = None  # type: Optional[BaseException]
+        self._instrumentation = instrumentation
+        self._progress = progress
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def add_directory(self, arcname: str, source: Path = None, mtime: float = 0) -> None:
+        self._entries.append(lambda archive: archive.add_directory(arcname, source, mtime))
+
+    def add_file(self, arcname: str, source: Path) -> None:
+        def write(archive: ArchiveWriter) -> None:
+            with self._instrumentation.timer('archive', arcname):
+                archive.add_file(source, arcname)
+
+        self._entries.append(write)
+
+    def add_stream(self, arcname: str, size: int, opener: Callable[[], ContextManager[BinaryIO]],
+                   mtime: float = 0) -> None:
+        """
+        Adds a file whose content is read from a stream, opener is called when the entry is written
+        """
+
+        def write(archive: ArchiveWriter) -> None:
+            with self._instrumentation.timer('archive', arcname), opener() as stream:
+                archive.add_stream(arcname, size, stream, mtime)
+
+        self._entries.append(write)
+
+    def add_result(self, arcname: str, work_item: WorkItem, mtime: float) -> None:
+        """
+        Adds the file returned by a work item (i.e. a delta)
+        :param mtime: stable modification time, the returned file may be a shared cache entry
+        """
+        def write(archive: ArchiveWriter) -> None:
+            path = work_item.wait()
+            # the time spent waiting for the work item belongs to its own phase
+            with self._instrumentation.timer('archive', arcname):
+                archive.add_file(path, arcname, mtime)
+
+        self._entries.append(write)
+
+    def write(self, archive: ArchiveWriter, work_queue: WorkQueue) -> None:
+        """
+        Executes the work queue in the background and writes the entries meanwhile
+        """
+        worker = threading.Thread(target=self._execute, args=(work_queue,), name='bireus-work-queue')
+        worker.start()
+
+        try:
+            for write_entry in self._entries:
+                write_entry(archive)
+                self._progress.archive_written(archive.bytes_written)
+        finally:
+            worker.join()
+
+        if self._error is not None:
+            raise self._error
+
+    def _execute(self, work_queue: WorkQueue) -> None:
+        try:
+            work_queue.execute()
+        except BaseException as e:
+            # the failed work item re-raises it while writing, unless no entry depends on it
+            self._error = e
@@ -0,0 +1,125 @@
+# coding=utf-8
+import heapq
+import logging
+import zlib
+
+from typing import Dict, FrozenSet, List, Optional, Set
+
+from bireus.shared import *
+
+logger = logging.getLogger(__name__)
+
+SKETCH_SIZE = 64  # number of minimum hashes per file (bottom-k MinHash)
+SAMPLE_BLOCKS = 16  # larger files are sketched from this many evenly spread blocks
+SAMPLE_BLOCK_SIZE = 16 * 1024
+MIN_CHUNK_SIZE = 8  # shorter chunks occur in almost every file and say nothing about similarity
+MIN_FILE_SIZE = 1024  # a delta of smaller files isn't worth it
+MIN_SIMILARITY = 0.2  # estimated jaccard similarity of the chunk sets
+SIZE_RATIO = 0.5  # only files of a similar size are compared, by name (moves) or by content
+
+# chunk boundaries depend on the content only, so an insertion doesn't shift the following chunks.
+# Binary data contains a newline byte every 256 bytes on average, so this works for all files.
+_CHUNK_BOUNDARY = b'\n'
+
+
+def sketch_file(path: Path, size: int) -> FrozenSet[int]:
+    """
+    Splits the file into content defined chunks and keeps the smallest chunk hashes.
+    Splitting and hashing run in C (bytes.split, zlib), so sketching tens of thousands of files takes seconds.
+    :param size: size of the file
+    :return: up to SKETCH_SIZE chunk hashes
+    """
+    chunks = []  # type: List[bytes]
+
+    with path.open('rb') as file:
+        if size <= SAMPLE_BLOCKS * SAMPLE_BLOCK_SIZE:
+            chunks.extend(file.read().split(_CHUNK_BOUNDARY))
+        else:
+            for i in range(SAMPLE_BLOCKS):
+                file.seek((size - SAMPLE_BLOCK_SIZE) * i // (SAMPLE_BLOCKS - 1))
+                # the first and the last chunk depend on the sample position
+                chunks.extend(file.read(SAMPLE_BLOCK_SIZE).split(_CHUNK_BOUNDARY)[1:-1])
+
+    hashes = set(map(zlib.crc32, [chunk for chunk in chunks if len(chunk) >= MIN_CHUNK_SIZE]))
+    return frozenset(heapq.nsmallest(SKETCH_SIZE, hashes))
+
+
+def similarity(sketch1: FrozenSet[int], sketch2: FrozenSet[int]) -> float:
+    """
+    Estimates the jaccard similarity of two files from their sketches
+    """
+    union = heapq.nsmallest(SKETCH_SIZE, sketch1 | sketch2)
+    if len(union) == 0:
+        return 0.0
+
+    return sum(1 for value in union if value in sketch1 and value in sketch2) / len(union)
+
+
+def _size_bucket(size: int) -> int:
+    return size.bit_length()
+
+
+class SimilarityIndex(object):
+    """
+    Finds the most similar file of a version directory for a given file.
+    Files are bucketed by size, only the buckets that are queried get sketched.
+    """
+
+    def __init__(self, version_path: Path, files: Dict[str, int]):
+        """
+        :param version_path: the version directory
+        :param files: size of the files to search in, keyed by the path relative to version_path
+        """
+        self._version_path = version_path
+        self._buckets = dict()  # type: Dict[int, List[str]]
+        self._sizes = files
+        self._sketched_buckets = set()  # type: Set[int]
+        self._sketches = dict()  # type: Dict[str, FrozenSet[int]]
+        self._paths_by_hash = dict()  # type: Dict[int, List[str]]
+
+        for path, size in files.items():
+            if size >= MIN_FILE_SIZE:
+                self._buckets.setdefault(_size_bucket(size), []).append(path)
+
+    def closest(self, path: Path, size: int) -> Optional[str]:
+        """
+        :param path: the file to find a similar one for
+        :param size: size of the file
+        :return: relative path of the most similar indexed file or None if none is similar enough
+        """
+        if size < MIN_FILE_SIZE:
+            return None
+
+        bucket = _size_bucket(size)
+        for neighbour in range(bucket - 1, bucket + 2):
+            self._sketch_bucket(neighbour)
+
+        sketch = sketch_file(path, size)
+        candidates = set()  # type: Set[str]
+        for value in sketch:
+            candidates.update(self._paths_by_hash.get(value, []))
+
+        best_path = None  # type: Optional[str]
+        best_similarity = MIN_SIMILARITY
+
+        for candidate in sorted(candidates):
+            candidate_size = self._sizes[candidate]
+            if min(size, candidate_size) < SIZE_RATIO * max(size, candidate_size):
+                continue
+
+            candidate_similarity = similarity(sketch, self._sketches[candidate])
+            if candidate_similarity > best_similarity:
+                best_path, best_similarity = candidate, candidate_similarity
+
+        return best_path
+
+    def _sketch_bucket(self, bucket: int) -> None:
+        if bucket in self._sketched_buckets:
+            return
+
+        self._sketched_buckets.add(bucket)
+        for path in self._buckets.get(bucket, []):
+            sketch = sketch_file(self._version_path.joinpath(path), self._sizes[path])
+            self._sketches[path] = sketch
+            for value in sketch:
+                self._paths_by_hash.setdefault(value, []).append(path)
@@ -1,16 +1,28 @@
 # coding=utf-8
 import json
 import logging
-import tempfile
+import time
 import zipfile
 
-import bsdiff4
+from typing import Any, Callable, Dict, Optional, Tuple
 
 from bireus.server import get_subdirectory_names, get_filenames
+from bireus.server.codec_policy import FALLBACK_CODEC
 from bireus.server.compare_tasks.base import CompareTask
+from bireus.server.compare_tasks.moves import MoveDetector, Origin
+from bireus.server.compare_tasks.patch_writer import PatchWriter
+from bireus.server.compare_tasks.work_queue import WorkQueue
+from bireus.server.compare_tasks.zipdelta import ZipDelta
+from bireus.server.compression import ArchiveWriter, CompressionSettings, estimate_compressed_size
+from bireus.server.delta_cache import DeltaCache, get_cache_path
+from bireus.server.diff_runner import DiffMemoryError, DiffRunner
+from bireus.server.manifest import ManifestEntry, VersionManifest, get_manifest_path
 from bireus.shared import *
+from bireus.shared.checksum import hash_file
+from bireus.shared.codecs import Codec
 from bireus.shared.diff_head import DiffHead
 from bireus.shared.diff_item import DiffItem
+from bireus.shared.instrumentation import Instrumentation
 
 logger = logging.getLogger(__name__)
 
@@ -22,14 +34,68 @@ class CompareTaskV1(CompareTask):
 
     @classmethod
     def create(cls, absolute_path: Path, name: str, base: str, target: str,
-               is_zipdelta: bool = False) -> 'CompareTask':
-        return CompareTaskV1(absolute_path, name, base, target, is_zipdelta)
+               is_zipdelta: bool = False, jobs: int = 1) -> 'CompareTask':
+        return CompareTaskV1(absolute_path, name, base, target, is_zipdelta, jobs)
 
     def generate_diff(self, write_deltafile: bool = True) -> DiffHead:
+        start = time.perf_counter()
+        work_queue = WorkQueue(self.jobs, self.memory_budget, self.progress)
+        bireus_head = self.plan_diff(work_queue)
+
+        if write_deltafile:
+            patch_path = self._absolute_path.joinpath('__patches__', '%s_to_%s.tar.xz' % (self.base, self.target))
+            patch_path.parent.mkdir(exist_ok=True)
+
+            with ArchiveWriter(patch_path, CompressionSettings.from_settings(self._settings)) as archive:
+                self._patch_writer.write(archive, work_queue)
+                # all work items are done now, so the crc values are complete
+                archive.add_bytes('.bireus', json.dumps(bireus_head.to_dict()).encode('utf-8'))
+        else:
+            work_queue.execute()
+
+        self.instrumentation.duration = time.perf_counter() - start
+        self.instrumentation.count('delta_cache_hits', self._delta_cache.hits)
+        self.instrumentation.count('delta_cache_misses', self._delta_cache.misses)
+        self.instrumentation.count('isolated_diffs', self._diff_runner.isolated)
+        self.instrumentation.count('diffs_retried_alone', self._diff_runner.retried_alone)
+        return bireus_head
+
+    @property
+    def delta_cache(self) -> DeltaCache:
+        return self._delta_cache
+
+    @property
+    def patch_writer(self) -> PatchWriter:
+        return self._patch_writer
+
+    @property
+    def diff_runner(self) -> DiffRunner:
+        return self._diff_runner
+
+    def plan_diff(self, work_queue: WorkQueue, delta_cache: DeltaCache = None) -> DiffHead:
+        """
+        Builds the DiffItem tree, adds all expensive file operations to the work queue
+        and the entries of the patch archive to the patch writer.
+        The crc values of the DiffItems are filled in once the work queue is executed.
+        :param work_queue: the queue to add the work items to
+        :param delta_cache: cache for delta files, defaults to the cache of the repository
+        :return: the (yet incomplete) diff
+        """
         if not self.is_zipdelta:
             logger.debug('Generating %s diff `%s` -> `%s`', self.name, self.base, self.target)
 
-        self._deltapath.mkdir(parents=True, exist_ok=True)
+        if delta_cache is None:
+            delta_cache = DeltaCache(get_cache_path(self._absolute_path))
+
+        self._work_queue = work_queue
+        self._delta_cache = delta_cache
+        self._diff_runner = DiffRunner(self.diff_isolation_threshold, self.memory_budget)
+        self._patch_writer = PatchWriter(self.instrumentation, self.progress)
+        self._base_manifest = VersionManifest.load(self._basepath, get_manifest_path(self._absolute_path, self.base))
+        self._target_manifest = VersionManifest.load(self._targetpath,
+                                                     get_manifest_path(self._absolute_path, self.target))
+        with self.instrumentation.timer('moves'):
+            self._origins = self._detect_moves()
 
         bireus_head = DiffHead(protocol=self.get_version(),
                                repository=self.name,
@@ -43,15 +109,6 @@ class CompareTaskV1(CompareTask):
         else:
             bireus_head.items.extend(top_folder_diff.items)
 
-        if write_deltafile:
-            with self._deltapath.joinpath('.bireus').open(mode='w+') as diffFile:
-                json.dump(bireus_head.to_dict(), diffFile)
-
-            abs_delta_path = self._absolute_path.joinpath(self._deltapath)  # type: Path
-            make_archive(self._absolute_path.joinpath('__patches__', '%s_to_%s' % (self.base, self.target)), 'xztar',
-                         abs_delta_path)  # file extension gets added to filename automatically
-            remove_folder(self._absolute_path.joinpath(self.base, '.delta_to'))
-
         return bireus_head
 
     def _compare_directory(self, relative_path: Path) -> DiffItem:
@@ -59,28 +116,29 @@ class CompareTaskV1(CompareTask):
 
         basepath = self._basepath.joinpath(relative_path)  # type: Path
         targetpath = self._targetpath.joinpath(relative_path)  # type: Path
-        deltapath = self._deltapath.joinpath(relative_path)  # type: Path
 
         subdirectories = set()
         subfiles = set()
 
-        if basepath.exists():
-            if targetpath.exists():
-                action = 'delta'
-                deltapath.mkdir(exist_ok=True)
+        with self.instrumentation.timer('walk'):
+            if basepath.exists():
+                if targetpath.exists():
+                    action = 'delta'
+                    subdirectories.update(get_subdirectory_names(targetpath))
+                    subfiles.update(get_filenames(targetpath))
+                else:
+                    action = 'remove'
+
+                subdirectories.update(get_subdirectory_names(basepath))
+                subfiles.update(get_filenames(basepath))
+            else:
+                action = 'add'
                 subdirectories.update(get_subdirectory_names(targetpath))
                 subfiles.update(get_filenames(targetpath))
-            else:
-                action = 'remove'
-
-            subdirectories.update(get_subdirectory_names(basepath))
-            subfiles.update(get_filenames(basepath))
-        else:
-            action = 'add'
-            self._add_directory(relative_path)
 
-            subdirectories.update(get_subdirectory_names(targetpath))
-            subfiles.update(get_filenames(targetpath))
+        if targetpath.exists() and relative_path != Path(""):
+            # files of added directories are planned one by one as well, they may have been moved
+            self._patch_writer.add_directory(relative_path.as_posix(), targetpath)
 
         result_diff = DiffItem(iotype='directory',
                                name=relative_path.name,
@@ -106,60 +164,239 @@ class CompareTaskV1(CompareTask):
 
         basepath = self._basepath.joinpath(relative_path, file_path)
         targetpath = self._targetpath.joinpath(relative_path, file_path)
-        deltapath = self._deltapath.joinpath(relative_path, file_path)
+        arcname = relative_path.joinpath(file_path).as_posix()
+
+        # valid manifest entries spare us reading the file contents
+        base_entry = self._base_manifest.get(relative_path.joinpath(file_path))
+        target_entry = self._target_manifest.get(relative_path.joinpath(file_path))
 
         if not basepath.exists():
-            copy_file(targetpath, deltapath)
-            result_diff.action = 'add'
-            result_diff.target_crc = crc32_from_file(targetpath)
+            origin = self._origins.get(arcname)
+            if origin is not None:
+                self._plan_origin(result_diff, origin, targetpath, arcname, target_entry)
+            else:
+                self._patch_writer.add_file(arcname, targetpath)
+                result_diff.action = 'add'
+                self._fill_crc(result_diff, None, target_entry, None, targetpath)
 
         elif not targetpath.exists():
             result_diff.action = 'remove'
-            result_diff.base_crc = crc32_from_file(basepath)
+            self._fill_crc(result_diff, base_entry, None, basepath, None)
 
-        elif compare_files(basepath, targetpath):
+        elif self._is_unchanged(base_entry, target_entry, basepath, targetpath, arcname):
             result_diff.action = 'unchanged'
-            result_diff.base_crc = result_diff.target_crc = crc32_from_file(targetpath)
+            self._fill_crc(result_diff, target_entry, target_entry, targetpath, targetpath)
 
         else:
-            if zipfile.is_zipfile(str(basepath)):
+            if zipfile.is_zipfile(str(basepath)) and zipfile.is_zipfile(str(targetpath)):
+                logger.debug("zipdelta required for `%s`", file_path)
                 result_diff.action = 'zipdelta'
                 result_diff.base_crc = result_diff.target_crc = "#ZIPFILE"
 
-                temp = tempfile.TemporaryDirectory(suffix='_dir', prefix='bireus_')  # type: TemporaryDirectory
-
-                temp_abspath = Path(temp.name)
-                temp_basepath = temp_abspath.joinpath(self.base)
-                temp_targetpath = temp_abspath.joinpath(self.target)
-                temp_deltapath = temp_abspath.joinpath(self.base, ".delta_to", self.target)
-
-                temp_basepath.mkdir(parents=True, exist_ok=True)
-                temp_targetpath.mkdir(parents=True, exist_ok=True)
-                temp_deltapath.mkdir(parents=True, exist_ok=True)
-
-                unpack_archive(basepath, temp_basepath, "zip")
-                unpack_archive(targetpath, temp_targetpath, "zip")
-
-                logger.debug("zipdelta required for `%s`", file_path)
-                zip_diff = CompareTaskV1(temp_abspath, self.name, self.base, self.target,
-                                         is_zipdelta=True).generate_diff(
-                    False)
-                copy_folder(temp_deltapath, deltapath)
-
-                result_diff.items.extend(zip_diff.items)
+                # the content of the zip file is planned into the same queue
+                with self.instrumentation.timer('zip_extract', arcname):
+                    result_diff.items.extend(self._create_zip_delta(basepath, targetpath, arcname).plan())
             else:
-                result_diff.action = 'bsdiff'
-                bsdiff4.file_diff(str(basepath), str(targetpath), str(deltapath))
-                result_diff.target_crc = crc32_from_file(targetpath)
-                result_diff.base_crc = crc32_from_file(basepath)
+                self._plan_delta(result_diff, basepath, targetpath, arcname, base_entry, target_entry)
+                self._fill_crc(result_diff, base_entry, target_entry, basepath, targetpath)
 
         return result_diff
 
-    def _add_directory(self, relative_path: Path) -> None:
-        logger.debug("_add_directory for `%s`", relative_path)
-
-        targetpath = self._targetpath.joinpath(relative_path)
-        deltapath = self._deltapath.joinpath(relative_path)
+    def _plan_origin(self, diff: DiffItem, origin: Origin, targetpath: Path, arcname: str,
+                     target_entry: Optional[ManifestEntry]) -> None:
+        """
+        Plans a new file that is created on the client from a file of the base version
+        """
+        sourcepath = self._basepath.joinpath(origin.source)
+        source_entry = self._base_manifest.get(Path(origin.source))
+        diff.source = origin.source
+
+        if origin.identical:
+            # the client takes the file from its base version, nothing goes into the archive
+            diff.action = origin.action
+        else:
+            self._plan_delta(diff, sourcepath, targetpath, arcname, source_entry, target_entry)
+
+        self._fill_crc(diff, source_entry, target_entry, sourcepath, targetpath)
+
+    def _detect_moves(self) -> Dict[str, Origin]:
+        if self.is_zipdelta or not self.move_detection:
+            return dict()
+
+        return MoveDetector(self._basepath, self._targetpath, self._base_manifest, self._target_manifest,
+                            self.jobs).detect()
+
+    def _create_zip_delta(self, basepath: Path, targetpath: Path, arcname: str) -> ZipDelta:
+        return ZipDelta(self._work_queue, self._delta_cache, self._patch_writer, basepath, targetpath, arcname,
+                        targetpath.stat().st_mtime, self.blockdiff_threshold, diff_runner=self._diff_runner,
+                        instrumentation=self.instrumentation, blockdiff_action=self.blockdiff_action)
+
+    def _plan_delta(self, diff: DiffItem, basepath: Path, targetpath: Path, arcname: str,
+                    base_entry: Optional[ManifestEntry], target_entry: Optional[ManifestEntry]) -> None:
+        """
+        Sets the action of a changed file and queues the creation of its delta file
+        """
+        base_size = basepath.stat().st_size
+        size = max(base_size, targetpath.stat().st_size)
+        if size > self.blockdiff_threshold:
+            if not self.blockdiff_action:
+                # older clients would take the block based delta for the file
+                logger.debug("`%s` exceeds the blockdiff threshold, shipping the file", str(targetpath))
+                self._patch_writer.add_file(arcname, targetpath)
+                self._ship_file(diff)
+                return
+            # bsdiff would need several GiB of memory, fall back to a block based delta
+            diff.action = 'blockdiff'
+        else:
+            diff.action = 'bsdiff'
+
+        memory = Codec.get(diff.action).estimate_memory(size)
+        self._queue_delta(diff, targetpath, arcname, self._diff, diff, basepath, targetpath, arcname,
+                          base_entry, target_entry, cost=base_size, memory=memory)
+
+    def _queue_delta(self, diff: DiffItem, targetpath: Path, arcname: str, function: Callable[..., Path],
+                     *args: Any, cost: int = 0, memory: int = 0) -> None:
+        """
+        Queues the creation of a delta file and adds it (or the target file, if that is smaller) to the patch archive
+        :param function: creates the delta file and returns its path
+        :param memory: estimated peak memory of function in bytes
+        """
+        work_item = self._work_queue.add(diff.action, self._delta_or_file, diff, targetpath, arcname, function,
+                                         *args, cost=cost, memory=memory)
+        self._patch_writer.add_result(arcname, work_item, targetpath.stat().st_mtime)
+
+    def _delta_or_file(self, diff: DiffItem, targetpath: Path, arcname: str, function: Callable[..., Path],
+                       *args: Any) -> Path:
+        delta_path = function(*args)
+        if delta_path == targetpath:
+            # the codec stores the file as it is already
+            return delta_path
+
+        if self.min_delta_savings is None:
+            if diff.source is None:
+                return delta_path
+            # a delta against another (only similar) file may not even be smaller than the file, guard or not
+            min_delta_savings = 0
+        else:
+            min_delta_savings = self.min_delta_savings
+
+        # re-encoded files (compressed audio, encrypted blobs) often produce deltas as large as the file,
+        # the delta must save enough to be worth patching on the client
+        with self.instrumentation.timer('size_guard', arcname):
+            delta_size = estimate_compressed_size(delta_path)
+            target_size = estimate_compressed_size(targetpath)
+        fallback = delta_size > target_size * (100 - min_delta_savings) / 100
+
+        with self._statistics_lock:
+            self.deltas_checked += 1
+            if fallback:
+                self.delta_fallbacks += 1
+
+        self.instrumentation.count('deltas_checked')
+        if fallback:
+            self.instrumentation.count('delta_fallbacks')
+
+        if not fallback:
+            return delta_path
+
+        logger.debug("Delta of `%s` saves too little (%s vs. %s bytes), shipping the file", str(targetpath),
+                     delta_size, target_size)
+        self._ship_file(diff)
+        return targetpath
+
+    @staticmethod
+    def _ship_file(diff: DiffItem) -> None:
+        """
+        Turns a planned delta into the full target file
+        """
+        # a new file is added, an existing one replaced
+        diff.action = 'add' if diff.source is not None else 'replace'
+        diff.codec = None
+        diff.source = None
+
+    def _diff(self, diff: DiffItem, basepath: Path, targetpath: Path, arcname: str,
+              base_entry: Optional[ManifestEntry], target_entry: Optional[ManifestEntry]) -> Path:
+        """
+        :return: the delta file in the delta cache
+        """
+        # the same file pair shows up in many patches, so look it up in the cache first
+        base_hash, target_hash = self._hashes(basepath, targetpath, base_entry, target_entry, arcname)
+
+        try:
+            return self._cached_diff(diff.action, basepath, targetpath, arcname, base_hash, target_hash)
+        except DiffMemoryError as e:
+            self.instrumentation.count('memory_fallbacks')
+            if not self.blockdiff_action:
+                # older clients would take the block based delta for the file
+                logger.warning("%s, shipping the file", str(e))
+                self._ship_file(diff)
+                return targetpath
+
+            logger.warning("%s, falling back to %s", str(e), FALLBACK_CODEC)
+            diff.action = FALLBACK_CODEC
+            return self._cached_diff(diff.action, basepath, targetpath, arcname, base_hash, target_hash)
+
+    def _cached_diff(self, action: str, basepath: Path, targetpath: Path, arcname: str, base_hash: str,
+                     target_hash: str) -> Path:
+        delta_path = self._delta_cache.lookup(base_hash, target_hash, action)
+        if delta_path is not None:
+            logger.debug("delta cache hit for `%s`", str(targetpath))
+            return delta_path
+
+        codec = Codec.get(action)
+
+        def diff(path: Path) -> None:
+            with self.instrumentation.timer(action, arcname):
+                self._diff_runner.diff(codec, basepath, targetpath, path)
+            # the throughput of each codec
+            self.instrumentation.count('%s_bytes' % action, targetpath.stat().st_size)
+
+        return self._delta_cache.store(base_hash, target_hash, action, diff)
+
+    def _hashes(self, basepath: Path, targetpath: Path, base_entry: Optional[ManifestEntry],
+                target_entry: Optional[ManifestEntry], arcname: str) -> Tuple[str, str]:
+        if base_entry is not None and target_entry is not None:
+            return base_entry.sha256, target_entry.sha256
+
+        with self.instrumentation.timer('hash', arcname):
+            base_hash = base_entry.sha256 if base_entry is not None else hash_file(basepath)[1]
+            target_hash = target_entry.sha256 if target_entry is not None else hash_file(targetpath)[1]
+            return base_hash, target_hash
+
+    def _is_unchanged(self, base_entry: Optional[ManifestEntry], target_entry: Optional[ManifestEntry],
+                      basepath: Path, targetpath: Path, arcname: str) -> bool:
+        if base_entry is not None and target_entry is not None:
+            return base_entry.size == target_entry.size and base_entry.sha256 == target_entry.sha256
+        else:
+            with self.instrumentation.timer('compare', arcname):
+                return compare_files(basepath, targetpath)
+
+    def _fill_crc(self, diff: DiffItem, base_entry: Optional[ManifestEntry], target_entry: Optional[ManifestEntry],
+                  basepath: Optional[Path], targetpath: Optional[Path]) -> None:
+        """
+        Takes the crc values from the manifest entries, files without a valid entry are queued for reading
+        """
+        if basepath is not None and base_entry is not None:
+            diff.base_crc = base_entry.crc32
+            basepath = None
+
+        if targetpath is not None and target_entry is not None:
+            diff.target_crc = target_entry.crc32
+            targetpath = None
+
+        if basepath is not None or targetpath is not None:
+            self._work_queue.add('crc', _read_crc, diff, basepath, targetpath, self.instrumentation)
+
+
+def _read_crc(diff: DiffItem, basepath: Optional[Path], targetpath: Optional[Path],
+              instrumentation: Instrumentation) -> None:
+    with instrumentation.timer('hash'):
+        if basepath is not None:
+            diff.base_crc = crc32_from_file(basepath)
+
+        if targetpath is not None:
+            if targetpath == basepath:
+                diff.target_crc = diff.base_crc
+            else:
+                diff.target_crc = crc32_from_file(targetpath)
 
-        if not deltapath.exists():
-            copy_folder(targetpath, deltapath)
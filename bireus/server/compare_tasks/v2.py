@@ -0,0 +1,61 @@
+# coding=utf-8
+import logging
+
+from typing import Optional
+
+from bireus.server.codec_policy import CodecPolicy
+from bireus.server.compare_tasks.base import CompareTask
+from bireus.server.compare_tasks.v1 import CompareTaskV1
+from bireus.server.compare_tasks.zipdelta import ZipDelta
+from bireus.server.manifest import ManifestEntry
+from bireus.shared import *
+from bireus.shared.diff_item import DiffItem
+
+logger = logging.getLogger(__name__)
+
+
+class CompareTaskV2(CompareTaskV1):
+    """
+    Protocol 2: changed files get the action `delta` and the codec chosen by the codec policy of the repository
+    """
+
+    def __init__(self, absolute_path: Path, name: str, base: str, target: str, is_zipdelta: bool = False,
+                 jobs: int = 1):
+        super().__init__(absolute_path, name, base, target, is_zipdelta, jobs)
+        self._codec_policy = CodecPolicy.from_settings(self._settings, self.blockdiff_threshold)
+
+    @classmethod
+    def get_version(cls) -> int:
+        return 2
+
+    @classmethod
+    def create(cls, absolute_path: Path, name: str, base: str, target: str,
+               is_zipdelta: bool = False, jobs: int = 1) -> 'CompareTask':
+        return CompareTaskV2(absolute_path, name, base, target, is_zipdelta, jobs)
+
+    @property
+    def codec_policy(self) -> CodecPolicy:
+        return self._codec_policy
+
+    def _create_zip_delta(self, basepath: Path, targetpath: Path, arcname: str) -> ZipDelta:
+        return ZipDelta(self._work_queue, self._delta_cache, self._patch_writer, basepath, targetpath, arcname,
+                        targetpath.stat().st_mtime, self.blockdiff_threshold, codec_policy=self._codec_policy,
+                        diff_runner=self._diff_runner, instrumentation=self.instrumentation)
+
+    def _plan_delta(self, diff: DiffItem, basepath: Path, targetpath: Path, arcname: str,
+                    base_entry: Optional[ManifestEntry], target_entry: Optional[ManifestEntry]) -> None:
+        diff.action = 'delta'
+        base_size = basepath.stat().st_size
+        memory = self._codec_policy.estimate_memory(max(base_size, targetpath.stat().st_size))
+        self._queue_delta(diff, targetpath, arcname, self._codec_diff, diff, basepath, targetpath, arcname,
+                          base_entry, target_entry, cost=base_size, memory=memory)
+
+    def _codec_diff(self, diff: DiffItem, basepath: Path, targetpath: Path, arcname: str,
+                    base_entry: Optional[ManifestEntry], target_entry: Optional[ManifestEntry]) -> Path:
+        base_hash, target_hash = self._hashes(basepath, targetpath, base_entry, target_entry, arcname)
+        # includes the lookups in the delta cache, the policy may try several codecs
+        with self.instrumentation.timer('delta', arcname):
+            diff.codec, delta_path = self._codec_policy.diff(basepath, targetpath, base_hash, target_hash,
+                                                             self._delta_cache, runner=self._diff_runner)
+        self.instrumentation.count('delta_bytes', targetpath.stat().st_size)
+        return delta_path
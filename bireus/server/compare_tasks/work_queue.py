@@ -0,0 +1,176 @@
+# coding=utf-8
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from typing import Any, Callable, List, Optional
+
+from bireus.server.progress import NO_PROGRESS, UpdateProgress
+
+logger = logging.getLogger(__name__)
+
+
+class WorkItem(object):
+    """
+    A single unit of work planned by a compare task (bsdiff, copy, crc, zipdelta)
+    """
+
+    def __init__(self, kind: str, function: Callable[..., Any], args: List[Any], cost: int = 0, memory: int = 0):
+        self.kind = kind
+        self.cost = cost
+        self.memory = memory  # estimated peak memory in bytes
+        self.result = None  # return value of function
+        self._function = function
+        self._args = args
+        self._error = None  # type: Optional[BaseException]
+        self._done = threading.Event()
+
+    def run(self) -> None:
+        try:
+            self.result = self._function(*self._args)
+        except BaseException as e:
+            self._error = e
+            raise
+        finally:
+            self._done.set()
+
+    def cancel(self, error: BaseException) -> None:
+        if not self._done.is_set():
+            self._error = error
+            self._done.set()
+
+    def wait(self) -> Any:
+        """
+        Blocks until the item was executed
+        :return: the result of the item, re-raises its exception
+        """
+        self._done.wait()
+        if self._error is not None:
+            raise self._error
+        return self.result
+
+
+class WorkQueue(object):
+    """
+    Collects the work items of a compare task and executes them on a bounded thread pool.
+    With a memory budget an item only starts while the estimated memory of all running items fits into it,
+    an item that exceeds the budget on its own starts once nothing else is running.
+    """
+
+    def __init__(self, jobs: int = 1, memory_budget: Optional[int] = None, progress: UpdateProgress = NO_PROGRESS):
+        """
+        :param jobs: number of threads
+        :param memory_budget: estimated memory in bytes the running items may use, None for unlimited
+        :param progress: counts the executed items
+        """
+        self.jobs = jobs
+        self.memory_budget = memory_budget
+        self.progress = progress
+        self._items = []  # type: List[WorkItem]
+
+        self._condition = threading.Condition()
+        self._pending = []  # type: List[WorkItem]
+        self._memory_used = 0
+        self._running = 0
+        self._failure = None  # type: Optional[BaseException]
+
+    @property
+    def items(self) -> List[WorkItem]:
+        return self._items
+
+    def add(self, kind: str, function: Callable[..., Any], *args: Any, cost: int = 0, memory: int = 0) -> WorkItem:
+        """
+        Adds a work item
+        :param kind: type of work, used for logging only
+        :param function: function to execute
+        :param args: arguments for function
+        :param cost: estimated cost (i.e. file size), expensive items are started first
+        :param memory: estimated peak memory in bytes, only counts with a memory budget
+        :return: the new item, to wait for its result
+        """
+        item = WorkItem(kind, function, list(args), cost, memory)
+        self._items.append(item)
+        return item
+
+    def execute(self) -> None:
+        logger.debug("Executing %s work items with %s threads", len(self._items), self.jobs)
+        self.progress.add_work(len(self._items))
+
+        try:
+            if self.jobs > 1 and len(self._items) > 1:
+                # the order of execution doesn't affect the result, so start with the most expensive items
+                items = sorted(self._items, key=lambda item: item.cost, reverse=True)
+
+                if self.memory_budget is not None:
+                    self._execute_within_budget(items)
+                else:
+                    with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+                        futures = [executor.submit(self._run, item) for item in items]
+
+                        for future in futures:
+                            future.result()  # re-raises exceptions of the worker
+            else:
+                for item in self._items:
+                    self._run(item)
+        except BaseException as e:
+            # nobody must wait forever for items that will never run
+            for item in self._items:
+                item.cancel(e)
+            raise
+        finally:
+            self._items = []
+
+    def _run(self, item: WorkItem) -> None:
+        item.run()
+        self.progress.complete_work()
+
+    def _execute_within_budget(self, items: List[WorkItem]) -> None:
+        self._pending = items
+        self._failure = None
+
+        workers = [threading.Thread(target=self._work, name='bireus-work-%s' % i) for i in range(self.jobs)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        if self._failure is not None:
+            raise self._failure
+
+    def _work(self) -> None:
+        while True:
+            item = self._take()
+            if item is None:
+                return
+
+            try:
+                self._run(item)
+            except BaseException as e:
+                with self._condition:
+                    # no new items are started after a failure
+                    if self._failure is None:
+                        self._failure = e
+            finally:
+                with self._condition:
+                    self._memory_used -= item.memory
+                    self._running -= 1
+                    self._condition.notify_all()
+
+    def _take(self) -> Optional[WorkItem]:
+        """
+        Blocks until the first pending item fits into the memory budget
+        :return: the item, None if there is nothing left to do
+        """
+        with self._condition:
+            while True:
+                if self._failure is not None or len(self._pending) == 0:
+                    return None
+
+                for item in self._pending:
+                    if self._running == 0 or self._memory_used + item.memory <= self.memory_budget:
+                        self._pending.remove(item)
+                        self._memory_used += item.memory
+                        self._running += 1
+                        return item
+
+                self._condition.wait()
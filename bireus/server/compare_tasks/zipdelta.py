@@ -0,0 +1,347 @@
+# coding=utf-8
+import contextlib
+import hashlib
+import io
+import logging
+import shutil
+import tempfile
+import zipfile
+
+import bsdiff4
+from typing import BinaryIO, Dict, Iterator, List, Optional, Set, Tuple, Union
+
+from bireus.server.codec_policy import CodecPolicy, FALLBACK_CODEC
+from bireus.server.compare_tasks.patch_writer import PatchWriter
+from bireus.server.compare_tasks.work_queue import WorkQueue
+from bireus.server.delta_cache import DeltaCache
+from bireus.server.diff_runner import DiffMemoryError, DiffRunner
+from bireus.shared import *
+from bireus.shared.checksum import hash_file
+from bireus.shared.codecs import Codec
+from bireus.shared.diff_item import DiffItem
+from bireus.shared.instrumentation import DISABLED, Instrumentation
+
+logger = logging.getLogger(__name__)
+
+ZipSource = Union[Path, bytes]  # a zip file on disk or the content of a zip nested in another zip
+
+
+def open_zip(source: ZipSource) -> zipfile.ZipFile:
+    if isinstance(source, bytes):
+        return zipfile.ZipFile(io.BytesIO(source))
+    else:
+        return zipfile.ZipFile(str(source))
+
+
+def read_member(source: ZipSource, name: str) -> bytes:
+    with open_zip(source) as zip_file:
+        return zip_file.read(name)
+
+
+def _format_crc32(info: zipfile.ZipInfo) -> str:
+    # same format as crc32_from_file on the extracted member
+    if info.file_size > 0:
+        return hex(info.CRC & 0xffffffff)
+    else:
+        return "#EMPTY"
+
+
+def _is_safe(name: str) -> bool:
+    # the same members shutil.unpack_archive would skip on the client
+    return not name.startswith('/') and '..' not in name.split('/')
+
+
+class ZipListing(object):
+    """
+    Directory tree of a zip file, built from its central directory only
+    """
+
+    def __init__(self, zip_file: zipfile.ZipFile):
+        self.files = dict()  # type: Dict[str, zipfile.ZipInfo]
+        self.directories = {''}  # type: Set[str]
+        self._subdirectories = dict()  # type: Dict[str, Set[str]]
+        self._subfiles = dict()  # type: Dict[str, Set[str]]
+
+        for info in zip_file.infolist():
+            if not _is_safe(info.filename):
+                logger.warning("Skipping unsafe zip member `%s`", info.filename)
+                continue
+
+            if info.filename.endswith('/'):
+                self._add_directory(info.filename)
+            else:
+                self.files[info.filename] = info
+                self._subfiles.setdefault(self._parent(info.filename), set()).add(info.filename)
+                self._add_directory(self._parent(info.filename))
+
+    @staticmethod
+    def _parent(name: str) -> str:
+        parts = name.rstrip('/').split('/')
+        return '/'.join(parts[:-1]) + '/' if len(parts) > 1 else ''
+
+    def _add_directory(self, name: str) -> None:
+        # register the directory including all implicit parent directories
+        while name not in self.directories:
+            self.directories.add(name)
+            self._subdirectories.setdefault(self._parent(name), set()).add(name)
+            name = self._parent(name)
+
+    def subdirectories(self, prefix: str) -> Set[str]:
+        return self._subdirectories.get(prefix, set())
+
+    def subfiles(self, prefix: str) -> Set[str]:
+        return self._subfiles.get(prefix, set())
+
+
+class ZipDelta(object):
+    """
+    Compares two zip files member by member without extracting them.
+    Members with equal crc and size are unchanged, only the differing members are read and diffed.
+    """
+
+    def __init__(self, work_queue: WorkQueue, delta_cache: DeltaCache, patch_writer: PatchWriter, base: ZipSource,
+                 target: ZipSource, arcname: str, mtime: float, blockdiff_threshold: int,
+                 codec_policy: CodecPolicy = None, diff_runner: DiffRunner = None,
+                 instrumentation: Instrumentation = DISABLED, blockdiff_action: bool = True):
+        self._work_queue = work_queue
+        self._delta_cache = delta_cache
+        self._patch_writer = patch_writer
+        self._base = base
+        self._target = target
+        self._arcname = arcname  # name of the zip file in the patch archive
+        self._mtime = mtime  # the zip members are stored with the modification time of the zip file
+        self._blockdiff_threshold = blockdiff_threshold
+        self._codec_policy = codec_policy  # chooses the codec per member, otherwise bsdiff/blockdiff
+        self._diff_runner = diff_runner if diff_runner is not None else DiffRunner(None)  # all in-process
+        self._instrumentation = instrumentation
+        self._blockdiff_action = blockdiff_action  # otherwise members above the threshold are shipped in full
+
+    def plan(self) -> List[DiffItem]:
+        """
+        Builds the DiffItems for the content of the zip files, adds the work items for
+        changed members to the work queue and the entries to the patch writer
+        :return: the items of the top level directory inside the zip
+        """
+        with open_zip(self._base) as base_zip, open_zip(self._target) as target_zip:
+            self._base_listing = ZipListing(base_zip)
+            self._target_listing = ZipListing(target_zip)
+
+            return self._compare_directory('', base_zip, target_zip).items
+
+    def _compare_directory(self, prefix: str, base_zip: zipfile.ZipFile, target_zip: zipfile.ZipFile) -> DiffItem:
+        in_base = prefix in self._base_listing.directories
+        in_target = prefix in self._target_listing.directories
+
+        if in_base and in_target:
+            action = 'delta'
+        elif in_base:
+            action = 'remove'
+        else:
+            action = 'add'
+
+        if action != 'remove':
+            self._patch_writer.add_directory(self._member_arcname(prefix), mtime=self._mtime)
+
+        result_diff = DiffItem(iotype='directory',
+                               name=prefix.rstrip('/').split('/')[-1],
+                               action=action,
+                               base_crc='',
+                               target_crc='')  # type: DiffItem
+
+        for subdirectory in self._base_listing.subdirectories(prefix) | self._target_listing.subdirectories(prefix):
+            result_diff.items.append(self._compare_directory(subdirectory, base_zip, target_zip))
+
+        for file in self._base_listing.subfiles(prefix) | self._target_listing.subfiles(prefix):
+            result_diff.items.append(self._compare_file(file, base_zip, target_zip))
+
+        return result_diff
+
+    def _compare_file(self, name: str, base_zip: zipfile.ZipFile, target_zip: zipfile.ZipFile) -> DiffItem:
+        base_info = self._base_listing.files.get(name)
+        target_info = self._target_listing.files.get(name)
+
+        result_diff = DiffItem(iotype='file',
+                               name=name.split('/')[-1],
+                               base_crc='',
+                               target_crc='')  # type: DiffItem
+
+        if base_info is None:
+            result_diff.action = 'add'
+            result_diff.target_crc = _format_crc32(target_info)
+            self._patch_writer.add_stream(self._member_arcname(name), target_info.file_size,
+                                          lambda: self._open_member(self._target, name), self._mtime)
+
+        elif target_info is None:
+            result_diff.action = 'remove'
+            result_diff.base_crc = _format_crc32(base_info)
+
+        elif base_info.CRC == target_info.CRC and base_info.file_size == target_info.file_size:
+            result_diff.action = 'unchanged'
+            result_diff.base_crc = result_diff.target_crc = _format_crc32(target_info)
+
+        else:
+            nested_base = self._read_nested_zip(base_zip, name)
+            nested_target = self._read_nested_zip(target_zip, name) if nested_base is not None else None
+
+            if nested_target is not None:
+                logger.debug("nested zipdelta required for `%s`", name)
+                result_diff.action = 'zipdelta'
+                result_diff.base_crc = result_diff.target_crc = "#ZIPFILE"
+
+                # nested zip files are kept in memory until the patch is written
+                nested_delta = ZipDelta(self._work_queue, self._delta_cache, self._patch_writer, nested_base,
+                                        nested_target, self._member_arcname(name), self._mtime,
+                                        self._blockdiff_threshold, codec_policy=self._codec_policy,
+                                        diff_runner=self._diff_runner, instrumentation=self._instrumentation,
+                                        blockdiff_action=self._blockdiff_action)
+                result_diff.items.extend(nested_delta.plan())
+            else:
+                result_diff.base_crc = _format_crc32(base_info)
+                result_diff.target_crc = _format_crc32(target_info)
+
+                size = max(base_info.file_size, target_info.file_size)
+                if self._codec_policy is not None:
+                    result_diff.action = 'delta'
+                    work_item = self._work_queue.add('zipdelta', self._codec_member, name, result_diff,
+                                                     cost=base_info.file_size,
+                                                     memory=self._codec_policy.estimate_memory(size))
+                elif size > self._blockdiff_threshold and not self._blockdiff_action:
+                    # older clients would take the block based delta for the member
+                    result_diff.action = 'replace'
+                    self._patch_writer.add_stream(self._member_arcname(name), target_info.file_size,
+                                                  lambda: self._open_member(self._target, name), self._mtime)
+                    return result_diff
+                else:
+                    result_diff.action = 'blockdiff' if size > self._blockdiff_threshold else 'bsdiff'
+                    memory = Codec.get(result_diff.action).estimate_memory(size)
+
+                    if result_diff.action == 'bsdiff' and self._diff_runner.in_process(memory):
+                        work_item = self._work_queue.add('zipdelta', self._bsdiff_member, name,
+                                                         cost=base_info.file_size, memory=memory)
+                    else:
+                        # large members are streamed to disk instead of being held in memory
+                        work_item = self._work_queue.add('zipdelta', self._extracted_member, name, result_diff,
+                                                         cost=base_info.file_size, memory=memory)
+
+                self._patch_writer.add_result(self._member_arcname(name), work_item, self._mtime)
+
+        return result_diff
+
+    @staticmethod
+    def _read_nested_zip(zip_file: zipfile.ZipFile, name: str) -> Optional[bytes]:
+        """
+        :return: the content of the member if it is a zip file itself, otherwise None
+        """
+        # check the local header signature first to avoid reading every changed member
+        with zip_file.open(name) as member:
+            if member.read(4) != b'PK\x03\x04':
+                return None
+
+        data = zip_file.read(name)
+        if zipfile.is_zipfile(io.BytesIO(data)):
+            return data
+        else:
+            return None
+
+    def _member_arcname(self, name: str) -> str:
+        return '/'.join([self._arcname] + [part for part in name.split('/') if part])
+
+    @staticmethod
+    @contextlib.contextmanager
+    def _open_member(source: ZipSource, name: str) -> Iterator[BinaryIO]:
+        with open_zip(source) as zip_file:
+            with zip_file.open(name) as member:
+                yield member
+
+    def _extract_member(self, source: ZipSource, name: str, dest: Path) -> None:
+        with self._open_member(source, name) as member, dest.open('wb') as file:
+            shutil.copyfileobj(member, file)
+
+    def _bsdiff_member(self, name: str) -> Path:
+        arcname = self._member_arcname(name)
+        with self._instrumentation.timer('zip_extract', arcname):
+            base_data = read_member(self._base, name)
+            target_data = read_member(self._target, name)
+
+        with self._instrumentation.timer('hash', arcname):
+            base_hash = hashlib.sha256(base_data).hexdigest()
+            target_hash = hashlib.sha256(target_data).hexdigest()
+
+        delta_path = self._delta_cache.lookup(base_hash, target_hash, 'bsdiff')
+        if delta_path is not None:
+            return delta_path
+
+        def diff(path: Path) -> None:
+            with self._instrumentation.timer('bsdiff', arcname):
+                path.write_bytes(bsdiff4.diff(base_data, target_data))
+            self._instrumentation.count('bsdiff_bytes', len(target_data))
+
+        return self._delta_cache.store(base_hash, target_hash, 'bsdiff', diff)
+
+    @contextlib.contextmanager
+    def _extract_pair(self, name: str) -> Iterator[Tuple[Path, Path]]:
+        """
+        Streams a member of the base and of the target zip into a temporary directory
+        """
+        with tempfile.TemporaryDirectory(prefix='bireus_') as tempdir:
+            basepath = Path(tempdir, 'base')
+            targetpath = Path(tempdir, 'target')
+            with self._instrumentation.timer('zip_extract', self._member_arcname(name)):
+                self._extract_member(self._base, name, basepath)
+                self._extract_member(self._target, name, targetpath)
+            yield basepath, targetpath
+
+    def _extracted_member(self, name: str, diff: DiffItem) -> Path:
+        """
+        Diffs the extracted member with the codec named by the action of diff,
+        falls back to blockdiff (or the full member) if it needs more memory than the diff runner allows
+        """
+        arcname = self._member_arcname(name)
+        with self._extract_pair(name) as (basepath, targetpath):
+            with self._instrumentation.timer('hash', arcname):
+                base_hash = hash_file(basepath)[1]
+                target_hash = hash_file(targetpath)[1]
+
+            try:
+                return self._cached_diff(diff.action, basepath, targetpath, arcname, base_hash, target_hash)
+            except DiffMemoryError as e:
+                self._instrumentation.count('memory_fallbacks')
+                if not self._blockdiff_action:
+                    # older clients would take the block based delta for the member, the extracted files are
+                    # temporary, so the full member has to end up in the cache
+                    logger.warning("%s, shipping the member", str(e))
+                    diff.action = 'replace'
+                    return self._cached_diff('store', basepath, targetpath, arcname, base_hash, target_hash)
+
+                logger.warning("%s, falling back to %s", str(e), FALLBACK_CODEC)
+                diff.action = FALLBACK_CODEC
+                return self._cached_diff(diff.action, basepath, targetpath, arcname, base_hash, target_hash)
+
+    def _cached_diff(self, action: str, basepath: Path, targetpath: Path, arcname: str, base_hash: str,
+                     target_hash: str) -> Path:
+        delta_path = self._delta_cache.lookup(base_hash, target_hash, action)
+        if delta_path is not None:
+            return delta_path
+
+        codec = Codec.get(action)
+
+        def diff(path: Path) -> None:
+            with self._instrumentation.timer(action, arcname):
+                self._diff_runner.diff(codec, basepath, targetpath, path)
+            self._instrumentation.count('%s_bytes' % action, targetpath.stat().st_size)
+
+        return self._delta_cache.store(base_hash, target_hash, action, diff)
+
+    def _codec_member(self, name: str, diff: DiffItem) -> Path:
+        arcname = self._member_arcname(name)
+        with self._extract_pair(name) as (basepath, targetpath):
+            with self._instrumentation.timer('hash', arcname):
+                base_hash = hash_file(basepath)[1]
+                target_hash = hash_file(targetpath)[1]
+
+            # the extracted files are temporary, so the delta has to end up in the cache
+            with self._instrumentation.timer('delta', arcname):
+                diff.codec, delta_path = self._codec_policy.diff(basepath, targetpath, base_hash, target_hash,
+                                                                 self._delta_cache, persistent_inputs=False,
+                                                                 runner=self._diff_runner)
+            return delta_path
@@ -0,0 +1,372 @@
+# coding=utf-8
+import collections
+import io
+import logging
+import lzma
+import os
+import struct
+import tarfile
+import uuid
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from typing import Any, BinaryIO, Deque, Dict, Optional
+
+from bireus.shared import *
+from bireus.shared.checksum import read_chunks
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LEVEL = 6
+
+# dictionary size of the xz presets, blocks are 3x the dictionary size (like `xz -T`)
+_PRESET_DICT_SIZES = [256 * 1024, 1 << 20, 2 << 20, 4 << 20, 4 << 20, 8 << 20, 8 << 20, 16 << 20, 32 << 20, 64 << 20]
+MIN_BLOCK_SIZE = 1024 * 1024
+
+# files starting with these signatures are compressed already and are stored as they are
+PRECOMPRESSED_SIGNATURES = (
+    b'BSDIFF40',  # bsdiff4 (bz2 inside)
+    b'BZh',  # bz2
+    b'\x1f\x8b',  # gzip
+    b'\xfd7zXZ\x00',  # xz
+    b'(\xb5/\xfd',  # zstd
+    b'7z\xbc\xaf\x27\x1c',  # 7z
+    b'PK\x03\x04',  # zip, jar, docx, ...
+    b'\x89PNG',  # png
+    b'\xff\xd8\xff',  # jpeg
+    b'OggS',  # ogg
+    b'fLaC',  # flac
+    b'ID3',  # mp3
+)
+MIN_STORE_SIZE = 64 * 1024  # smaller files are not worth an extra block
+
+# compressed sizes are estimated with a fast preset from at most 8 MiB per file
+ESTIMATE_LEVEL = 1
+ESTIMATE_SAMPLES = 8
+ESTIMATE_SAMPLE_SIZE = 1024 * 1024
+
+_XZ_MAGIC = b'\xfd7zXZ\x00'
+_XZ_FOOTER_MAGIC = b'YZ'
+_XZ_STREAM_FLAGS = b'\x00\x01'  # crc32 check
+_LZMA2_CHUNK_SIZE = 64 * 1024  # maximum size of an uncompressed LZMA2 chunk
+
+
+class CompressionSettings(object):
+    """
+    Compression of the patch archives and latest.tar.xz, configured by the optional `compression` in info.json, e.g.
+        "compression": {"level": 6, "threads": 4, "store_precompressed": true}
+    The format is always .tar.xz, because clients request the archives by that name.
+    """
+
+    def __init__(self, level: int = DEFAULT_LEVEL, threads: int = None, block_size: int = None,
+                 store_precompressed: bool = True):
+        if not 0 <= level <= 9:
+            raise ValueError("xz compression level must be within 0 and 9, got %s" % level)
+
+        self.level = level
+        self.threads = threads if threads else (os.cpu_count() or 1)
+        self.block_size = block_size if block_size else max(MIN_BLOCK_SIZE, 3 * _PRESET_DICT_SIZES[level])
+        self.store_precompressed = store_precompressed
+
+    @classmethod
+    def from_settings(cls, settings: Dict[str, Any]) -> 'CompressionSettings':
+        compression = settings.get('compression', dict())
+        return CompressionSettings(compression.get('level', DEFAULT_LEVEL), compression.get('threads'),
+                                   compression.get('block_size'), compression.get('store_precompressed', True))
+
+
+def is_precompressed(path: Path) -> bool:
+    if path.stat().st_size < MIN_STORE_SIZE:
+        return False
+
+    with path.open('rb') as file:
+        return file.read(8).startswith(PRECOMPRESSED_SIGNATURES)
+
+
+def estimate_compressed_size(path: Path) -> int:
+    """
+    Estimates the size of a file inside a patch archive. Larger files are estimated from evenly spread samples.
+    """
+    size = path.stat().st_size
+    if is_precompressed(path):
+        return size
+
+    compressor = lzma.LZMACompressor(format=lzma.FORMAT_XZ, preset=ESTIMATE_LEVEL)
+    compressed = 0
+
+    if size <= ESTIMATE_SAMPLES * ESTIMATE_SAMPLE_SIZE:
+        for chunk in read_chunks(path):
+            compressed += len(compressor.compress(chunk))
+        return compressed + len(compressor.flush())
+
+    with path.open('rb') as file:
+        for i in range(ESTIMATE_SAMPLES):
+            file.seek((size - ESTIMATE_SAMPLE_SIZE) * i // (ESTIMATE_SAMPLES - 1))
+            compressed += len(compressor.compress(file.read(ESTIMATE_SAMPLE_SIZE)))
+        compressed += len(compressor.flush())
+
+    return compressed * size // (ESTIMATE_SAMPLES * ESTIMATE_SAMPLE_SIZE)
+
+
+class _PrefixedStream(object):
+    """
+    Puts the already consumed head of a stream back in front of it
+    """
+
+    def __init__(self, head: bytes, stream: BinaryIO):
+        self._head = head
+        self._stream = stream
+
+    def read(self, size: int = -1) -> bytes:
+        if len(self._head) == 0:
+            return self._stream.read(size)
+
+        if size < 0:
+            result = self._head + self._stream.read()
+            self._head = b''
+            return result
+
+        result = self._head[:size]
+        self._head = self._head[size:]
+        if len(result) < size:
+            result += self._stream.read(size - len(result))
+        return result
+
+
+def _encode_varint(value: int) -> bytes:
+    result = bytearray()
+    while value >= 0x80:
+        result.append((value & 0x7f) | 0x80)
+        value >>= 7
+    result.append(value)
+    return bytes(result)
+
+
+def _crc32(data: bytes) -> bytes:
+    return struct.pack('<I', zlib.crc32(data) & 0xffffffff)
+
+
+def _padding(size: int) -> bytes:
+    return b'\x00' * (-size % 4)
+
+
+def stored_xz(data: bytes) -> bytes:
+    """
+    Wraps data into a valid xz stream without compressing it (uncompressed LZMA2 chunks)
+    """
+    # block header: size, flags (1 filter, no sizes), LZMA2 filter with the smallest dictionary
+    header = b'\x02\x00\x21\x01\x00'
+    header += _padding(len(header))
+    header += _crc32(header)
+
+    chunks = bytearray()
+    for offset in range(0, len(data), _LZMA2_CHUNK_SIZE):
+        chunk = data[offset:offset + _LZMA2_CHUNK_SIZE]
+        chunks.append(0x01 if offset == 0 else 0x02)  # uncompressed chunk, reset the dictionary once
+        chunks.extend(struct.pack('>H', len(chunk) - 1))
+        chunks.extend(chunk)
+    chunks.append(0x00)  # end of LZMA2 data
+
+    check = _crc32(data)
+    block = header + bytes(chunks) + _padding(len(header) + len(chunks)) + check
+    unpadded_size = len(header) + len(chunks) + len(check)
+
+    index = b'\x00' + _encode_varint(1) + _encode_varint(unpadded_size) + _encode_varint(len(data))
+    index += _padding(len(index))
+    index += _crc32(index)
+
+    footer = struct.pack('<I', len(index) // 4 - 1) + _XZ_STREAM_FLAGS
+
+    return (_XZ_MAGIC + _XZ_STREAM_FLAGS + _crc32(_XZ_STREAM_FLAGS) + block + index +
+            _crc32(footer) + footer + _XZ_FOOTER_MAGIC)
+
+
+class _BlockWriter(object):
+    """
+    File-like sink for tarfile: cuts the tar stream into blocks that are compressed in parallel
+    and written as consecutive xz streams (which every xz decoder reads as one file)
+    """
+
+    def __init__(self, file, settings: CompressionSettings):
+        self._file = file
+        self._settings = settings
+        self._executor = ThreadPoolExecutor(max_workers=settings.threads)
+        self._pending = collections.deque()  # type: Deque[Future]
+        self._buffer = bytearray()
+        self._store = False
+        self._position = 0
+
+    def tell(self) -> int:
+        return self._position
+
+    def write(self, data: bytes) -> int:
+        self._buffer.extend(data)
+        self._position += len(data)
+
+        if len(self._buffer) >= self._settings.block_size:
+            self._flush_block()
+
+        return len(data)
+
+    def set_store(self, store: bool) -> None:
+        """
+        Stores the following data without compressing it (or compresses it again)
+        """
+        if store != self._store:
+            self._flush_block()
+            self._store = store
+
+    def _flush_block(self) -> None:
+        if len(self._buffer) == 0:
+            return
+
+        data = bytes(self._buffer)
+        self._buffer = bytearray()
+
+        if self._store:
+            self._pending.append(self._executor.submit(stored_xz, data))
+        else:
+            # lzma releases the GIL, so the blocks are compressed on several cores
+            self._pending.append(self._executor.submit(lzma.compress, data, format=lzma.FORMAT_XZ,
+                                                       check=lzma.CHECK_CRC32, preset=self._settings.level))
+
+        # keep the memory bounded: write finished blocks in order
+        while len(self._pending) > self._settings.threads:
+            self._file.write(self._pending.popleft().result())
+
+    def close(self) -> None:
+        try:
+            self._flush_block()
+            while len(self._pending) > 0:
+                self._file.write(self._pending.popleft().result())
+        finally:
+            self._executor.shutdown()
+
+
+class ArchiveWriter(object):
+    """
+    Writes a .tar.xz archive entry by entry. The archive is written to a temporary file
+    and moved to its destination on close, so readers never see an incomplete archive.
+    """
+
+    def __init__(self, path: Path, settings: CompressionSettings = None):
+        if settings is None:
+            settings = CompressionSettings()
+
+        self._path = path
+        self._settings = settings
+        self._temp_path = path.with_name('%s.%s.tmp' % (path.name, uuid.uuid4().hex))
+        self._file = self._temp_path.open('wb')
+        self._blocks = _BlockWriter(self._file, settings)
+        # follow symlinks like the copy functions do
+        self._tar = tarfile.open(fileobj=self._blocks, mode='w', dereference=True)
+
+    @property
+    def path(self) -> Path:
+        return self._path
+
+    @property
+    def bytes_written(self) -> int:
+        """
+        Compressed bytes written to disk so far, blocks still being compressed are missing
+        """
+        return self._file.tell()
+
+    def add_file(self, source: Path, arcname: str, mtime: float = None) -> None:
+        """
+        Adds a file, with the modification time of source unless mtime is given
+        """
+        tarinfo = self._tar.gettarinfo(str(source), arcname)
+        if mtime is not None:
+            tarinfo.mtime = mtime
+        if tarinfo.islnk():
+            # never store hard links: the client would overwrite several files at once when patching
+            tarinfo.type = tarfile.REGTYPE
+            tarinfo.size = source.stat().st_size
+
+        self._blocks.set_store(self._settings.store_precompressed and is_precompressed(source))
+        with source.open('rb') as file:
+            self._tar.addfile(tarinfo, file)
+
+    def add_directory(self, arcname: str, source: Path = None, mtime: float = 0) -> None:
+        """
+        Adds a directory entry, with the attributes of source if given
+        """
+        if source is not None:
+            tarinfo = self._tar.gettarinfo(str(source), arcname)
+        else:
+            tarinfo = tarfile.TarInfo(arcname)
+            tarinfo.type = tarfile.DIRTYPE
+            tarinfo.mode = 0o755
+            tarinfo.mtime = mtime
+
+        self._blocks.set_store(False)
+        self._tar.addfile(tarinfo)
+
+    def add_stream(self, arcname: str, size: int, stream: BinaryIO, mtime: float = 0) -> None:
+        """
+        Adds a file with the next size bytes of stream as content
+        """
+        head = stream.read(8)
+        store = self._settings.store_precompressed and size >= MIN_STORE_SIZE and \
+            head.startswith(PRECOMPRESSED_SIGNATURES)
+
+        tarinfo = tarfile.TarInfo(arcname)
+        tarinfo.size = size
+        tarinfo.mode = 0o644
+        tarinfo.mtime = mtime
+
+        self._blocks.set_store(store)
+        self._tar.addfile(tarinfo, _PrefixedStream(head, stream))
+
+    def add_bytes(self, arcname: str, data: bytes, mtime: float = 0) -> None:
+        self.add_stream(arcname, len(data), io.BytesIO(data), mtime)
+
+    def add_tree(self, root_dir: Path, prefix: str = '') -> None:
+        """
+        Adds the content of root_dir recursively in a stable order
+        """
+        for dirpath, dirnames, filenames in os.walk(str(root_dir), followlinks=True):
+            dirnames.sort()
+            relative_dir = Path(dirpath).relative_to(root_dir)
+
+            for dirname in dirnames:
+                self.add_directory(prefix + relative_dir.joinpath(dirname).as_posix(), Path(dirpath, dirname))
+
+            for filename in sorted(filenames):
+                self.add_file(Path(dirpath, filename), prefix + relative_dir.joinpath(filename).as_posix())
+
+    def close(self) -> None:
+        try:
+            self._tar.close()
+            self._blocks.close()
+        finally:
+            self._file.close()
+
+        os.replace(str(self._temp_path), str(self._path))
+
+    def abort(self) -> None:
+        try:
+            self._blocks.close()
+        finally:
+            self._file.close()
+            self._temp_path.unlink()
+
+    def __enter__(self) -> 'ArchiveWriter':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def write_archive(path: Path, root_dir: Path, settings: Optional[CompressionSettings] = None) -> Path:
+    """
+    Packs the content of root_dir into the .tar.xz archive at path
+    """
+    with ArchiveWriter(path, settings) as archive:
+        archive.add_tree(root_dir)
+
+    return path
@@ -0,0 +1,117 @@
+# coding=utf-8
+import logging
+import os
+import threading
+import uuid
+
+from typing import Callable, List, Optional, Tuple
+
+from bireus.shared import *
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_SIZE = 1024 * 1024 * 1024  # 1 GiB
+
+
+def get_cache_path(repository_path: Path) -> Path:
+    return repository_path.joinpath('__deltacache__')
+
+
+class DeltaCache(object):
+    """
+    Content addressed on-disk cache for delta files, keyed by (base hash, target hash, codec).
+    Lookups refresh the mtime of an entry, eviction removes the least recently used entries first.
+    The cache may be shared by several threads and processes, entries are written atomically.
+    """
+
+    def __init__(self, path: Path):
+        self._path = path
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def path(self) -> Path:
+        return self._path
+
+    def _entry_path(self, base_hash: str, target_hash: str, codec: str) -> Path:
+        return self._path.joinpath(base_hash[:2], '%s_%s.%s' % (base_hash, target_hash, codec))
+
+    def lookup(self, base_hash: str, target_hash: str, codec: str) -> Optional[Path]:
+        """
+        :return: path of the cached delta or None
+        """
+        entry_path = self._entry_path(base_hash, target_hash, codec)
+
+        try:
+            os.utime(str(entry_path))
+            hit = True
+        except FileNotFoundError:  # not cached or evicted in the meantime
+            hit = False
+
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        return entry_path if hit else None
+
+    def store(self, base_hash: str, target_hash: str, codec: str, write: Callable[[Path], None]) -> Path:
+        """
+        Creates a cache entry
+        :param write: function that writes the delta to the given path
+        :return: path of the new entry
+        """
+        entry_path = self._entry_path(base_hash, target_hash, codec)
+        entry_path.parent.mkdir(parents=True, exist_ok=True)
+
+        temp_path = entry_path.with_name('%s.%s.tmp' % (entry_path.name, uuid.uuid4().hex))
+        try:
+            write(temp_path)
+            os.replace(str(temp_path), str(entry_path))
+        except BaseException:
+            if temp_path.exists():
+                temp_path.unlink()
+            raise
+
+        return entry_path
+
+    def evict(self, max_size: int) -> int:
+        """
+        Removes the least recently used entries until the cache fits into max_size
+        :return: number of removed entries
+        """
+        if not self._path.exists():
+            return 0
+
+        entries = []  # type: List[Tuple[float, int, Path]]
+        total_size = 0
+
+        for entry_path in self._path.glob('*/*'):
+            if entry_path.suffix == '.tmp':
+                # an entry being written by store, it is renamed once complete
+                continue
+            try:
+                stat = entry_path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry_path))
+            total_size += stat.st_size
+
+        entries.sort()
+        removed = 0
+
+        while total_size > max_size and removed < len(entries):
+            mtime, size, entry_path = entries[removed]
+            try:
+                entry_path.unlink()
+            except FileNotFoundError:
+                pass
+            total_size -= size
+            removed += 1
+
+        if removed > 0:
+            logger.debug("Evicted %s entries from delta cache %s", removed, str(self._path))
+
+        return removed
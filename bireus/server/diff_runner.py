@@ -0,0 +1,197 @@
+# coding=utf-8
+"""
+Runs memory hungry diffs (bsdiff needs ~17x the file size) in a child process with a memory limit, so running out
+of memory fails a single diff instead of the whole server process. Started as a script it is the child:
+
+    python -m bireus.server.diff_runner <codec> <base> <target> <delta> <memory limit>
+"""
+import contextlib
+import logging
+import os
+import signal
+import subprocess
+import sys
+import threading
+
+from typing import Iterator, Optional, Tuple
+
+import bireus
+from bireus.shared import *
+from bireus.shared.codecs import Codec
+
+try:
+    import resource
+except ImportError:  # not available on windows, the child runs without a limit there
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ISOLATION_THRESHOLD = 256 * 1024 * 1024  # estimated memory from which a diff runs in a child process
+LIMIT_HEADROOM = 256 * 1024 * 1024  # address space of the interpreter besides the diff itself
+EXIT_OUT_OF_MEMORY = 3
+_KILLED = -getattr(signal, 'SIGKILL', 9)  # return code of a child killed by the kernel (OOM killer)
+
+
+class DiffMemoryError(Exception):
+    """
+    The diff needs more memory than it may use, a cheaper codec has to be used instead
+    """
+
+    def __init__(self, codec: str, path: Path, memory: int):
+        super().__init__("%s of `%s` needs more memory than allowed (estimated %s bytes)" % (codec, str(path),
+                                                                                           memory))
+        self.codec = codec
+        self.path = path
+        self.memory = memory
+
+
+class DiffError(Exception):
+    def __init__(self, codec: str, path: Path, returncode: int, output: str):
+        super().__init__("%s of `%s` failed with exit code %s: %s" % (codec, str(path), returncode, output))
+        self.returncode = returncode
+
+
+class _Gate(object):
+    """
+    Lets any number of isolated diffs run side by side, or a single one alone
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._running = 0
+        self._exclusive = False
+
+    @property
+    def running(self) -> int:
+        """
+        :return: number of isolated diffs running side by side right now
+        """
+        with self._condition:
+            return self._running
+
+    @contextlib.contextmanager
+    def shared(self) -> Iterator[None]:
+        with self._condition:
+            self._condition.wait_for(lambda: not self._exclusive)
+            self._running += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._running -= 1
+                self._condition.notify_all()
+
+    @contextlib.contextmanager
+    def exclusive(self) -> Iterator[None]:
+        with self._condition:
+            self._condition.wait_for(lambda: not self._exclusive)
+            self._exclusive = True
+            self._condition.wait_for(lambda: self._running == 0)
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._exclusive = False
+                self._condition.notify_all()
+
+
+class DiffRunner(object):
+    """
+    Runs the diffs of a compare task. Small diffs run in-process, diffs estimated to need at least
+    isolation_threshold bytes run in a child process whose address space is limited to the estimate (plus headroom).
+    A child killed by the kernel while other isolated diffs were running ran out of memory together with them,
+    it is retried alone. A child killed while running alone or exceeding its own limit raises DiffMemoryError,
+    as does a diff that exceeds the memory budget anyway.
+    """
+
+    def __init__(self, isolation_threshold: Optional[int] = DEFAULT_ISOLATION_THRESHOLD,
+                 memory_budget: Optional[int] = None):
+        """
+        :param isolation_threshold: estimated memory in bytes from which a diff runs in a child, None for never
+        :param memory_budget: estimated memory in bytes a single diff may use at most, None for unlimited
+        """
+        self.isolation_threshold = isolation_threshold
+        self.memory_budget = memory_budget
+
+        # statistics
+        self.isolated = 0  # diffs that ran in a child process
+        self.retried_alone = 0  # diffs that were killed and retried without other isolated diffs running
+        self._lock = threading.Lock()
+        self._gate = _Gate()
+
+    def in_process(self, memory: int) -> bool:
+        """
+        :param memory: estimated memory of the diff in bytes
+        :return: True if the diff runs in this process without a limit
+        """
+        return (self.isolation_threshold is None or memory < self.isolation_threshold) and \
+            (self.memory_budget is None or memory <= self.memory_budget)
+
+    def diff(self, codec: Codec, base_path: Path, target_path: Path, delta_path: Path) -> None:
+        """
+        Writes the delta of base_path and target_path to delta_path
+        :raises DiffMemoryError: the codec needs more memory than it may use for these files
+        """
+        memory = codec.estimate_memory(max(base_path.stat().st_size, target_path.stat().st_size))
+
+        if self.in_process(memory):
+            codec.diff(base_path, target_path, delta_path)
+            return
+
+        if self.memory_budget is not None and memory > self.memory_budget:
+            raise DiffMemoryError(codec.name, target_path, memory)
+
+        with self._lock:
+            self.isolated += 1
+
+        with self._gate.shared():
+            returncode, output = self._run_child(codec, base_path, target_path, delta_path, memory)
+            crowded = self._gate.running > 1
+
+        if returncode == _KILLED and crowded:
+            logger.warning("%s of `%s` was killed, retrying it alone", codec.name, str(target_path))
+            with self._lock:
+                self.retried_alone += 1
+
+            with self._gate.exclusive():
+                returncode, output = self._run_child(codec, base_path, target_path, delta_path, memory)
+
+        if returncode in (EXIT_OUT_OF_MEMORY, _KILLED):
+            raise DiffMemoryError(codec.name, target_path, memory)
+        elif returncode != 0:
+            raise DiffError(codec.name, target_path, returncode, output)
+
+    @staticmethod
+    def _run_child(codec: Codec, base_path: Path, target_path: Path, delta_path: Path,
+                   memory: int) -> Tuple[int, str]:
+        limit = memory * 3 // 2 + LIMIT_HEADROOM  # the estimate is rough
+        logger.debug("Running %s of `%s` in a child process (memory limit %s bytes)", codec.name, str(target_path),
+                     limit)
+
+        # the child must find this package even if it isn't installed
+        env = dict(os.environ)
+        package_root = str(Path(bireus.__file__).resolve().parents[1])
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, [package_root, env.get('PYTHONPATH')]))
+
+        result = subprocess.run([sys.executable, '-m', 'bireus.server.diff_runner', codec.name, str(base_path),
+                                 str(target_path), str(delta_path), str(limit)],
+                                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, env=env)
+        return result.returncode, result.stderr.decode(errors='replace').strip()
+
+
+def main(argv=None) -> int:
+    codec_name, base_path, target_path, delta_path, limit = (argv or sys.argv[1:])
+
+    if resource is not None:
+        resource.setrlimit(resource.RLIMIT_AS, (int(limit), int(limit)))
+
+    try:
+        Codec.get(codec_name).diff(Path(base_path), Path(target_path), Path(delta_path))
+    except MemoryError:
+        return EXIT_OUT_OF_MEMORY
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
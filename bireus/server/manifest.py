@@ -0,0 +1,159 @@
+# coding=utf-8
+import hashlib
+import json
+import logging
+import os
+
+from typing import Any, Dict, List, Optional, Tuple
+
+from bireus.server import get_subdirectory_names, get_filenames
+from bireus.shared import *
+from bireus.shared.checksum import hash_files
+
+logger = logging.getLogger(__name__)
+
+
+def get_manifest_path(repository_path: Path, version: str) -> Path:
+    return repository_path.joinpath('__manifests__', '%s.json' % version)
+
+
+class ManifestEntry(object):
+    """
+    Checksums of a single file, valid as long as the stat values don't change
+    """
+
+    def __init__(self, size: int, mtime: int, inode: int, crc32: str, sha256: str):
+        self.size = size
+        self.mtime = mtime
+        self.inode = inode
+        self.crc32 = crc32
+        self.sha256 = sha256
+
+    def matches(self, stat: os.stat_result) -> bool:
+        return self.size == stat.st_size and self.mtime == stat.st_mtime_ns and self.inode == stat.st_ino
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'size': self.size,
+            'mtime': self.mtime,
+            'inode': self.inode,
+            'crc32': self.crc32,
+            'sha256': self.sha256
+        }
+
+    @staticmethod
+    def load_dict(data: Dict[str, Any]) -> 'ManifestEntry':
+        return ManifestEntry(data['size'], data['mtime'], data['inode'], data['crc32'], data['sha256'])
+
+
+class VersionManifest(object):
+    """
+    Content manifest of a version directory (relative path -> checksums).
+    Entries are keyed by size, mtime and inode, so only modified files need to be read again.
+    """
+
+    def __init__(self, version_path: Path, entries: Dict[str, ManifestEntry] = None):
+        if entries is None:
+            entries = dict()
+
+        self._version_path = version_path
+        self._entries = entries  # type: Dict[str, ManifestEntry]
+
+    @property
+    def entries(self) -> Dict[str, ManifestEntry]:
+        return self._entries
+
+    def get(self, relative_path: Path) -> Optional[ManifestEntry]:
+        """
+        Returns the entry of a file, but only if the file wasn't touched since it was hashed
+        :param relative_path: path relative to the version directory
+        :return: the entry or None if there is no valid entry
+        """
+        entry = self._entries.get(relative_path.as_posix())
+
+        if entry is None:
+            return None
+
+        try:
+            stat = self._version_path.joinpath(relative_path).stat()
+        except FileNotFoundError:
+            return None
+
+        if entry.matches(stat):
+            return entry
+        else:
+            return None
+
+    def fingerprint(self) -> str:
+        """
+        :return: hash over the paths and contents of all files, changes whenever the content of the version changes
+        """
+        fingerprint = hashlib.sha256()
+        for path in sorted(self._entries):
+            fingerprint.update(('%s %s\n' % (path, self._entries[path].sha256)).encode('utf-8'))
+        return fingerprint.hexdigest()
+
+    def refresh(self, jobs: int = 4) -> int:
+        """
+        Brings the manifest up to date with the version directory
+        :param jobs: number of threads used for hashing
+        :return: number of entries that were added, updated or removed
+        """
+        entries = dict()
+        stale = []  # type: List[Tuple[str, os.stat_result]]
+        self._refresh_directory(Path(""), entries, stale)
+
+        for (path, stat), (crc32, sha256) in zip(stale, hash_files(
+                [self._version_path.joinpath(path) for path, stat in stale], jobs)):
+            entries[path] = ManifestEntry(stat.st_size, stat.st_mtime_ns, stat.st_ino, crc32, sha256)
+
+        removed = len(set(self._entries) - set(entries))
+        self._entries = entries
+
+        logger.debug("Manifest of %s refreshed, %s of %s files hashed, %s removed", self._version_path.name,
+                     len(stale), len(entries), removed)
+        return len(stale) + removed
+
+    def _refresh_directory(self, relative_path: Path, entries: Dict[str, ManifestEntry],
+                           stale: List[Tuple[str, os.stat_result]]) -> None:
+        path = self._version_path.joinpath(relative_path)
+
+        for file in get_filenames(path):
+            file_path = relative_path.joinpath(file).as_posix()
+            stat = path.joinpath(file).stat()
+            entry = self._entries.get(file_path)
+
+            if entry is None or not entry.matches(stat):
+                stale.append((file_path, stat))
+            else:
+                entries[file_path] = entry
+
+        for directory in get_subdirectory_names(path):
+            self._refresh_directory(relative_path.joinpath(directory), entries, stale)
+
+    def save(self, manifest_path: Path) -> None:
+        manifest_path.parent.mkdir(parents=True, exist_ok=True)
+
+        # write to a temporary file first, so a concurrent reader never sees a half written manifest
+        temp_path = manifest_path.with_name(manifest_path.name + '.tmp')
+        with temp_path.open('w+') as file:
+            json.dump({path: entry.to_dict() for path, entry in self._entries.items()}, file)
+        os.replace(str(temp_path), str(manifest_path))
+
+    @staticmethod
+    def load(version_path: Path, manifest_path: Path) -> 'VersionManifest':
+        """
+        Loads a manifest from disk, a missing or broken manifest results in an empty one
+        """
+        if not manifest_path.exists():
+            return VersionManifest(version_path)
+
+        try:
+            with manifest_path.open('r') as file:
+                data = json.load(file)
+
+            return VersionManifest(version_path,
+                                   {path: ManifestEntry.load_dict(entry) for path, entry in data.items()})
+        except (ValueError, KeyError):
+            logger.warning("Manifest %s is invalid and will be rebuilt", str(manifest_path))
+            return VersionManifest(version_path)
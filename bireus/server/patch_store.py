@@ -0,0 +1,164 @@
+# coding=utf-8
+"""
+Patches of the web server in lazy mode: the version graph advertises all patches, but a patch is only generated
+when a client requests it first. The generated patches are kept up to a size limit.
+"""
+import asyncio
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from typing import Dict, List, Optional, Set, Tuple
+
+from bireus.server.repository import ServerRepository, UnknownPatchError
+from bireus.shared import *
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_STORE_SIZE = 10 * 1024 * 1024 * 1024  # 10 GiB
+DEFAULT_HOT_THRESHOLD = 10  # requests of patches from a version, from then on its new patches are generated eagerly
+
+
+class PatchStore(object):
+    """
+    Generates the patches of several repositories on demand and keeps them in their __patches__ folders.
+    Concurrent requests for the same patch wait for a single generation, a generation waits for a running update
+    of its repository. Requests refresh the mtime of a patch, eviction removes the least recently requested patches
+    first once the store exceeds max_size.
+    """
+
+    def __init__(self, repositories: List[ServerRepository], max_size: int = DEFAULT_STORE_SIZE,
+                 hot_threshold: Optional[int] = DEFAULT_HOT_THRESHOLD, concurrency: int = 1, jobs: int = 1):
+        """
+        :param max_size: size of all patches in bytes
+        :param hot_threshold: number of requests after which the patches from a version are generated eagerly,
+                              None to generate all patches on demand
+        :param concurrency: number of patches generated at the same time
+        :param jobs: number of threads per patch
+        """
+        self.repositories = repositories
+        self.max_size = max_size
+        self.hot_threshold = hot_threshold
+        self.jobs = jobs
+
+        self._executor = ThreadPoolExecutor(max_workers=concurrency)
+        self._pending = dict()  # type: Dict[Path, asyncio.Future]
+        self._requests = dict()  # type: Dict[Tuple[str, str, str], int]  # (repository, from, to) -> requests
+
+        # statistics
+        self.hits = 0
+        self.misses = 0  # patches that were generated on demand
+        self.coalesced = 0  # requests that waited for the generation of another request
+        self.evicted = 0
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=False)
+
+    async def get(self, repository: ServerRepository, version_from: str, version_to: str) -> Path:
+        """
+        :return: path of the patch, it is generated if necessary
+        :raises UnknownPatchError: the version graph has no such patch
+        """
+        if not repository.version_graph.has_edge(version_from, version_to):
+            raise UnknownPatchError(repository.name, version_from, version_to)
+
+        key = (repository.name, version_from, version_to)
+        self._requests[key] = self._requests.get(key, 0) + 1
+        path = repository.patch_path(version_from, version_to)
+
+        pending = self._pending.get(path)
+        if pending is not None:
+            self.coalesced += 1
+            # a client that disconnects must not cancel the generation for the others
+            return await asyncio.shield(pending)
+
+        try:
+            os.utime(str(path))
+            self.hits += 1
+            return path
+        except FileNotFoundError:
+            pass
+
+        self.misses += 1
+        loop = asyncio.get_event_loop()
+        generation = loop.run_in_executor(self._executor, repository.generate_patch, version_from, version_to,
+                                          self.jobs)
+        self._pending[path] = generation
+        generation.add_done_callback(lambda future: self._pending.pop(path, None))
+
+        await asyncio.shield(generation)
+        await loop.run_in_executor(self._executor, self.evict, {path} | set(self._pending))
+        return path
+
+    def hot_versions(self, repository: ServerRepository) -> Set[str]:
+        """
+        :return: the versions of the repository whose patches were requested at least hot_threshold times
+        """
+        if self.hot_threshold is None:
+            return set()
+
+        requests = dict()  # type: Dict[str, int]
+        for (name, version_from, version_to), count in self._requests.items():
+            if name == repository.name:
+                requests[version_from] = requests.get(version_from, 0) + count
+
+        return {version for version, count in requests.items() if count >= self.hot_threshold}
+
+    def evict(self, keep: Set[Path] = frozenset()) -> int:
+        """
+        Removes the least recently requested patches until the store fits into max_size.
+        The patches of repositories that are updated right now count, but stay.
+        :param keep: patches that must not be removed
+        :return: number of removed patches
+        """
+        entries = []  # type: List[Tuple[float, int, Path]]
+        total_size = 0
+        locked = [repository for repository in self.repositories if repository.lock.acquire(blocking=False)]
+
+        try:
+            for repository in self.repositories:
+                for patch_path in repository.absolute_path.joinpath('__patches__').glob('*.tar.xz'):
+                    try:
+                        stat = patch_path.stat()
+                    except FileNotFoundError:
+                        continue
+                    total_size += stat.st_size
+                    if patch_path not in keep and repository in locked:
+                        entries.append((stat.st_mtime, stat.st_size, patch_path))
+
+            entries.sort()
+            removed = 0
+
+            while total_size > self.max_size and removed < len(entries):
+                mtime, size, patch_path = entries[removed]
+                try:
+                    patch_path.unlink()
+                except FileNotFoundError:
+                    pass
+                total_size -= size
+                removed += 1
+        finally:
+            for repository in locked:
+                repository.lock.release()
+
+        if removed > 0:
+            logger.info("Evicted %s patches from the patch store", removed)
+            self.evicted += removed
+
+        return removed
+
+    def metrics(self) -> str:
+        """
+        Renders the statistics in the Prometheus text format
+        """
+        lines = [
+            '# HELP bireus_patch_requests_total Requested patches by outcome',
+            '# TYPE bireus_patch_requests_total counter',
+            'bireus_patch_requests_total{outcome="hit"} %s' % self.hits,
+            'bireus_patch_requests_total{outcome="generated"} %s' % self.misses,
+            'bireus_patch_requests_total{outcome="coalesced"} %s' % self.coalesced,
+            '# HELP bireus_patches_evicted_total Patches removed from the patch store',
+            '# TYPE bireus_patches_evicted_total counter',
+            'bireus_patches_evicted_total %s' % self.evicted
+        ]
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,112 @@
+# coding=utf-8
+"""
+Progress of a running repository update, written by the update (from several threads) and read by the web server.
+Progress is not tracked by default: the NO_PROGRESS instance ignores everything.
+"""
+import logging
+import threading
+
+from typing import Any, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class UpdateProgress(object):
+    enabled = True
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.phase = None  # type: Optional[str]  # latest_archive, manifest, patching, done
+        self.pairs_total = 0
+        self.pairs_done = 0
+        self.current_pair = None  # type: Optional[Tuple[str, str]]
+        self.work_total = 0  # work items (deltas, checksums) of the current pair
+        self.work_done = 0
+        self.bytes_written = 0  # size of the finished patches
+        self._archive_bytes = 0  # size of the patch being written
+
+    def set_phase(self, phase: str) -> None:
+        self.phase = phase
+
+    def add_pairs(self, count: int) -> None:
+        with self._lock:
+            self.pairs_total += count
+
+    def start_pair(self, base: str, target: str) -> None:
+        with self._lock:
+            self.current_pair = (base, target)
+            self.work_total = 0
+            self.work_done = 0
+            self._archive_bytes = 0
+
+    def add_work(self, count: int) -> None:
+        with self._lock:
+            self.work_total += count
+
+    def complete_work(self) -> None:
+        with self._lock:
+            self.work_done += 1
+
+    def archive_written(self, size: int) -> None:
+        """
+        :param size: bytes of the current patch written so far
+        """
+        self._archive_bytes = size
+
+    def finish_pair(self, size: Optional[int] = None) -> None:
+        """
+        :param size: size of the patch, defaults to the bytes reported by archive_written
+        """
+        with self._lock:
+            self.pairs_done += 1
+            self.bytes_written += size if size is not None else self._archive_bytes
+            self._archive_bytes = 0
+            self.current_pair = None
+
+    @property
+    def percent(self) -> float:
+        """
+        :return: share of the work of the current pair that is done
+        """
+        return 100.0 * self.work_done / self.work_total if self.work_total > 0 else 0.0
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'phase': self.phase,
+                'pairs_total': self.pairs_total,
+                'pairs_done': self.pairs_done,
+                'current_pair': list(self.current_pair) if self.current_pair is not None else None,
+                'work_total': self.work_total,
+                'work_done': self.work_done,
+                'percent': round(self.percent, 1),
+                'bytes_written': self.bytes_written + self._archive_bytes
+            }
+
+
+class _NoProgress(UpdateProgress):
+    enabled = False
+
+    def set_phase(self, phase: str) -> None:
+        pass
+
+    def add_pairs(self, count: int) -> None:
+        pass
+
+    def start_pair(self, base: str, target: str) -> None:
+        pass
+
+    def add_work(self, count: int) -> None:
+        pass
+
+    def complete_work(self) -> None:
+        pass
+
+    def archive_written(self, size: int) -> None:
+        pass
+
+    def finish_pair(self, size: Optional[int] = None) -> None:
+        pass
+
+
+NO_PROGRESS = _NoProgress()
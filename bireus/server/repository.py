@@ -1,23 +1,73 @@
 # coding=utf-8
 import json
 import logging
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
 
 import networkx
+from typing import AbstractSet, Any, Dict, Iterator, List, Optional, Tuple
+
 from bireus.server import get_subdirectory_names, patching_strategies
-from bireus.server.patch_strategy import AbstractStrategy
+from bireus.server.patch_strategy import is_set
 
-from bireus.server.compare_tasks.base import CompareTask
+from bireus.server.checkout_log import CheckoutLog
+from bireus.server.compare_tasks.base import BSDIFF_MEMORY_FACTOR, DEFAULT_BLOCKDIFF_THRESHOLD, CompareTask
+from bireus.server.compression import CompressionSettings, write_archive
+from bireus.server.delta_cache import DEFAULT_CACHE_SIZE, DeltaCache, get_cache_path
+from bireus.server.manifest import VersionManifest, get_manifest_path
 from bireus.shared import *
+from bireus.server.progress import NO_PROGRESS
+from bireus.shared.instrumentation import DISABLED, Instrumentation
 from bireus.shared.repository import BaseRepository
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_SHORTCUT_BUDGET = 1024 * 1024 * 1024  # 1 GiB of shortcut patches per repository
+DEFAULT_SHORTCUT_CHECKOUTS = 10  # checkouts of a version pair before it gets a shortcut
+
+
+class UnknownPatchError(Exception):
+    def __init__(self, name: str, version_from: str, version_to: str):
+        super().__init__("Repository %s has no patch %s -> %s" % (name, version_from, version_to))
+
+
+def _generate_patch(absolute_path: Path, name: str, protocol: int, version_from: str, version_to: str,
+                    instrumented: bool = False,
+                    memory_budget: Optional[int] = None) -> Tuple[int, int, int, int, Optional[Dict[str, Any]]]:
+    """
+    Generates a single patch, module level so it can be sent to a worker process
+    :param instrumented: collect the timers and counters of the patch
+    :param memory_budget: share of the diff memory budget of the repository for this process
+    :return: hits and misses of the delta cache, checked deltas, deltas replaced by the full file
+             and the instrumentation of the patch (if instrumented)
+    """
+    logger.info('Generating patch for %s -> %s', version_from, version_to)
+    compare_task = CompareTask.get_factory(protocol)(absolute_path, name, version_from, version_to)
+    if instrumented:
+        compare_task.instrumentation = Instrumentation('%s_to_%s' % (version_from, version_to))
+    if memory_budget is not None:
+        compare_task.memory_budget = memory_budget
+    compare_task.generate_diff()
+    return compare_task.delta_cache.hits, compare_task.delta_cache.misses, compare_task.deltas_checked, \
+        compare_task.delta_fallbacks, compare_task.instrumentation.to_dict(None) if instrumented else None
+
 
 class ServerRepository(BaseRepository):
     def __init__(self, absolute_path: Path):
         super().__init__(absolute_path)
 
         self._compare_task_factory = CompareTask.get_factory(self.protocol)
+        self.delta_cache_hits = 0
+        self.delta_cache_misses = 0
+        self.deltas_checked = 0
+        self.delta_fallbacks = 0  # deltas that were larger than allowed, the full file was shipped instead
+        self.instrumentation = DISABLED  # type: Instrumentation  # replace it to collect timers and counters
+        self.progress = NO_PROGRESS  # replace it to follow a running update
+        self.checkout_log = CheckoutLog(self.checkout_log_path)
+        # serializes the updates and the patches generated on demand, they share the patches and the delta cache
+        self.lock = threading.Lock()
 
     @property
     def info_path(self) -> Path:
@@ -27,67 +77,348 @@ class ServerRepository(BaseRepository):
     def version_graph_path(self) -> Path:
         return self._absolute_path.joinpath('versions.gml')
 
-    def update(self) -> None:
-        if not self.info_path.exists():
-            logger.error("Repository %s is missing info.json - skipping repo", self.name)
-            return
+    @property
+    def latest_fingerprint_path(self) -> Path:
+        """
+        Content fingerprint of the version latest.tar.xz was built from
+        """
+        return self._absolute_path.joinpath('__manifests__', 'latest.fingerprint')
+
+    @property
+    def checkout_log_path(self) -> Path:
+        return self._absolute_path.joinpath('checkouts.json')
+
+    @property
+    def shortcut_budget(self) -> int:
+        """
+        Size of all shortcut patches in bytes
+        """
+        return self._metadata.get('shortcut_budget', DEFAULT_SHORTCUT_BUDGET)
+
+    @property
+    def delta_cache_size(self) -> int:
+        return self._metadata.get('delta_cache_size', DEFAULT_CACHE_SIZE)
+
+    @property
+    def compression_settings(self) -> CompressionSettings:
+        return CompressionSettings.from_settings(self._metadata)
+
+    def new_versions(self) -> List[str]:
+        """
+        :return: the version directories that were not patched yet
+        """
+        return sorted(version for version in get_subdirectory_names(self._absolute_path)
+                      if not self.has_version(version))
+
+    def estimate_work(self) -> int:
+        """
+        Rough estimate of the work of the next update: number of new versions times their size in bytes
+        """
+        new_versions = self.new_versions()
+        return len(new_versions) * sum(size for version in new_versions for size in self._file_sizes(version))
+
+    def estimate_memory(self, jobs: int = 1) -> int:
+        """
+        Rough estimate of the peak memory of the next update in bytes, bsdiff needs a multiple of the file size.
+        A diff memory budget caps it, larger diffs fall back to blockdiff.
+        """
+        threshold = self._metadata.get('blockdiff_threshold', DEFAULT_BLOCKDIFF_THRESHOLD)
+        largest = max((size for version in self.new_versions() for size in self._file_sizes(version)
+                       if size <= threshold), default=0)
+        estimate = BSDIFF_MEMORY_FACTOR * largest * jobs
+
+        memory_budget = self._metadata.get('diff_memory_budget')
+        if memory_budget is not None:
+            return min(estimate, memory_budget)
+        return estimate
+
+    def _file_sizes(self, version: str) -> Iterator[int]:
+        for dirpath, dirnames, filenames in os.walk(str(self._absolute_path.joinpath(version))):
+            for filename in filenames:
+                yield os.path.getsize(os.path.join(dirpath, filename))
+
+    def update(self, jobs: int = 1, lazy: bool = False, hot_versions: AbstractSet[str] = frozenset()) -> None:
+        """
+        Checks for new versions and generates the required patches
+        :param jobs: number of patches that are generated in parallel
+        :param lazy: only add the patches to the version graph, they are generated on demand (see generate_patch)
+        :param hot_versions: in lazy mode the patches from these versions are generated anyway
+        """
+        with self.lock:
+            if not self.info_path.exists():
+                logger.error("Repository %s is missing info.json - skipping repo", self.name)
+                return
+
+            logger.info('Updating repository %s', self.name)
+            start = time.perf_counter()
+
+            version_list = get_subdirectory_names(self._absolute_path)
+
+            version_list.sort()
+            logger.info('%s is the latest version', version_list[-1])
+            self.progress.set_phase('latest_archive')
+            with self.instrumentation.timer('latest_archive'):
+                self.update_latest_archive(version_list[-1])
+
+            if any(not self.has_version(version_dir) for version_dir in version_list):
+                self.progress.set_phase('manifest')
+                with self.instrumentation.timer('manifest'):
+                    self.refresh_manifests(version_list)
+
+            logger.debug('begin patching')
+            self.progress.set_phase('patching')
 
-        logger.info('Updating repository %s', self.name)
+            # check for new versions
+            for version_dir in version_list:
+                if not self.has_version(version_dir):
+                    logger.info("new version: %s", version_dir)
+                    self.add_version(version_dir, jobs, lazy, hot_versions)
+                    logger.debug('append %s to known versions', version_dir)
+                    self._metadata['latest_version'] = version_dir
+                    self._save_info_json()
+                    networkx.write_gml(self.version_graph, str(self.version_graph_path))
 
-        version_list = get_subdirectory_names(self._absolute_path)
+            logger.info('delta cache of %s: %s hits, %s misses', self.name, self.delta_cache_hits,
+                        self.delta_cache_misses)
+            logger.info('delta size guard of %s: %s of %s deltas replaced by the full file', self.name,
+                        self.delta_fallbacks, self.deltas_checked)
 
-        version_list.sort()
-        logger.info('%s is the latest version', version_list[-1])
+            self.progress.set_phase('done')
+            self.instrumentation.duration += time.perf_counter() - start
+            if self.instrumentation.enabled:
+                logger.info('Instrumentation of %s', self.instrumentation.summary())
+
+    def patch_path(self, version_from: str, version_to: str) -> Path:
+        return self._absolute_path.joinpath('__patches__', '%s_to_%s.tar.xz' % (version_from, version_to))
+
+    def update_latest_archive(self, latest_version: str) -> bool:
+        """
+        Rebuilds latest.tar.xz, but only if the latest version or its content changed since the last build
+        :return: True if the archive was rebuilt
+        """
+        manifest_path = get_manifest_path(self._absolute_path, latest_version)
+        manifest = VersionManifest.load(self._absolute_path.joinpath(latest_version), manifest_path)
+        if manifest.refresh() > 0 or not manifest_path.exists():
+            manifest.save(manifest_path)
+
+        fingerprint = '%s %s' % (latest_version, manifest.fingerprint())
+        fingerprint_path = self.latest_fingerprint_path
+        archive_path = self._absolute_path.joinpath('latest.tar.xz')
+
+        if archive_path.exists() and fingerprint_path.exists() and fingerprint_path.read_text() == fingerprint:
+            logger.info('latest.tar.xz is up to date')
+            return False
+
+        # the archive is written to a temporary file and renamed, clients never see a half written archive
         logger.info('generate latest.tar.xz')
-        make_archive(self._absolute_path.joinpath('latest'), 'xztar',
-                     self._absolute_path.joinpath(version_list[-1]))
-
-        logger.debug('begin patching')
-
-        # check for new versions
-        for version_dir in version_list:
-            if not self.has_version(version_dir):
-                logger.info("new version: %s", version_dir)
-                self.add_version(version_dir)
-                logger.debug('append %s to known versions', version_dir)
-                self._metadata['latest_version'] = version_dir
-                self._save_info_json()
-                networkx.write_gml(self.version_graph, str(self.version_graph_path))
-
-    def add_version(self, new_version: str) -> None:
+        write_archive(archive_path, self._absolute_path.joinpath(latest_version), self.compression_settings)
+        fingerprint_path.write_text(fingerprint)
+        return True
+
+    def add_version(self, new_version: str, jobs: int = 1, lazy: bool = False,
+                    hot_versions: AbstractSet[str] = frozenset()) -> None:
         logger.debug("existing versions: %s", list(self.version_graph))
 
         logger.info("patching strategy: %s", self.strategy)
 
-        strategy = patching_strategies[self.strategy]  # type: AbstractStrategy
-        patch_paths = strategy.add_version(self.version_graph, self.latest_version, new_version)
+        strategy = patching_strategies[self.strategy]
+        # the strategies only know their own patches, shortcuts would count as neighbours of a version
+        shortcuts = [(version_from, version_to, dict(self.version_graph.edges[version_from, version_to]))
+                     for version_from, version_to in self.shortcuts()]
+        # the web server reads the version graph meanwhile, it must never see one without the shortcuts
+        version_graph = self.version_graph.copy()
+        version_graph.remove_edges_from(shortcuts)
+        patch_paths = strategy.add_version(version_graph, self.latest_version, new_version)
+        version_graph.add_edges_from(shortcuts)
+        self.version_graph = version_graph
         logger.info("%s versions were selected for patching" % len(patch_paths))
         logger.debug(patch_paths)
 
-        for patch in patch_paths:
-            version_from = patch[0]
-            version_to = patch[1]
-            logger.info('Generating patch for %s -> %s', version_from, version_to)
-            self._compare_task_factory(self._absolute_path, self.name, version_from, version_to).generate_diff()
+        if lazy:
+            # the version graph advertises all patches, but most of them are never downloaded
+            deferred = len(patch_paths)
+            patch_paths = [(version_from, version_to) for version_from, version_to in patch_paths
+                           if version_from in hot_versions]
+            logger.info("%s patches are generated on demand", deferred - len(patch_paths))
+        self.progress.add_pairs(len(patch_paths))
+
+        # create it upfront, otherwise parallel tasks race for it
+        self._absolute_path.joinpath('__patches__').mkdir(exist_ok=True)
+
+        if jobs > 1 and len(patch_paths) > 1:
+            logger.info("Generating patches with %s processes", jobs)
+            # the processes can't share their admission, each gets an equal share of the budget
+            memory_budget = self._metadata.get('diff_memory_budget')
+            process_budget = memory_budget // jobs if memory_budget is not None else None
+
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                futures = [executor.submit(_generate_patch, self._absolute_path, self.name, self.protocol,
+                                           version_from, version_to, self.instrumentation.enabled, process_budget)
+                           for version_from, version_to in patch_paths]
+
+                for future, (version_from, version_to) in zip(futures, patch_paths):
+                    # the worker processes report no progress of their own, only the finished patches count
+                    self.progress.start_pair(version_from, version_to)
+                    # re-raises exceptions of the worker
+                    hits, misses, checked, fallbacks, instrumentation = future.result()
+                    self.progress.finish_pair(self._record_patch_size(version_from, version_to))
+                    self.delta_cache_hits += hits
+                    self.delta_cache_misses += misses
+                    self.deltas_checked += checked
+                    self.delta_fallbacks += fallbacks
+                    if instrumentation is not None:
+                        self.instrumentation.merge(Instrumentation.load_dict(instrumentation))
+        else:
+            for version_from, version_to in patch_paths:
+                logger.info('Generating patch for %s -> %s', version_from, version_to)
+                # a single patch at a time, so the compare task may use the threads on file level
+                compare_task = self._compare_task_factory(self._absolute_path, self.name, version_from, version_to,
+                                                          jobs=jobs)
+                if self.instrumentation.enabled:
+                    compare_task.instrumentation = Instrumentation('%s_to_%s' % (version_from, version_to))
+                compare_task.progress = self.progress
+                self.progress.start_pair(version_from, version_to)
+                compare_task.generate_diff()
+                self.progress.finish_pair(self._record_patch_size(version_from, version_to))
+                self.instrumentation.merge(compare_task.instrumentation)
+                self.delta_cache_hits += compare_task.delta_cache.hits
+                self.delta_cache_misses += compare_task.delta_cache.misses
+                self.deltas_checked += compare_task.deltas_checked
+                self.delta_fallbacks += compare_task.delta_fallbacks
+
+        DeltaCache(get_cache_path(self._absolute_path)).evict(self.delta_cache_size)
+
+    def _record_patch_size(self, version_from: str, version_to: str) -> int:
+        """
+        Stores the size of a generated patch on its edge, clients weigh their patch paths by it
+        :return: size of the patch in bytes
+        """
+        size = self.patch_path(version_from, version_to).stat().st_size
+        self.version_graph.edges[version_from, version_to]['size'] = size
+        return size
+
+    def generate_patch(self, version_from: str, version_to: str, jobs: int = 1) -> Path:
+        """
+        Generates a single patch of the version graph, i.e. one that was deferred by a lazy update.
+        It waits for a running update of the repository.
+        :return: path of the patch
+        """
+        with self.lock:
+            if not self.version_graph.has_edge(version_from, version_to):
+                raise UnknownPatchError(self.name, version_from, version_to)
+
+            patch_path = self.patch_path(version_from, version_to)
+            if patch_path.exists():
+                # the update generated it meanwhile
+                return patch_path
+
+            logger.info('Generating patch for %s -> %s on demand', version_from, version_to)
+            self._absolute_path.joinpath('__patches__').mkdir(exist_ok=True)
+            self._compare_task_factory(self._absolute_path, self.name, version_from, version_to,
+                                       jobs=jobs).generate_diff()
+            self._record_patch_size(version_from, version_to)
+            networkx.write_gml(self.version_graph, str(self.version_graph_path))
+            return patch_path
+
+    def shortcuts(self) -> List[Tuple[str, str]]:
+        """
+        :return: the patches that were added for frequent checkouts, on top of those of the patching strategy
+        """
+        return [(version_from, version_to) for version_from, version_to, data in self.version_graph.edges(data=True)
+                if is_set(data, 'shortcut')]
+
+    def update_shortcuts(self, min_checkouts: int = DEFAULT_SHORTCUT_CHECKOUTS, jobs: int = 1) -> List[Tuple[str, str]]:
+        """
+        Adds direct patches for the most frequent checkouts over several patches and removes the shortcuts that
+        are not among them anymore. Checkouts rank by their count times the patches they save, the shortcuts are
+        taken in this order as long as their patches fit into the shortcut budget.
+        :param min_checkouts: checkouts of a version pair before it is considered
+        :param jobs: number of threads per patch
+        :return: the shortcuts of the version graph
+        """
+        with self.lock:
+            existing = set(self.shortcuts())
+            strategy_graph = self.version_graph.copy()
+            strategy_graph.remove_edges_from(existing)
+
+            candidates = []  # type: List[Tuple[int, str, str]]
+            for (version_from, version_to), count in self.checkout_log.counts().items():
+                if count < min_checkouts or version_from == version_to or not self.has_version(version_from) \
+                        or not self.has_version(version_to):
+                    continue
+                try:
+                    hops = networkx.shortest_path_length(strategy_graph, version_from, version_to)
+                except networkx.NetworkXNoPath:
+                    continue
+                if hops > 1:
+                    candidates.append((count * (hops - 1), version_from, version_to))
+            candidates.sort(key=lambda candidate: candidate[0], reverse=True)
+
+            self._absolute_path.joinpath('__patches__').mkdir(exist_ok=True)
+            selected = []  # type: List[Tuple[str, str]]
+            used = 0
+
+            for saved, version_from, version_to in candidates:
+                patch_path = self.patch_path(version_from, version_to)
+                if not patch_path.exists():
+                    logger.info('Generating shortcut patch for %s -> %s', version_from, version_to)
+                    self._compare_task_factory(self._absolute_path, self.name, version_from, version_to,
+                                               jobs=jobs).generate_diff()
+
+                size = patch_path.stat().st_size
+                if used + size > self.shortcut_budget:
+                    logger.info('Shortcut %s -> %s exceeds the shortcut budget', version_from, version_to)
+                    patch_path.unlink()
+                    continue
+
+                used += size
+                selected.append((version_from, version_to))
+
+            for version_from, version_to in existing - set(selected):
+                logger.info('Removing shortcut %s -> %s', version_from, version_to)
+                self.version_graph.remove_edge(version_from, version_to)
+                if self.patch_path(version_from, version_to).exists():
+                    self.patch_path(version_from, version_to).unlink()
+
+            self.version_graph.add_edges_from(selected, shortcut='yes')
+            for version_from, version_to in selected:
+                self._record_patch_size(version_from, version_to)
+            networkx.write_gml(self.version_graph, str(self.version_graph_path))
+            logger.info('%s has %s shortcuts using %s bytes', self.name, len(selected), used)
+            return selected
+
+    def refresh_manifests(self, versions: List[str]) -> None:
+        """
+        Updates the content manifests of the given versions, only modified files are hashed
+        """
+        for version in versions:
+            manifest_path = get_manifest_path(self._absolute_path, version)
+            manifest = VersionManifest.load(self._absolute_path.joinpath(version), manifest_path)
+            if manifest.refresh() > 0 or not manifest_path.exists():
+                manifest.save(manifest_path)
 
     def cleanup(self) -> None:
         logger.debug('Cleanup %s', self.name)
         remove_folder(self._absolute_path.joinpath("__patches__"))
 
     def _save_info_json(self):
-        info_json = {
+        info_json = dict(self._metadata)  # keep the optional settings
+        info_json.update({
             "name": self.name,
             "first_version": self.first_version,
             "latest_version": self.latest_version,
             "strategy": self.strategy,
-            "protocol": 1
-        }
+            "protocol": self.protocol
+        })
 
         with self.info_path.open("w+") as file:
             json.dump(info_json, file)
 
     @classmethod
-    def create(cls, path: Path, name: str, first_version: str, strategy: str) -> 'ServerRepository':
+    def create(cls, path: Path, name: str, first_version: str, strategy: str,
+               protocol: int = 1) -> 'ServerRepository':
+        CompareTask.get_factory(protocol)  # fail early on unsupported protocol versions
+
         version_path = path.joinpath(first_version)
         version_path.mkdir(parents=True)
 
@@ -100,7 +431,7 @@ class ServerRepository(BaseRepository):
                 "first_version": first_version,
                 "latest_version": first_version,
                 "strategy": strategy,
-                "protocol": 1
+                "protocol": protocol
             }
 
             json.dump(info_json, file)
@@ -1,10 +1,12 @@
 # coding=utf-8
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
 from bireus.server import get_subdirectory_names
-from typing import List
+from typing import List, Optional
 
 from bireus.server.repository import ServerRepository
+from bireus.server.update_scheduler import UpdateResult, UpdateScheduler
 from bireus.shared import *
 
 logger = logging.getLogger(__name__)
@@ -28,29 +30,47 @@ class RepositoryManager(object):
     def full_cleanup(self) -> None:
         logger.info('full_cleanup started for %s', str(self.path))
 
-        for repo in self.repositories:
-            repo.cleanup()
+        # the repositories share nothing, so remove their patches at once
+        with ThreadPoolExecutor(max_workers=max(1, len(self.repositories))) as executor:
+            for future in [executor.submit(repo.cleanup) for repo in self.repositories]:
+                future.result()
 
         logger.info('full_cleanup finished')
 
-    def full_update(self) -> None:
+    def full_update(self, jobs: int = 1, cpu_budget: Optional[int] = None,
+                    memory_budget: Optional[int] = None) -> List[UpdateResult]:
+        """
+        Updates all repositories concurrently, a failing repository doesn't stop the others
+        :param jobs: number of patches that are generated in parallel per repository
+        :param cpu_budget: number of cpu cores used by all repositories together, defaults to all cores
+        :param memory_budget: estimated memory in bytes used by all repositories together, unlimited by default
+        :return: the result of each repository
+        """
         logger.info('full_update started for %s', str(self.path))
 
-        for repo in self.repositories:
-            repo.update()
+        results = UpdateScheduler(jobs, cpu_budget, memory_budget).run(self.repositories)
+
+        failed = [result.name for result in results if not result.success]
+        if len(failed) > 0:
+            logger.error('full_update finished, failed repositories: %s', ', '.join(failed))
+        else:
+            logger.info('full_update finished')
 
-        logger.info('full_update finished')
+        return results
 
-    def create(self, name: str, first_version: str = "1.0.0", strategy="inst-bi") -> ServerRepository:
+    def create(self, name: str, first_version: str = "1.0.0", strategy="inst-bi",
+               protocol: int = 1) -> ServerRepository:
         """
         Creates a new repository
         :param name: name of repository
         :param first_version: name of the first version
         :param strategy: 'bi' for bidirectional patching, 'fo' for forward only patching
+        :param protocol: protocol version of the patches (2 supports the codec policy)
         :return: representation of the new repository
         """
 
         logger.info('create repository %s with version %s (strategy=%s)' % (name, first_version, strategy))
-        repository = ServerRepository.create(self.path.joinpath(name), name, first_version, strategy)
+        repository = ServerRepository.create(self.path.joinpath(name), name, first_version, strategy,
+                                             protocol)
         self.repositories.append(repository)
         return repository
@@ -0,0 +1,148 @@
+# coding=utf-8
+import logging
+import os
+import threading
+import time
+
+from typing import Any, Dict, List, Optional, Tuple
+
+from bireus.server.repository import ServerRepository
+
+logger = logging.getLogger(__name__)
+
+
+class UpdateResult(object):
+    """
+    Outcome of the update of a single repository
+    """
+
+    def __init__(self, name: str, new_versions: List[str], error: Optional[BaseException] = None,
+                 duration: float = 0.0):
+        self.name = name
+        self.new_versions = new_versions
+        self.error = error
+        self.duration = duration  # in seconds
+
+    @property
+    def success(self) -> bool:
+        return self.error is None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'name': self.name,
+            'new_versions': self.new_versions,
+            'success': self.success,
+            'error': repr(self.error) if self.error is not None else None,
+            'duration': self.duration
+        }
+
+
+class UpdateScheduler(object):
+    """
+    Updates several repositories concurrently within a global cpu and memory budget.
+    Repositories with the most estimated work are started first, smaller ones fill up the remaining budget.
+    A repository that exceeds the budget on its own is started once nothing else is running.
+    """
+
+    def __init__(self, jobs: int = 1, cpu_budget: Optional[int] = None, memory_budget: Optional[int] = None):
+        """
+        :param jobs: number of patches that are generated in parallel per repository
+        :param cpu_budget: number of cpu cores used at most, defaults to all cores
+        :param memory_budget: estimated memory (in bytes) used at most, unlimited by default
+        """
+        self.jobs = jobs
+        self.cpu_budget = cpu_budget if cpu_budget else (os.cpu_count() or 1)
+        self.memory_budget = memory_budget
+
+        self._condition = threading.Condition()
+        self._cpu_used = 0
+        self._memory_used = 0
+        self._running = 0
+
+    def run(self, repositories: List[ServerRepository]) -> List[UpdateResult]:
+        """
+        Updates the repositories, a failing repository doesn't affect the others
+        :return: the results in the order of repositories
+        """
+        work = dict()  # type: Dict[ServerRepository, int]
+        costs = dict()  # type: Dict[ServerRepository, Tuple[int, int]]
+        results = dict()  # type: Dict[ServerRepository, UpdateResult]
+        threads = []  # type: List[threading.Thread]
+
+        for repo in repositories:
+            try:
+                work[repo] = repo.estimate_work()
+                costs[repo] = (min(self.jobs, self.cpu_budget), repo.estimate_memory(self.jobs))
+            except Exception as e:
+                # i.e. an unreadable version folder, the repository would fail its update as well
+                logger.exception('Estimating the update of %s failed', repo.name)
+                results[repo] = UpdateResult(repo.name, [], e)
+
+        pending = sorted(work, key=lambda repo: work[repo], reverse=True)
+
+        while len(pending) > 0:
+            with self._condition:
+                repo = self._wait_for_budget(pending, costs)
+                pending.remove(repo)
+
+                cpu, memory = costs[repo]
+                self._cpu_used += cpu
+                self._memory_used += memory
+                self._running += 1
+
+                logger.info('Starting update of %s (estimated work %s, %s/%s cpus and %s bytes memory in use)',
+                            repo.name, work[repo], self._cpu_used, self.cpu_budget, self._memory_used)
+
+            thread = threading.Thread(target=self._update, args=(repo, costs[repo], results),
+                                      name='bireus-update-' + repo.name)
+            thread.start()
+            threads.append(thread)
+
+        for thread in threads:
+            thread.join()
+
+        return [results[repo] for repo in repositories]
+
+    def _fits(self, cost: Tuple[int, int]) -> bool:
+        if self._running == 0:
+            return True
+
+        cpu, memory = cost
+        if self._cpu_used + cpu > self.cpu_budget:
+            return False
+
+        return self.memory_budget is None or self._memory_used + memory <= self.memory_budget
+
+    def _wait_for_budget(self, pending: List[ServerRepository], costs: Dict[ServerRepository, Tuple[int, int]]) \
+            -> ServerRepository:
+        """
+        Blocks until one of the pending repositories fits into the budget, the caller holds the condition
+        :return: the first pending repository that fits
+        """
+        while True:
+            for repo in pending:
+                if self._fits(costs[repo]):
+                    return repo
+
+            self._condition.wait()
+
+    def _update(self, repo: ServerRepository, cost: Tuple[int, int],
+                results: Dict[ServerRepository, UpdateResult]) -> None:
+        new_versions = []  # type: List[str]
+        start = time.monotonic()
+
+        try:
+            new_versions = repo.new_versions()
+            repo.update(self.jobs)
+            results[repo] = UpdateResult(repo.name, new_versions, duration=time.monotonic() - start)
+            logger.info('Update of %s finished in %.1fs', repo.name, results[repo].duration)
+        except Exception as e:
+            logger.exception('Update of %s failed', repo.name)
+            results[repo] = UpdateResult(repo.name, new_versions, e, time.monotonic() - start)
+        finally:
+            cpu, memory = cost
+            with self._condition:
+                self._cpu_used -= cpu
+                self._memory_used -= memory
+                self._running -= 1
+                self._condition.notify_all()
@@ -0,0 +1,397 @@
+# coding=utf-8
+"""
+Processes the update requests of the http server (web-server.py) without blocking its event loop
+"""
+import asyncio
+import collections
+import functools
+import json
+import logging
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+from typing import Any, Dict, List, Optional
+
+from bireus.server.patch_store import PatchStore
+from bireus.server.progress import NO_PROGRESS, UpdateProgress
+from bireus.server.repository import ServerRepository
+from bireus.shared.instrumentation import DISABLED, Instrumentation, escape_label
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CALLBACK_RETRIES = 3
+DEFAULT_CALLBACK_TIMEOUT = 30  # seconds per attempt
+DEFAULT_CALLBACK_BACKOFF = 1.0  # seconds before the first retry, doubled for each further one
+DEFAULT_CALLBACK_CONNECTIONS = 10
+MAX_FINISHED_JOBS = 100  # finished jobs kept for the status api
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+
+
+class CallbackClient(object):
+    """
+    Posts the callbacks of finished updates through a single pooled session.
+    Connection errors, timeouts and server errors (5xx) are retried with an exponential backoff.
+    """
+
+    def __init__(self, retries: int = DEFAULT_CALLBACK_RETRIES, timeout: float = DEFAULT_CALLBACK_TIMEOUT,
+                 backoff: float = DEFAULT_CALLBACK_BACKOFF, connections: int = DEFAULT_CALLBACK_CONNECTIONS):
+        self.retries = retries
+        self.timeout = timeout
+        self.backoff = backoff
+        self.connections = connections
+        self._session = None  # type: aiohttp.ClientSession
+
+    async def start(self) -> None:
+        # the session binds to the running event loop, so it can't be created in __init__
+        self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.connections),
+                                              timeout=aiohttp.ClientTimeout(total=self.timeout))
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def post(self, url: str, payload: Any) -> bool:
+        """
+        :return: True if the callback was accepted
+        """
+        data = json.dumps(payload)
+
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                await asyncio.sleep(self.backoff * 2 ** (attempt - 1))
+
+            try:
+                async with self._session.post(url, data=data) as response:
+                    logger.debug("Callback `%s`: status code '%s', body:\n%s", url, response.status,
+                                 await response.text())
+                    if response.status < 500:
+                        return response.status < 400
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.warning("Callback `%s` failed (attempt %s of %s): %s", url, attempt + 1, self.retries + 1,
+                               repr(e))
+
+        logger.error("Callback `%s` failed, giving up", url)
+        return False
+
+
+class UpdateJob(object):
+    """
+    An update request and its state. Requests served by the same update share its progress.
+    """
+
+    def __init__(self, repository: ServerRepository, callback_url: Optional[str], payload: Any):
+        self.id = uuid.uuid4().hex
+        self.repository = repository
+        self.callback_url = callback_url
+        self.payload = payload  # posted to the callback url after the update
+        self.state = JOB_QUEUED
+        self.created = time.time()
+        self.started = None  # type: Optional[float]
+        self.finished = None  # type: Optional[float]
+        self.error = None  # type: Optional[BaseException]
+        self.callback_delivered = None  # type: Optional[bool]
+        self.progress = NO_PROGRESS  # type: UpdateProgress
+
+    @property
+    def done(self) -> bool:
+        return self.state in (JOB_DONE, JOB_FAILED)
+
+    @property
+    def duration(self) -> Optional[float]:
+        """
+        :return: seconds the update took (or takes so far), None if it didn't start yet
+        """
+        if self.started is None:
+            return None
+        return (self.finished if self.finished is not None else time.time()) - self.started
+
+    def start(self, progress: UpdateProgress) -> None:
+        self.state = JOB_RUNNING
+        self.started = time.time()
+        self.progress = progress
+
+    def finish(self, error: Optional[BaseException] = None) -> None:
+        self.state = JOB_FAILED if error is not None else JOB_DONE
+        self.finished = time.time()
+        self.error = error
+
+    def to_dict(self, queue_position: Optional[int] = None) -> Dict[str, Any]:
+        """
+        :param queue_position: number of queued jobs before this one (1 is next), only for queued jobs
+        """
+        return {
+            'id': self.id,
+            'repository': self.repository.name,
+            'state': self.state,
+            'queue_position': queue_position,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+            'duration': self.duration,
+            'error': repr(self.error) if self.error is not None else None,
+            'callback_delivered': self.callback_delivered,
+            'progress': self.progress.to_dict() if self.progress.enabled else None
+        }
+
+
+class UpdateService(object):
+    """
+    Runs the requested updates on a thread pool, so the event loop keeps serving http requests.
+    Each repository has a worker that processes its requests in order, up to `concurrency`
+    repositories are updated at the same time.
+    Pending requests of a repository are coalesced into a single update that delivers all of their callbacks,
+    requests that arrive during an update are served by at most one follow-up update.
+    With a patch store the updates are lazy, only the patches from hot versions are generated right away.
+    With shortcuts each update also refreshes the shortcut patches of the repository (see report_checkout).
+    """
+
+    def __init__(self, concurrency: int = 1, jobs: int = 1, callback_client: CallbackClient = None,
+                 patch_store: PatchStore = None, shortcut_checkouts: Optional[int] = None):
+        """
+        :param concurrency: number of repositories updated at the same time
+        :param jobs: number of patches that are generated in parallel per repository
+        :param patch_store: generates the patches on demand
+        :param shortcut_checkouts: reported checkouts of a version pair before it gets a shortcut patch,
+                                   None to disable shortcuts
+        """
+        self.concurrency = concurrency
+        self.jobs = jobs
+        self.callback_client = callback_client if callback_client is not None else CallbackClient()
+        self.patch_store = patch_store
+        self.shortcut_checkouts = shortcut_checkouts
+
+        self._executor = ThreadPoolExecutor(max_workers=concurrency)
+        self._queues = dict()  # type: Dict[str, asyncio.Queue]
+        self._workers = dict()  # type: Dict[str, asyncio.Task]
+        self._update_jobs = collections.OrderedDict()  # type: Dict[str, UpdateJob]  # in order of submission
+
+        # statistics
+        self.updates = 0
+        self.coalesced = 0  # requests served by the update of another request
+        self.finished_jobs = {JOB_DONE: 0, JOB_FAILED: 0}
+        self.update_seconds = 0.0  # sum of the durations of all updates
+        self.diff_bytes = dict()  # type: Dict[str, int]  # codec -> size of the diffed target files
+        self.diff_seconds = dict()  # type: Dict[str, float]  # codec -> time spent diffing
+
+    async def start(self) -> None:
+        await self.callback_client.start()
+
+    async def close(self) -> None:
+        """
+        Stops the workers, running updates are finished in the background
+        """
+        for worker in self._workers.values():
+            worker.cancel()
+        await asyncio.gather(*self._workers.values(), return_exceptions=True)
+        self._workers.clear()
+        self._queues.clear()
+
+        await self.callback_client.close()
+        self._executor.shutdown(wait=False)
+        if self.patch_store is not None:
+            self.patch_store.close()
+
+    def submit(self, repository: ServerRepository, callback_url: Optional[str], payload: Any) -> UpdateJob:
+        """
+        Queues an update of the repository, returns immediately
+        :param callback_url: None for updates nobody waits for
+        """
+        queue = self._queues.get(repository.name)
+        if queue is None:
+            queue = self._queues[repository.name] = asyncio.Queue()
+            self._workers[repository.name] = asyncio.ensure_future(self._work(queue))
+
+        job = UpdateJob(repository, callback_url, payload)
+        self._update_jobs[job.id] = job
+        self._forget_finished_jobs()
+
+        queue.put_nowait(job)
+        return job
+
+    async def report_checkout(self, repository: ServerRepository, version_from: str,
+                              version_to: str) -> Optional[UpdateJob]:
+        """
+        Records a checkout of a client. Once a pair without a direct patch reaches shortcut_checkouts,
+        an update is queued that adds the shortcut.
+        :return: the queued update, if any
+        """
+        count = repository.checkout_log.record(version_from, version_to)
+        # not on the update threads, a long update would hold back the response
+        await asyncio.get_event_loop().run_in_executor(None, repository.checkout_log.save)
+
+        if self.shortcut_checkouts is None or count != self.shortcut_checkouts \
+                or repository.version_graph.has_edge(version_from, version_to):
+            return None
+
+        logger.info("Checkout %s -> %s of %s is frequent, queueing a shortcut", version_from, version_to,
+                    repository.name)
+        return self.submit(repository, None, None)
+
+    def get_job(self, job_id: str) -> Optional[UpdateJob]:
+        return self._update_jobs.get(job_id)
+
+    def list_jobs(self) -> List[UpdateJob]:
+        """
+        :return: queued, running and recently finished jobs in order of submission
+        """
+        return list(self._update_jobs.values())
+
+    def queue_position(self, job: UpdateJob) -> Optional[int]:
+        """
+        :return: 1 + the number of queued jobs submitted before job, None if it isn't queued anymore
+        """
+        if job.state != JOB_QUEUED:
+            return None
+
+        position = 1
+        for other in self._update_jobs.values():
+            if other is job:
+                return position
+            if other.state == JOB_QUEUED:
+                position += 1
+        return None
+
+    def status(self, job: UpdateJob) -> Dict[str, Any]:
+        return job.to_dict(self.queue_position(job))
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(1 for job in self._update_jobs.values() if job.state == JOB_QUEUED)
+
+    def metrics(self) -> str:
+        """
+        Renders the queue, the jobs and the diff throughput in the Prometheus text format
+        """
+        lines = [
+            '# HELP bireus_update_queue_depth Update requests waiting for their repository',
+            '# TYPE bireus_update_queue_depth gauge',
+            'bireus_update_queue_depth %s' % self.queue_depth,
+            '# HELP bireus_update_running Update requests being served',
+            '# TYPE bireus_update_running gauge',
+            'bireus_update_running %s' % sum(1 for job in self._update_jobs.values() if job.state == JOB_RUNNING),
+            '# HELP bireus_update_jobs_total Finished update requests',
+            '# TYPE bireus_update_jobs_total counter'
+        ]
+        lines.extend('bireus_update_jobs_total{state="%s"} %s' % (state, count)
+                     for state, count in sorted(self.finished_jobs.items()))
+        lines.extend([
+            '# HELP bireus_update_duration_seconds Duration of the updates',
+            '# TYPE bireus_update_duration_seconds summary',
+            'bireus_update_duration_seconds_sum %r' % self.update_seconds,
+            'bireus_update_duration_seconds_count %s' % self.updates,
+            '# HELP bireus_diff_bytes_total Size of the diffed target files per codec',
+            '# TYPE bireus_diff_bytes_total counter'
+        ])
+        lines.extend('bireus_diff_bytes_total{codec="%s"} %s' % (escape_label(codec), size)
+                     for codec, size in sorted(self.diff_bytes.items()))
+        lines.extend([
+            '# HELP bireus_diff_seconds_total Time spent diffing per codec',
+            '# TYPE bireus_diff_seconds_total counter'
+        ])
+        lines.extend('bireus_diff_seconds_total{codec="%s"} %r' % (escape_label(codec), seconds)
+                     for codec, seconds in sorted(self.diff_seconds.items()))
+        lines.extend([
+            '# HELP bireus_diff_throughput_bytes_per_second Average diff throughput per codec',
+            '# TYPE bireus_diff_throughput_bytes_per_second gauge'
+        ])
+        lines.extend('bireus_diff_throughput_bytes_per_second{codec="%s"} %r' % (
+            escape_label(codec), self.diff_bytes[codec] / seconds)
+            for codec, seconds in sorted(self.diff_seconds.items()) if seconds > 0)
+
+        return '\n'.join(lines) + '\n'
+
+    async def join(self) -> None:
+        """
+        Waits until all queued updates and their callbacks are done
+        """
+        for queue in list(self._queues.values()):
+            await queue.join()
+
+    def _forget_finished_jobs(self) -> None:
+        finished = [job_id for job_id, job in self._update_jobs.items() if job.done]
+        for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self._update_jobs[job_id]
+
+    async def _work(self, queue: asyncio.Queue) -> None:
+        while True:
+            jobs = [await queue.get()]  # type: List[UpdateJob]
+            # a single update serves all requests that are pending by now
+            while not queue.empty():
+                jobs.append(queue.get_nowait())
+
+            try:
+                await self._update(jobs)
+            except Exception as e:
+                logger.exception(e)
+            finally:
+                for _ in jobs:
+                    queue.task_done()
+
+    async def _update(self, jobs: List[UpdateJob]) -> None:
+        repository = jobs[0].repository
+        logger.debug("Updating repository %s for %s requests", repository.name, len(jobs))
+        self.updates += 1
+        self.coalesced += len(jobs) - 1
+
+        progress = UpdateProgress()
+        instrumentation = Instrumentation(repository.name)
+        for job in jobs:
+            job.start(progress)
+
+        # the worker of the repository is the only one updating it, so it may replace the attributes
+        repository.progress = progress
+        repository.instrumentation = instrumentation
+        if self.patch_store is not None:
+            update = functools.partial(repository.update, self.jobs, lazy=True,
+                                       hot_versions=self.patch_store.hot_versions(repository))
+        else:
+            update = functools.partial(repository.update, self.jobs)
+
+        def run() -> None:
+            update()
+            if self.shortcut_checkouts is not None:
+                repository.update_shortcuts(self.shortcut_checkouts, self.jobs)
+
+        start = time.perf_counter()
+        try:
+            await asyncio.get_event_loop().run_in_executor(self._executor, run)
+        except Exception as e:
+            logger.exception(e)
+            for job in jobs:
+                job.finish(e)
+        else:
+            for job in jobs:
+                job.finish()
+        finally:
+            repository.progress = NO_PROGRESS
+            repository.instrumentation = DISABLED
+            self.update_seconds += time.perf_counter() - start
+            self._record(instrumentation)
+
+        for job in jobs:
+            self.finished_jobs[job.state] += 1
+
+        if jobs[0].error is not None:
+            # nothing changed, the callbacks aren't delivered
+            return
+
+        logger.debug("Performing callbacks")
+        jobs = [job for job in jobs if job.callback_url is not None]
+        delivered = await asyncio.gather(*(self.callback_client.post(job.callback_url, job.payload) for job in jobs))
+        for job, success in zip(jobs, delivered):
+            job.callback_delivered = success
+
+    def _record(self, instrumentation: Instrumentation) -> None:
+        counters = instrumentation.to_dict(0)['counters']
+        for counter, value in counters.items():
+            if counter.endswith('_bytes'):
+                codec = counter[:-len('_bytes')]
+                self.diff_bytes[codec] = self.diff_bytes.get(codec, 0) + value
+                self.diff_seconds[codec] = self.diff_seconds.get(codec, 0.0) + instrumentation.phase_time(codec)
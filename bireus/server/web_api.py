@@ -0,0 +1,170 @@
+# coding=utf-8
+"""
+HTTP endpoints of the web server (web-server.py):
+
+    POST /update                 queues an update, answers with the ids of the new jobs
+    GET  /jobs                   status of the queued, running and recently finished jobs
+    GET  /jobs/{id}              status of a single job
+    GET  /jobs/{id}/events       the status of a job as server-sent events until it is finished
+    GET  /metrics                queue depth, job durations and diff throughput in the Prometheus text format
+    GET  /{repository}/{file}    info.json, versions.gml, latest.tar.xz and __patches__/{a}_to_{b}.tar.xz,
+                                 patches are generated on demand if the update service has a patch store
+    POST /{repository}/checkouts records a checkout of a client over several patches
+"""
+import asyncio
+import json
+import logging
+
+from aiohttp import web
+
+from bireus.server.repository import ServerRepository, UnknownPatchError
+from bireus.server.repository_manager import RepositoryManager
+from bireus.server.update_service import UpdateJob, UpdateService
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_EVENT_INTERVAL = 1.0  # seconds between two progress events
+REPOSITORY_FILES = ['info.json', 'versions.gml', 'latest.tar.xz']  # read by the client besides the patches
+
+
+class WebApi(object):
+    def __init__(self, repository_manager: RepositoryManager, update_service: UpdateService,
+                 event_interval: float = DEFAULT_EVENT_INTERVAL):
+        self.repository_manager = repository_manager
+        self.update_service = update_service
+        self.event_interval = event_interval
+
+    def create_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post('/update', self.update)
+        app.router.add_get('/jobs', self.list_jobs)
+        app.router.add_get('/jobs/{id}', self.get_job)
+        app.router.add_get('/jobs/{id}/events', self.job_events)
+        app.router.add_get('/metrics', self.metrics)
+        app.router.add_get('/{repository}/__patches__/{patch}', self.patch)
+        app.router.add_post('/{repository}/checkouts', self.checkout)
+        app.router.add_get('/{repository}/{filename}', self.repository_file)
+        app.on_startup.append(self._start_service)
+        app.on_cleanup.append(self._stop_service)
+        return app
+
+    async def _start_service(self, app: web.Application) -> None:
+        await self.update_service.start()
+
+    async def _stop_service(self, app: web.Application) -> None:
+        await self.update_service.close()
+
+    async def update(self, request: web.Request) -> web.Response:
+        data = await request.content.read(int(request.headers['content-length']))
+        body = json.loads(data.decode("utf-8"))
+
+        try:
+            repo_name = body["repository"]
+            callback_url = body["callback_url"]
+            payload = body["payload"]
+        except KeyError:
+            logger.debug("Invalid request: " + repr(request))
+            raise web.HTTPBadRequest(reason="Invalid arguments",
+                                     text="repository, callback_url and payload are required")
+
+        jobs = []
+
+        for repo in [x for x in self.repository_manager.repositories if x.name == repo_name]:
+            logger.debug(
+                "Adding to queue: repo='%s', callback_url='%s', payload= '%s'" % (repo.name, callback_url, payload))
+            jobs.append(self.update_service.submit(repo, callback_url, payload))
+
+        if len(jobs) == 0:
+            raise web.HTTPNotFound(reason="Invalid arguments",
+                                   text="repository, callback_url and payload are required")
+
+        return web.json_response({'jobs': [self.update_service.status(job) for job in jobs]},
+                                 status=web.HTTPAccepted.status_code)
+
+    async def list_jobs(self, request: web.Request) -> web.Response:
+        return web.json_response({'queue_depth': self.update_service.queue_depth,
+                                  'jobs': [self.update_service.status(job) for job in self.update_service.list_jobs()]})
+
+    async def get_job(self, request: web.Request) -> web.Response:
+        return web.json_response(self.update_service.status(self._job(request)))
+
+    async def job_events(self, request: web.Request) -> web.StreamResponse:
+        job = self._job(request)
+
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache'})
+        await response.prepare(request)
+
+        while True:
+            status = self.update_service.status(job)
+            await response.write(('data: %s\n\n' % json.dumps(status)).encode('utf-8'))
+            if job.done:
+                break
+            await asyncio.sleep(self.event_interval)
+
+        await response.write_eof()
+        return response
+
+    async def metrics(self, request: web.Request) -> web.Response:
+        text = self.update_service.metrics()
+        if self.update_service.patch_store is not None:
+            text += self.update_service.patch_store.metrics()
+        return web.Response(text=text, content_type='text/plain', charset='utf-8')
+
+    async def patch(self, request: web.Request) -> web.FileResponse:
+        repository = self._repository(request)
+        name = request.match_info['patch']
+        versions = name[:-len('.tar.xz')].split('_to_') if name.endswith('.tar.xz') else []
+        if len(versions) != 2:
+            raise web.HTTPNotFound(reason="Unknown patch", text="no patch %s" % name)
+
+        patch_store = self.update_service.patch_store
+        if patch_store is not None:
+            try:
+                path = await patch_store.get(repository, versions[0], versions[1])
+            except UnknownPatchError as e:
+                raise web.HTTPNotFound(reason="Unknown patch", text=str(e))
+        else:
+            path = repository.patch_path(versions[0], versions[1])
+            if not path.exists():
+                raise web.HTTPNotFound(reason="Unknown patch", text="no patch %s" % name)
+
+        return web.FileResponse(path)
+
+    async def checkout(self, request: web.Request) -> web.Response:
+        repository = self._repository(request)
+        body = await request.json()
+
+        try:
+            version_from = body["from"]
+            version_to = body["to"]
+        except (KeyError, TypeError):
+            logger.debug("Invalid request: " + repr(request))
+            raise web.HTTPBadRequest(reason="Invalid arguments", text="from and to are required")
+
+        if not repository.has_version(version_from) or not repository.has_version(version_to):
+            raise web.HTTPNotFound(reason="Unknown version", text="no version %s or %s" % (version_from, version_to))
+
+        await self.update_service.report_checkout(repository, version_from, version_to)
+        return web.Response(status=web.HTTPNoContent.status_code)
+
+    async def repository_file(self, request: web.Request) -> web.FileResponse:
+        repository = self._repository(request)
+        path = repository.absolute_path.joinpath(request.match_info['filename'])
+        if request.match_info['filename'] not in REPOSITORY_FILES or not path.exists():
+            raise web.HTTPNotFound(reason="Unknown file", text="no file %s" % request.match_info['filename'])
+
+        return web.FileResponse(path)
+
+    def _repository(self, request: web.Request) -> ServerRepository:
+        for repository in self.repository_manager.repositories:
+            if repository.name == request.match_info['repository']:
+                return repository
+
+        raise web.HTTPNotFound(reason="Unknown repository",
+                               text="no repository %s" % request.match_info['repository'])
+
+    def _job(self, request: web.Request) -> UpdateJob:
+        job = self.update_service.get_job(request.match_info['id'])
+        if job is None:
+            raise web.HTTPNotFound(reason="Unknown job", text="no job with id %s" % request.match_info['id'])
+        return job
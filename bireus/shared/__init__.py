@@ -2,17 +2,10 @@
 import filecmp
 import os
 import shutil
-import zlib
 from pathlib import Path
 from typing import Union, Any
 
-
-def crc32_from_file(filepath: Union[str, Path]) -> str:
-    if os.path.getsize(str(filepath)) > 0:
-        with open(str(filepath), 'rb') as file:
-            return hex(zlib.crc32(file.read()) & 0xffffffff)
-    else:
-        return "#EMPTY"
+from bireus.shared.checksum import crc32_from_file
 
 
 def copy_file(source: Union[str, Path], dest: Union[str, Path]) -> None:
@@ -0,0 +1,225 @@
+# coding=utf-8
+"""
+rsync style block delta for files that are too large for bsdiff.
+
+The base file is split into fixed size blocks, each identified by a weak rolling checksum (adler32)
+and a strong hash. The target file is scanned with a rolling window; windows that match a base block
+become copy operations, everything else is stored as literal data.
+Both directions work on streams, so memory usage is bounded by the block signature and a few buffers.
+
+Patch format: MAGIC, target size (u64), block size (u32), then a sequence of operations
+  b'C' offset (u64) length (u64)  - copy from the base file
+  b'L' length (u64) data          - literal data
+  b'E'                            - end of patch
+"""
+import hashlib
+import math
+import os
+import struct
+import zlib
+
+from typing import BinaryIO, Dict, Union
+from pathlib import Path
+
+MAGIC = b'BIRBLK01'
+MIN_BLOCK_SIZE = 4096
+MAX_BLOCK_SIZE = 128 * 1024
+READ_SIZE = 1024 * 1024
+LITERAL_FLUSH_SIZE = 1024 * 1024
+ADLER_MOD = 65521
+
+_HEADER = struct.Struct('<QI')
+_COPY = struct.Struct('<QQ')
+_LITERAL = struct.Struct('<Q')
+
+
+def default_block_size(file_size: int) -> int:
+    """
+    Square root of the file size (like rsync) as power of 2, within [MIN_BLOCK_SIZE, MAX_BLOCK_SIZE]
+    """
+    if file_size <= 0:
+        return MIN_BLOCK_SIZE
+
+    return max(MIN_BLOCK_SIZE, min(MAX_BLOCK_SIZE, 1 << int(math.log2(math.sqrt(file_size)))))
+
+
+def _strong_hash(data: bytes) -> bytes:
+    return hashlib.sha256(data).digest()
+
+
+def _signature(base_file: BinaryIO, block_size: int) -> Dict[int, Dict[bytes, int]]:
+    """
+    :return: weak checksum -> strong hash -> offset of all complete blocks in the base file
+    """
+    signature = dict()  # type: Dict[int, Dict[bytes, int]]
+    offset = 0
+
+    while True:
+        block = base_file.read(block_size)
+        if len(block) < block_size:
+            break
+
+        signature.setdefault(zlib.adler32(block), dict()).setdefault(_strong_hash(block), offset)
+        offset += block_size
+
+    return signature
+
+
+class _DeltaWriter(object):
+    """
+    Writes the operations and merges copies of adjacent blocks
+    """
+
+    def __init__(self, file: BinaryIO):
+        self._file = file
+        self._copy_offset = None
+        self._copy_length = 0
+
+    def copy(self, offset: int, length: int) -> None:
+        if self._copy_offset is not None and self._copy_offset + self._copy_length == offset:
+            self._copy_length += length
+        else:
+            self._flush_copy()
+            self._copy_offset = offset
+            self._copy_length = length
+
+    def literal(self, data: bytes) -> None:
+        if len(data) == 0:
+            return
+
+        self._flush_copy()
+        self._file.write(b'L')
+        self._file.write(_LITERAL.pack(len(data)))
+        self._file.write(data)
+
+    def close(self) -> None:
+        self._flush_copy()
+        self._file.write(b'E')
+
+    def _flush_copy(self) -> None:
+        if self._copy_offset is not None:
+            self._file.write(b'C')
+            self._file.write(_COPY.pack(self._copy_offset, self._copy_length))
+            self._copy_offset = None
+            self._copy_length = 0
+
+
+def file_diff(src_path: Union[str, Path], dst_path: Union[str, Path], patch_path: Union[str, Path],
+              block_size: int = None) -> None:
+    """
+    Writes a block delta from src_path to dst_path into patch_path (same signature as bsdiff4.file_diff)
+    """
+    if block_size is None:
+        block_size = default_block_size(os.path.getsize(str(src_path)))
+
+    with open(str(src_path), 'rb') as base_file:
+        signature = _signature(base_file, block_size)
+
+    with open(str(dst_path), 'rb') as target_file, open(str(patch_path), 'wb') as patch_file:
+        patch_file.write(MAGIC)
+        patch_file.write(_HEADER.pack(os.path.getsize(str(dst_path)), block_size))
+        writer = _DeltaWriter(patch_file)
+
+        n = block_size
+        buffer = bytearray()
+        start = 0  # start of the current window in buffer
+        literal_start = 0  # start of the pending literal data in buffer
+        eof = False
+        weak = None
+        a = b = 0
+
+        while True:
+            if len(buffer) - start <= n and not eof:
+                # keep memory bounded: drop everything that was written already
+                if literal_start > 0:
+                    del buffer[:literal_start]
+                    start -= literal_start
+                    literal_start = 0
+
+                chunk = target_file.read(READ_SIZE)
+                if chunk:
+                    buffer.extend(chunk)
+                else:
+                    eof = True
+                continue
+
+            if len(buffer) - start < n:
+                break  # the rest is shorter than a block
+
+            if weak is None:
+                weak = zlib.adler32(bytes(buffer[start:start + n]))
+                a = weak & 0xffff
+                b = weak >> 16
+
+            candidates = signature.get(weak)
+            if candidates is not None:
+                offset = candidates.get(_strong_hash(bytes(buffer[start:start + n])))
+                if offset is not None:
+                    writer.literal(bytes(buffer[literal_start:start]))
+                    writer.copy(offset, n)
+                    start += n
+                    literal_start = start
+                    weak = None
+                    continue
+
+            # roll the window byte by byte until a weak checksum matches (hot loop, keep it tight)
+            end = min(len(buffer) - n, literal_start + LITERAL_FLUSH_SIZE)
+            if start >= end and start + n >= len(buffer):
+                break  # end of file reached, nothing left to roll in
+
+            signature_get = signature.get
+            while start < end:
+                out_byte = buffer[start]
+                a = (a - out_byte + buffer[start + n]) % ADLER_MOD
+                b = (b - n * out_byte + a - 1) % ADLER_MOD
+                start += 1
+                if signature_get((b << 16) | a) is not None:
+                    break
+            weak = (b << 16) | a
+
+            if start - literal_start >= LITERAL_FLUSH_SIZE:
+                writer.literal(bytes(buffer[literal_start:start]))
+                literal_start = start
+
+        writer.literal(bytes(buffer[literal_start:]))
+        writer.close()
+
+
+def _copy_stream(source: BinaryIO, dest: BinaryIO, length: int) -> None:
+    while length > 0:
+        data = source.read(min(length, READ_SIZE))
+        if not data:
+            raise ValueError("unexpected end of blockdiff data")
+        dest.write(data)
+        length -= len(data)
+
+
+def file_patch(src_path: Union[str, Path], dst_path: Union[str, Path], patch_path: Union[str, Path]) -> None:
+    """
+    Applies a block delta onto src_path and writes the result to dst_path (same signature as bsdiff4.file_patch)
+    """
+    with open(str(patch_path), 'rb') as patch_file, open(str(src_path), 'rb') as base_file, \
+            open(str(dst_path), 'wb') as target_file:
+        if patch_file.read(len(MAGIC)) != MAGIC:
+            raise ValueError("incorrect blockdiff header")
+
+        target_size, block_size = _HEADER.unpack(patch_file.read(_HEADER.size))
+
+        while True:
+            operation = patch_file.read(1)
+
+            if operation == b'C':
+                offset, length = _COPY.unpack(patch_file.read(_COPY.size))
+                base_file.seek(offset)
+                _copy_stream(base_file, target_file, length)
+            elif operation == b'L':
+                length, = _LITERAL.unpack(patch_file.read(_LITERAL.size))
+                _copy_stream(patch_file, target_file, length)
+            elif operation == b'E':
+                break
+            else:
+                raise ValueError("corrupt blockdiff patch")
+
+        if target_file.tell() != target_size:
+            raise ValueError("blockdiff result has wrong size (expected=%s, actual=%s)"
+                             % (target_size, target_file.tell()))
@@ -0,0 +1,73 @@
+# coding=utf-8
+import hashlib
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from typing import Iterator, List, Tuple, Union
+
+CHUNK_SIZE = 1024 * 1024  # memory usage per hashed file, independent of the file size
+STRONG_HASH = 'sha256'  # hardware accelerated by OpenSSL on most platforms
+
+
+def read_chunks(filepath: Union[str, Path], chunk_size: int = CHUNK_SIZE) -> Iterator[memoryview]:
+    """
+    Reads a file chunk by chunk into a single reused buffer.
+    Attention: a yielded chunk is only valid until the next one is read!
+    """
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+
+    with open(str(filepath), 'rb', buffering=0) as file:
+        while True:
+            length = file.readinto(buffer)
+            if not length:
+                break
+            yield view[:length]
+
+
+def _format_crc32(crc: int, size: int) -> str:
+    if size > 0:
+        return hex(crc & 0xffffffff)
+    else:
+        return "#EMPTY"
+
+
+def crc32_from_file(filepath: Union[str, Path]) -> str:
+    crc = 0
+    size = 0
+
+    for chunk in read_chunks(filepath):
+        crc = zlib.crc32(chunk, crc)
+        size += len(chunk)
+
+    return _format_crc32(crc, size)
+
+
+def hash_file(filepath: Union[str, Path]) -> Tuple[str, str]:
+    """
+    Reads a file once and calculates both checksums
+    :return: crc32 (formatted like crc32_from_file) and the hex digest of the strong hash
+    """
+    crc = 0
+    size = 0
+    strong_hash = hashlib.new(STRONG_HASH)
+
+    for chunk in read_chunks(filepath):
+        crc = zlib.crc32(chunk, crc)
+        strong_hash.update(chunk)
+        size += len(chunk)
+
+    return _format_crc32(crc, size), strong_hash.hexdigest()
+
+
+def hash_files(filepaths: List[Union[str, Path]], jobs: int = 4) -> List[Tuple[str, str]]:
+    """
+    Hashes many files on a thread pool (zlib and hashlib release the GIL on large chunks)
+    :return: results of hash_file in the order of filepaths
+    """
+    if jobs <= 1 or len(filepaths) <= 1:
+        return [hash_file(filepath) for filepath in filepaths]
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(hash_file, filepaths))
@@ -0,0 +1,116 @@
+# coding=utf-8
+import abc
+import logging
+
+import bsdiff4
+from typing import Dict, List, Optional
+
+from bireus.shared import *
+from bireus.shared import blockdiff
+
+logger = logging.getLogger(__name__)
+
+
+class UnknownCodecError(Exception):
+    def __init__(self, name: str):
+        super().__init__("Delta codec `%s` is not supported in this version" % name)
+        self.name = name
+
+
+class Codec(abc.ABC):
+    """
+    A delta codec turns a base and a target file into a delta file and back.
+    Codecs are registered by subclassing, the name is used in the .bireus file and in the delta cache.
+    """
+    _codecs = None
+
+    name = None  # type: str
+    throughput = 0  # rough estimate of the diff speed in bytes per second, used for the time budget
+    memory_factor = 0  # rough estimate of the diff memory as multiple of the file size, 0 for constant memory
+
+    @abc.abstractmethod
+    def diff(self, base_path: Path, target_path: Path, delta_path: Path) -> None:
+        pass
+
+    @abc.abstractmethod
+    def patch(self, base_path: Path, target_path: Path, delta_path: Path) -> None:
+        """
+        Applies delta_path onto base_path and writes the result to target_path
+        """
+        pass
+
+    def estimate_time(self, size: int) -> float:
+        return size / self.throughput
+
+    def estimate_memory(self, size: int) -> int:
+        return self.memory_factor * size
+
+    def existing_delta(self, base_path: Path, target_path: Path) -> Optional[Path]:
+        """
+        :return: a file that already is the delta, so neither diff nor the delta cache are needed
+        """
+        return None
+
+    @classmethod
+    def get(cls, name: str) -> 'Codec':
+        if cls._codecs is None:
+            cls._codecs = dict()  # type: Dict[str, Codec]
+            for codec_class in Codec.__subclasses__():
+                cls._codecs[codec_class.name] = codec_class()
+
+        if name in cls._codecs:
+            return cls._codecs[name]
+        else:
+            raise UnknownCodecError(name)
+
+    @classmethod
+    def names(cls) -> List[str]:
+        return [codec_class.name for codec_class in Codec.__subclasses__()]
+
+
+class BsdiffCodec(Codec):
+    """
+    Smallest deltas, but slow and memory hungry (~17x the file size)
+    """
+    name = 'bsdiff'
+    throughput = 2 * 1024 * 1024
+    memory_factor = 17
+
+    def diff(self, base_path: Path, target_path: Path, delta_path: Path) -> None:
+        bsdiff4.file_diff(str(base_path), str(target_path), str(delta_path))
+
+    def patch(self, base_path: Path, target_path: Path, delta_path: Path) -> None:
+        bsdiff4.file_patch(str(base_path), str(target_path), str(delta_path))
+
+
+class BlockdiffCodec(Codec):
+    """
+    Copy/literal delta of a rolling block match, streams through files of any size
+    """
+    name = 'blockdiff'
+    # measured on files that changed throughout, the rolling checksum advances byte by byte in Python there.
+    # Unchanged blocks go about 10x faster, but the time budget must not be exceeded by changed files.
+    throughput = 2 * 1024 * 1024
+
+    def diff(self, base_path: Path, target_path: Path, delta_path: Path) -> None:
+        blockdiff.file_diff(base_path, target_path, delta_path)
+
+    def patch(self, base_path: Path, target_path: Path, delta_path: Path) -> None:
+        blockdiff.file_patch(base_path, target_path, delta_path)
+
+
+class StoreCodec(Codec):
+    """
+    Stores the full target file, wins for files that changed completely
+    """
+    name = 'store'
+    throughput = 500 * 1024 * 1024
+
+    def existing_delta(self, base_path: Path, target_path: Path) -> Optional[Path]:
+        return target_path
+
+    def diff(self, base_path: Path, target_path: Path, delta_path: Path) -> None:
+        copy_file(target_path, delta_path)
+
+    def patch(self, base_path: Path, target_path: Path, delta_path: Path) -> None:
+        copy_file(delta_path, target_path)
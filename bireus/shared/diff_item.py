@@ -1,5 +1,5 @@
 # coding=utf-8
-from typing import List, Any, Dict
+from typing import List, Any, Dict, Optional
 
 
 class DiffItem(object):
@@ -7,7 +7,8 @@ class DiffItem(object):
     Represents an item of a .bireus file (file or directory)
     """
 
-    def __init__(self, iotype: str, name: str, base_crc, target_crc, action: str = '', items: List['DiffItem'] = None):
+    def __init__(self, iotype: str, name: str, base_crc, target_crc, action: str = '', items: List['DiffItem'] = None,
+                 codec: Optional[str] = None, source: Optional[str] = None):
         if items is None:
             items = []
 
@@ -15,6 +16,8 @@ class DiffItem(object):
         self._name = name
         self._action = action
         self._items = items  # type: List['DiffItem']
+        self._codec = codec  # delta codec of a file (protocol 2 and later)
+        self._source = source  # base file of a moved or copied file, relative to the repository
 
         self._base_crc = base_crc
         self._target_crc = target_crc
@@ -35,6 +38,22 @@ class DiffItem(object):
     def action(self, value: str) -> None:
         self._action = value
 
+    @property
+    def codec(self) -> Optional[str]:
+        return self._codec
+
+    @codec.setter
+    def codec(self, value: Optional[str]) -> None:
+        self._codec = value
+
+    @property
+    def source(self) -> Optional[str]:
+        return self._source
+
+    @source.setter
+    def source(self, value: Optional[str]) -> None:
+        self._source = value
+
     @property
     def items(self) -> List['DiffItem']:
         return self._items
@@ -67,6 +86,12 @@ class DiffItem(object):
             result['target_crc'] = self._target_crc
             result['base_crc'] = self._base_crc
 
+            if self._codec is not None:
+                result['codec'] = self._codec
+
+            if self._source is not None:
+                result['source'] = self._source
+
         for item in self._items:
             result['items'].append(item.to_dict())
 
@@ -84,7 +109,9 @@ class DiffItem(object):
                           name=data['name'],
                           base_crc=base_crc,
                           target_crc=target_crc,
-                          action=data['action'])
+                          action=data['action'],
+                          codec=data.get('codec'),
+                          source=data.get('source'))
 
         for sub_dict in data['items']:
             result.items.append(DiffItem.load_dict(sub_dict))
@@ -0,0 +1,257 @@
+# coding=utf-8
+"""
+Timers and counters for the phases of a patch run, i.e.
+
+    server: walk, moves, compare, hash, bsdiff, blockdiff, delta, size_guard, zip_extract, archive, latest_archive
+    client: download, unpack, hash, apply, copy, zip_extract, zip_rezip
+
+Times are summed per phase and per file. A compare or patch task collects one run, the repository merges its runs.
+Instrumentation is disabled by default: the DISABLED instance ignores everything and costs a method call.
+"""
+import json
+import logging
+import threading
+import time
+
+from typing import Any, ContextManager, Dict, List, Optional, Tuple
+
+from bireus.shared import *
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TOP_FILES = 10  # number of files in the summary
+
+
+class _Timer(object):
+    def __init__(self, instrumentation: 'Instrumentation', phase: str, item: Optional[str]):
+        self._instrumentation = instrumentation
+        self._phase = phase
+        self._item = item
+        self._start = 0.0
+
+    def __enter__(self) -> '_Timer':
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self._instrumentation.add_time(self._phase, time.perf_counter() - self._start, self._item)
+
+
+class _NoTimer(object):
+    def __enter__(self) -> '_NoTimer':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        pass
+
+
+_NO_TIMER = _NoTimer()
+
+
+class Instrumentation(object):
+    """
+    Collects the time per phase and file and arbitrary counters, it is safe to use from several threads
+    """
+
+    enabled = True
+
+    def __init__(self, name: str):
+        """
+        :param name: name of the run or repository, i.e. `v1_to_v2`
+        """
+        self.name = name
+        self.duration = 0.0  # wall time of the whole run in seconds, set by the owner
+        self._lock = threading.Lock()
+        self._phases = dict()  # type: Dict[str, List[float]]  # phase -> [seconds, calls]
+        self._counters = dict()  # type: Dict[str, int]
+        self._files = dict()  # type: Dict[str, Dict[str, float]]  # file -> phase -> seconds
+        self._runs = []  # type: List[Dict[str, Any]]
+
+    def timer(self, phase: str, item: str = None) -> ContextManager:
+        """
+        Times the enclosed block, i.e. `with instrumentation.timer('bsdiff', 'dir/file.bin'):`
+        :param item: the file the time is spent on, if any
+        """
+        return _Timer(self, phase, item)
+
+    def add_time(self, phase: str, seconds: float, item: str = None) -> None:
+        with self._lock:
+            totals = self._phases.setdefault(phase, [0.0, 0])
+            totals[0] += seconds
+            totals[1] += 1
+
+            if item is not None:
+                file_phases = self._files.setdefault(item, dict())
+                file_phases[phase] = file_phases.get(phase, 0.0) + seconds
+
+    def count(self, counter: str, value: int = 1) -> None:
+        with self._lock:
+            self._counters[counter] = self._counters.get(counter, 0) + value
+
+    def phase_time(self, phase: str) -> float:
+        return self._phases.get(phase, [0.0, 0])[0]
+
+    def counter(self, counter: str) -> int:
+        return self._counters.get(counter, 0)
+
+    def merge(self, other: 'Instrumentation') -> None:
+        """
+        Adds the phases, counters and files of a finished run and keeps a summary of it
+        """
+        with self._lock:
+            for phase, (seconds, calls) in other._phases.items():
+                totals = self._phases.setdefault(phase, [0.0, 0])
+                totals[0] += seconds
+                totals[1] += calls
+
+            for counter, value in other._counters.items():
+                self._counters[counter] = self._counters.get(counter, 0) + value
+
+            for item, file_phases in other._files.items():
+                own_phases = self._files.setdefault(item, dict())
+                for phase, seconds in file_phases.items():
+                    own_phases[phase] = own_phases.get(phase, 0.0) + seconds
+
+            self._runs.append({
+                'name': other.name,
+                'duration': other.duration,
+                'phases': {phase: seconds for phase, (seconds, calls) in other._phases.items()}
+            })
+
+    def top_phases(self) -> List[Tuple[str, float]]:
+        """
+        :return: phases and their time in seconds, the most expensive first
+        """
+        return sorted(((phase, totals[0]) for phase, totals in self._phases.items()), key=lambda entry: -entry[1])
+
+    def top_files(self, count: Optional[int] = DEFAULT_TOP_FILES) -> List[Tuple[str, float]]:
+        """
+        :param count: maximum number of files, None for all
+        :return: files and the time spent on them in seconds, the most expensive first
+        """
+        files = sorted(((item, sum(phases.values())) for item, phases in self._files.items()),
+                       key=lambda entry: (-entry[1], entry[0]))
+        return files if count is None else files[:count]
+
+    def summary(self) -> str:
+        """
+        :return: one line naming the dominating phases and files
+        """
+        total = sum(seconds for phase, seconds in self.top_phases())
+        if total == 0:
+            return '%s: nothing measured' % self.name
+
+        phases = ', '.join('%s %.0f%% (%.2fs)' % (phase, seconds / total * 100, seconds)
+                           for phase, seconds in self.top_phases()[:3])
+        files = ', '.join('%s (%.2fs)' % (item, seconds) for item, seconds in self.top_files(3))
+        return '%s: %s; slowest files: %s' % (self.name, phases, files or 'none')
+
+    def to_dict(self, top_files: Optional[int] = DEFAULT_TOP_FILES) -> Dict[str, Any]:
+        """
+        :param top_files: number of files to include, None for all (required to merge it again)
+        """
+        with self._lock:
+            return {
+                'name': self.name,
+                'duration': self.duration,
+                'phases': {phase: {'seconds': seconds, 'calls': calls}
+                           for phase, (seconds, calls) in self._phases.items()},
+                'counters': dict(self._counters),
+                'files': [{'path': item, 'seconds': seconds, 'phases': dict(self._files[item])}
+                          for item, seconds in self.top_files(top_files)],
+                'runs': list(self._runs)
+            }
+
+    @staticmethod
+    def load_dict(data: Dict[str, Any]) -> 'Instrumentation':
+        instrumentation = Instrumentation(data['name'])
+        instrumentation.duration = data['duration']
+        instrumentation._phases = {phase: [totals['seconds'], totals['calls']]
+                                   for phase, totals in data['phases'].items()}
+        instrumentation._counters = dict(data['counters'])
+        instrumentation._files = {entry['path']: dict(entry['phases']) for entry in data['files']}
+        instrumentation._runs = list(data['runs'])
+        return instrumentation
+
+
+class _DisabledInstrumentation(Instrumentation):
+    enabled = False
+
+    def timer(self, phase: str, item: str = None) -> ContextManager:
+        return _NO_TIMER
+
+    def add_time(self, phase: str, seconds: float, item: str = None) -> None:
+        pass
+
+    def count(self, counter: str, value: int = 1) -> None:
+        pass
+
+    def merge(self, other: 'Instrumentation') -> None:
+        pass
+
+
+DISABLED = _DisabledInstrumentation('disabled')
+
+
+def escape_label(value: str) -> str:
+    """
+    Escapes a label value of the Prometheus text format
+    """
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def to_prometheus(instrumentations: List[Instrumentation], top_files: int = DEFAULT_TOP_FILES) -> str:
+    """
+    Renders the instrumentations (one per repository) in the Prometheus text format
+    """
+    metrics = [
+        ('bireus_phase_seconds_total', 'Time spent per phase', 'counter'),
+        ('bireus_phase_calls_total', 'Number of timed operations per phase', 'counter'),
+        ('bireus_events_total', 'Counted events', 'counter'),
+        ('bireus_file_seconds_total', 'Time spent per phase on the most expensive files', 'counter'),
+        ('bireus_run_duration_seconds', 'Wall time of the whole run', 'gauge')
+    ]
+    samples = {metric: [] for metric, _, _ in metrics}  # type: Dict[str, List[str]]
+
+    for instrumentation in instrumentations:
+        data = instrumentation.to_dict(top_files)
+        repository = 'repository="%s"' % escape_label(data['name'])
+
+        for phase, totals in sorted(data['phases'].items()):
+            labels = '%s,phase="%s"' % (repository, escape_label(phase))
+            samples['bireus_phase_seconds_total'].append('{%s} %r' % (labels, totals['seconds']))
+            samples['bireus_phase_calls_total'].append('{%s} %s' % (labels, totals['calls']))
+
+        for counter, value in sorted(data['counters'].items()):
+            samples['bireus_events_total'].append('{%s,event="%s"} %s' % (repository, escape_label(counter), value))
+
+        for entry in data['files']:
+            for phase, seconds in sorted(entry['phases'].items()):
+                samples['bireus_file_seconds_total'].append('{%s,file="%s",phase="%s"} %r' % (
+                    repository, escape_label(entry['path']), escape_label(phase), seconds))
+
+        samples['bireus_run_duration_seconds'].append('{%s} %r' % (repository, data['duration']))
+
+    lines = []  # type: List[str]
+    for metric, description, metric_type in metrics:
+        lines.append('# HELP %s %s' % (metric, description))
+        lines.append('# TYPE %s %s' % (metric, metric_type))
+        lines.extend(metric + sample for sample in samples[metric])
+
+    return '\n'.join(lines) + '\n'
+
+
+def write_metrics(path: Path, instrumentations: List[Instrumentation], format: str = 'json') -> None:
+    """
+    :param format: `json` or `prometheus`
+    """
+    if format == 'json':
+        content = json.dumps({'repositories': [instrumentation.to_dict() for instrumentation in instrumentations]},
+                             indent=2)
+    elif format == 'prometheus':
+        content = to_prometheus(instrumentations)
+    else:
+        raise ValueError("metrics format must be `json` or `prometheus`, got %s" % format)
+
+    path.write_text(content)
+    logger.info('Metrics written to %s', str(path))
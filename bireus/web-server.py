@@ -1,14 +1,15 @@
 import argparse
-import asyncio
-import json
 import logging
 import os
 import sys
 from pathlib import Path
 
-from aiohttp import web, ClientSession
+from aiohttp import web
 
+from bireus.server.patch_store import DEFAULT_HOT_THRESHOLD, DEFAULT_STORE_SIZE, PatchStore
 from bireus.server.repository_manager import RepositoryManager
+from bireus.server.update_service import CallbackClient, UpdateService, DEFAULT_CALLBACK_RETRIES
+from bireus.server.web_api import WebApi
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -22,6 +23,21 @@ class WebServer():
         parser.add_argument("--debug", "-d", default='info', choices=['debug', 'info', 'warning', 'error'])
         parser.add_argument("--path", "-p", default=os.getcwd(), help="repository root path")
         parser.add_argument("--port", default=8080, help="repository root path")
+        parser.add_argument("--concurrency", type=int, default=1,
+                            help="number of repositories updated at the same time")
+        parser.add_argument("--jobs", "-j", type=int, default=1,
+                            help="number of patches generated in parallel per repository")
+        parser.add_argument("--callback-retries", type=int, default=DEFAULT_CALLBACK_RETRIES,
+                            help="number of retries of a failed callback")
+        parser.add_argument("--lazy", action="store_true",
+                            help="generate patches when they are requested first")
+        parser.add_argument("--patch-store-size", type=int, default=DEFAULT_STORE_SIZE // (1024 * 1024),
+                            help="size of all patches in MiB in lazy mode, least recently used ones are removed")
+        parser.add_argument("--hot-patches", type=int, default=DEFAULT_HOT_THRESHOLD,
+                            help="requests of patches from a version after which its new patches are generated "
+                                 "eagerly in lazy mode")
+        parser.add_argument("--shortcuts", type=int, default=None,
+                            help="reported checkouts over several patches after which a direct patch is added")
 
         args = parser.parse_args()
 
@@ -32,12 +48,15 @@ class WebServer():
         logger.addHandler(streamhandler)
 
         self.repository_manager = RepositoryManager(Path(args.path))
-        self.queue = asyncio.Queue()
+        patch_store = None
+        if args.lazy:
+            patch_store = PatchStore(self.repository_manager.repositories, args.patch_store_size * 1024 * 1024,
+                                     args.hot_patches, args.concurrency, args.jobs)
+        self.update_service = UpdateService(args.concurrency, args.jobs, CallbackClient(args.callback_retries),
+                                            patch_store, args.shortcuts)
 
-        self.app = web.Application()
-        self.app.router.add_post('/update', self.handle)
+        self.app = WebApi(self.repository_manager, self.update_service).create_app()
 
-        asyncio.ensure_future(self.process_queue())
         web.run_app(self.app, port=args.port)
 
     def get_loglevel(self, level: str) -> int:
@@ -52,49 +71,6 @@ class WebServer():
         else:  # default
             return logging.INFO
 
-    async def process_queue(self):
-        while True:
-            try:
-                logging.debug("Awaiting queue item")
-                repository, callback_url, payload = await self.queue.get()
-
-                logging.debug("Updating repository " + repository.name)
-                repository.update()
-
-                logging.debug("Performing callback")
-                async with ClientSession() as session:
-                    async with session.post(callback_url, data=json.dumps(payload)) as response:
-                        logger.debug("Status code '%s', body:\n%s", response.status, await response.text())
-            except Exception as e:
-                logger.exception(e)
-
-    async def handle(self, request):
-        data = await request.content.read(int(request.headers['content-length']))
-        body = json.loads(data.decode("utf-8"))
-
-        try:
-            repo_name = body["repository"]
-            callback_url = body["callback_url"]
-            payload = body["payload"]
-        except KeyError:
-            logger.debug("Invalid request: " + repr(request))
-            return web.HTTPBadRequest(reason="Invalid arguments",
-                                      text="repository, callback_url and payload are required")
-
-        success = False
-
-        for repo in [x for x in self.repository_manager.repositories if x.name == repo_name]:
-            logger.debug(
-                "Adding to queue: repo='%s', callback_url='%s', payload= '%s'" % (repo.name, callback_url, payload))
-            await self.queue.put((repo, callback_url, payload))
-            success = True
-
-        if success:
-            return web.HTTPAccepted()
-        else:
-            return web.HTTPNotFound(reason="Invalid arguments",
-                                    text="repository, callback_url and payload are required")
-
 
 if __name__ == '__main__':
     WebServer()
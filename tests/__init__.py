@@ -1,9 +1,52 @@
+import asyncio
 import tempfile
 from pathlib import Path
 
+from typing import List
+
+from bireus.server.repository_manager import RepositoryManager
 from bireus.shared import compare_files, unpack_archive
 
 
+def create_simplefile(path: str, name: str, content: str) -> str:
+    abs_path = Path(path, name)
+    abs_path.write_text(content)
+    return str(abs_path)
+
+
+def add_demo_version(path: Path, version: str) -> None:
+    """
+    Adds a version with a changed and an unchanged file to the repository repo_demo in path
+    """
+    path.joinpath("repo_demo", version).mkdir(exist_ok=True)
+    path.joinpath("repo_demo", version, "changed.txt").write_text(("Das ist Version %s!" % version) * 100)
+    path.joinpath("repo_demo", version, "unchanged.txt").write_text("unchanged")
+
+
+def create_demo_repository(path: Path, versions: List[str], strategy: str = "inst-bi") -> RepositoryManager:
+    """
+    Creates the repository repo_demo in path with the given versions, it is not updated yet
+    """
+    repo_manager = RepositoryManager(path)
+    repo_manager.create("repo_demo", versions[0], strategy)
+    for version in versions:
+        add_demo_version(path, version)
+    return repo_manager
+
+
+def run_until_complete(coroutine):
+    """
+    Runs the coroutine in a new event loop, like asyncio.run (Python 3.7+)
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
 def assert_file_equals(file_or_folder_A: Path, file_or_folder_B: Path, file_name=None) -> None:
     if file_name is None:
         assert compare_files(file_or_folder_A, file_or_folder_B)
@@ -0,0 +1,33 @@
+# coding=utf-8
+import json
+
+import networkx
+import pytest
+
+
+@pytest.fixture()
+def empty_repo_with_2_version(tmpdir):
+    repo_folder = tmpdir.mkdir("repo_demo")
+    v1_folder = repo_folder.mkdir("v1")
+    v2_folder = repo_folder.mkdir("v2")
+
+    info_json = repo_folder.join("info.json")
+    with info_json.open("w") as file:
+        json.dump(
+            {
+                "name": "repo_demo",
+                "first_version": "v1",
+                "latest_version": "v1",
+                "strategy": "inst-bi",
+                "protocol": 1,
+                # the test files are too small for deltas to pay off
+                "min_delta_savings": None
+            },
+            file
+        )
+
+    version_graph = networkx.DiGraph()
+    version_graph.add_node("v1")
+    networkx.write_gml(version_graph, str(repo_folder.join("versions.gml")))
+
+    return tmpdir, repo_folder, v1_folder, v2_folder
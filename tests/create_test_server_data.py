@@ -15,7 +15,7 @@ import networkx
 from bireus.shared import remove_folder
 
 
-def create_test_server_data(path: Path, strategy: str):
+def create_test_server_data(path: Path, strategy: str, protocol: int = 1, settings: dict = None):
     if path.exists():
         remove_folder(path)
 
@@ -471,17 +471,17 @@ def create_test_server_data(path: Path, strategy: str):
     shutil.rmtree(str(repo_path.joinpath("temp1")))
     shutil.rmtree(str(repo_path.joinpath("temp2")))
 
+    info_json = {
+        "name": "repo_demo",
+        "first_version": "v1",
+        "latest_version": "v2",
+        "strategy": strategy,
+        "protocol": protocol
+    }
+    info_json.update(settings or dict())
+
     with repo_path.joinpath("info.json").open(mode='w+') as info_file:
-        json.dump(
-            {
-                "name": "repo_demo",
-                "first_version": "v1",
-                "latest_version": "v2",
-                "strategy": strategy,
-                "protocol": 1
-            },
-            info_file
-        )
+        json.dump(info_json, info_file)
 
     version_graph = networkx.DiGraph()
     version_graph.add_node("v1")
@@ -20,6 +20,7 @@ class MockDownloadService(AbstractDownloadService):
             self._read_function = [read_function]
 
         self.urls_called = []  # type: List[str]
+        self.posted = []  # type: List[Tuple[str, bytes]]
 
     def add_download_action(self, download_function) -> None:
         self._download_function.append(download_function)
@@ -34,3 +35,6 @@ class MockDownloadService(AbstractDownloadService):
     def read(self, url: str) -> bytes:
         self.urls_called.append(url)
         return self._read_function.pop(0)(url)
+
+    def post(self, url: str, data: bytes) -> None:
+        self.posted.append((url, data))
@@ -0,0 +1,66 @@
+# coding=utf-8
+import tempfile
+from pathlib import Path
+
+from benchmarks.generator import GeneratorSettings, RepositoryGenerator
+from benchmarks.run import WORK_FOLDER, compare_reports, main, run_benchmark
+
+tiny_settings = GeneratorSettings(files=20, max_size=8 * 1024, zip_files=2, zip_members=4, zip_depth=2,
+                                  versions=3, directories=3)
+
+
+def test_generator_is_deterministic():
+    with tempfile.TemporaryDirectory() as tmpdir1, tempfile.TemporaryDirectory() as tmpdir2:
+        repo1 = RepositoryGenerator(tiny_settings).generate(Path(tmpdir1))
+        repo2 = RepositoryGenerator(tiny_settings).generate(Path(tmpdir2))
+
+        files1 = sorted(path.relative_to(repo1) for path in repo1.rglob('*') if path.is_file())
+        files2 = sorted(path.relative_to(repo2) for path in repo2.rglob('*') if path.is_file())
+
+        assert files1 == files2
+        assert any(path.parts[0] == 'v003' for path in files1)
+        for path in files1:
+            assert repo1.joinpath(path).read_bytes() == repo2.joinpath(path).read_bytes()
+
+
+def test_run_benchmark():
+    for protocol in [1, 2]:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            report = run_benchmark(Path(tmpdir), tiny_settings, jobs=2, protocol=protocol)
+
+        assert sorted(report['phases']) == ['client_checkout', 'client_init', 'compare', 'generate', 'server_update']
+        assert report['phases']['server_update']['wall_time'] > 0
+        assert report['phases']['compare']['patch_size'] > 0
+        assert 'v001_to_v002.tar.xz' in report['patches']
+        assert report['patch_bytes'] == sum(report['patches'].values())
+        assert report['environment']['protocol'] == protocol
+
+        assert compare_reports(report, report, 0.0) == []
+
+
+def test_compare_reports():
+    baseline = {'phases': {'compare': {'wall_time': 1.0}, 'generate': {'wall_time': 1.0}}, 'patch_bytes': 100}
+    report = {'phases': {'compare': {'wall_time': 1.05}, 'generate': {'wall_time': 5.0}}, 'patch_bytes': 100}
+
+    assert compare_reports(baseline, report, 0.1) == []
+
+    report['phases']['compare']['wall_time'] = 1.2
+    report['patch_bytes'] = 200
+    regressions = compare_reports(baseline, report, 0.1)
+    assert len(regressions) == 2
+    assert regressions[0].startswith('compare wall_time')
+
+
+def test_work_dir_is_kept():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        Path(tmpdir, "keep.txt").write_text("not part of the benchmark")
+        args = ["--files", "5", "--max-size", "4096", "--zip-files", "1", "--versions", "2", "--work-dir", tmpdir,
+                "--output", str(Path(tmpdir, "report.json"))]
+
+        # a second run replaces the repositories of the first one
+        assert main(args) == 0
+        assert main(args) == 0
+
+        assert Path(tmpdir, "keep.txt").read_text() == "not part of the benchmark"
+        assert Path(tmpdir, WORK_FOLDER, "server").is_dir()
+        assert Path(tmpdir, "report.json").exists()
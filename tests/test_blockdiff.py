@@ -0,0 +1,67 @@
+# coding=utf-8
+import random
+import zlib
+
+import pytest
+
+from bireus.shared import *
+from bireus.shared import blockdiff
+
+
+def _roundtrip(tmpdir, base: bytes, target: bytes, block_size: int = None) -> int:
+    base_path = Path(tmpdir.strpath, "base.bin")
+    target_path = Path(tmpdir.strpath, "target.bin")
+    patch_path = Path(tmpdir.strpath, "base.blockdiff")
+    result_path = Path(tmpdir.strpath, "result.bin")
+    base_path.write_bytes(base)
+    target_path.write_bytes(target)
+
+    blockdiff.file_diff(base_path, target_path, patch_path, block_size)
+    blockdiff.file_patch(base_path, result_path, patch_path)
+
+    assert result_path.read_bytes() == target
+    return patch_path.stat().st_size
+
+
+def test_insert_delete_modify(tmpdir):
+    rnd = random.Random(42)
+    base = bytes(rnd.getrandbits(8) for _ in range(300000))
+    target = base[:1000] + b"inserted" + base[1000:50000] + base[60000:200000] + b"x" * 77 + base[200077:]
+
+    patch_size = _roundtrip(tmpdir, base, target, block_size=4096)
+
+    # shifted content is found again, only the changes around the edits are stored
+    assert patch_size < len(target) // 10
+
+
+@pytest.mark.parametrize("base,target", [
+    (b"", b""),
+    (b"", b"new content"),
+    (b"old content", b""),
+    (b"short", b"shorter than a block"),
+    (b"a" * 10000, b"a" * 10001),
+])
+def test_edge_cases(tmpdir, base, target):
+    _roundtrip(tmpdir, base, target, block_size=4096)
+
+
+def test_rolling_checksum_equals_adler32():
+    rnd = random.Random(1)
+    data = bytes(rnd.getrandbits(8) for _ in range(600))
+    n = 64
+
+    weak = zlib.adler32(data[:n])
+    a, b = weak & 0xffff, weak >> 16
+    for start in range(1, len(data) - n):
+        a = (a - data[start - 1] + data[start - 1 + n]) % blockdiff.ADLER_MOD
+        b = (b - n * data[start - 1] + a - 1) % blockdiff.ADLER_MOD
+        assert (b << 16) | a == zlib.adler32(data[start:start + n])
+
+
+def test_corrupt_patch(tmpdir):
+    Path(tmpdir.strpath, "base.bin").write_bytes(b"base")
+    Path(tmpdir.strpath, "patch").write_bytes(b"no blockdiff")
+
+    with pytest.raises(ValueError):
+        blockdiff.file_patch(Path(tmpdir.strpath, "base.bin"), Path(tmpdir.strpath, "out.bin"),
+                             Path(tmpdir.strpath, "patch"))
@@ -0,0 +1,34 @@
+# coding=utf-8
+import hashlib
+import zlib
+
+from bireus.shared import *
+from bireus.shared.checksum import CHUNK_SIZE, hash_file, hash_files, read_chunks
+
+
+def test_crc32_across_chunks(tmpdir):
+    content = bytes(range(256)) * (CHUNK_SIZE // 128 + 3)  # a few chunks, last one incomplete
+    path = Path(tmpdir.strpath, "big.bin")
+    path.write_bytes(content)
+
+    assert crc32_from_file(path) == hex(zlib.crc32(content) & 0xffffffff)
+    assert hash_file(path) == (hex(zlib.crc32(content) & 0xffffffff), hashlib.sha256(content).hexdigest())
+    assert max(len(chunk) for chunk in read_chunks(path)) == CHUNK_SIZE
+
+
+def test_empty_file(tmpdir):
+    path = Path(tmpdir.strpath, "empty.bin")
+    path.touch()
+
+    assert crc32_from_file(path) == "#EMPTY"
+    assert hash_file(path)[0] == "#EMPTY"
+
+
+def test_hash_files_keeps_order(tmpdir):
+    paths = []
+    for i in range(10):
+        path = Path(tmpdir.strpath, "file%s.txt" % i)
+        path.write_text("content %s" % i)
+        paths.append(path)
+
+    assert hash_files(paths, jobs=4) == [hash_file(path) for path in paths]
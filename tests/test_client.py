@@ -2,6 +2,7 @@
 import json
 import logging
 import sys
+import threading
 
 import networkx
 import pytest
@@ -10,8 +11,9 @@ from bireus.client.download_service import DownloadError
 from bireus.client.repository import ClientRepository, CheckoutError
 from bireus.server.repository_manager import RepositoryManager
 from bireus.shared import *
+from bireus.shared.instrumentation import Instrumentation
 from bireus.shared.repository import ProtocolException
-from tests import assert_file_equals, assert_zip_file_equals
+from tests import assert_file_equals, assert_zip_file_equals, create_demo_repository
 from tests.create_test_server_data import create_test_server_data
 from tests.mocks.mock_download_service import MockDownloadService
 
@@ -230,3 +232,198 @@ def test_protocol_exception(tmpdir):
 
     with pytest.raises(ProtocolException):
         ClientRepository(Path(repo_folder.strpath))
+
+
+def test_checkout_version_protocol_2(mocker):
+    create_test_server_data(server_path, "inst-bi", protocol=2,
+                            settings={"codec_policy": {"codecs": ["bsdiff", "blockdiff", "store"]}})
+    RepositoryManager(server_path).full_update()
+    if client_path.exists():
+        remove_folder(client_path)
+
+    downloader = MockDownloadService()
+    client_repo = get_latest_version(mocker, downloader)
+
+    server_update = server_path.joinpath("repo_demo", "__patches__", "v2_to_v1.tar.xz")
+    downloader.add_download_action(lambda path_from, path_to: copy_file(server_update, path_to))
+
+    client_repo.checkout_version("v1")
+
+    original_source_path = server_path.joinpath("repo_demo", "v1")
+
+    assert not client_path.joinpath("new_folder").joinpath("new_file.txt").exists()
+    assert_file_equals(client_path, original_source_path, Path("removed_folder", "obsolete.txt"))
+    assert_file_equals(client_path, original_source_path, "changed.txt")
+    assert_file_equals(client_path, original_source_path, "unchanged.txt")
+    assert_zip_file_equals(client_path, original_source_path, Path("zip_sub", "changed-subfolder.test"))
+    assert_zip_file_equals(client_path, original_source_path, "changed.zip")
+
+
+def test_checkout_version_moved_files(mocker):
+    create_test_server_data(server_path, "inst-bi", settings={"move_detection": True})
+    repo_path = server_path.joinpath("repo_demo")
+
+    content = "".join("line %s\n" % i for i in range(200))
+    repo_path.joinpath("v1", "renamed_folder").mkdir()
+    repo_path.joinpath("v1", "renamed_folder", "moved.txt").write_text(content)
+    repo_path.joinpath("v1", "renamed_folder", "similar.txt").write_text(content + "v1 ending\n")
+    repo_path.joinpath("v1", "copied.txt").write_text("This file will be unchanged.")
+    repo_path.joinpath("v2", "folder").mkdir()
+    repo_path.joinpath("v2", "folder", "moved.txt").write_text(content)
+    repo_path.joinpath("v2", "folder", "similar.txt").write_text(content + "v2 ending\n")
+
+    RepositoryManager(server_path).full_update()
+    if client_path.exists():
+        remove_folder(client_path)
+
+    downloader = MockDownloadService()
+    client_repo = get_latest_version(mocker, downloader)
+
+    server_update = repo_path.joinpath("__patches__", "v2_to_v1.tar.xz")
+    downloader.add_download_action(lambda path_from, path_to: copy_file(server_update, path_to))
+
+    client_repo.checkout_version("v1")
+
+    original_source_path = repo_path.joinpath("v1")
+
+    assert not client_path.joinpath("folder").exists()
+    assert_file_equals(client_path, original_source_path, Path("renamed_folder", "moved.txt"))
+    assert_file_equals(client_path, original_source_path, Path("renamed_folder", "similar.txt"))
+    assert_file_equals(client_path, original_source_path, "copied.txt")
+    assert_file_equals(client_path, original_source_path, "unchanged.txt")
+
+
+def test_checkout_version_instrumentation(mocker, prepare_server):
+    downloader = MockDownloadService()
+    client_repo = get_latest_version(mocker, downloader)
+    client_repo.instrumentation = Instrumentation("repo_demo")
+
+    server_update = server_path.joinpath("repo_demo", "__patches__", "v2_to_v1.tar.xz")
+    downloader.add_download_action(lambda path_from, path_to: copy_file(server_update, path_to))
+
+    client_repo.checkout_version("v1")
+
+    data = client_repo.instrumentation.to_dict(None)
+    assert data["duration"] > 0
+    assert [run["name"] for run in data["runs"]] == ["v2_to_v1"]
+    for phase in ["download", "unpack", "hash", "apply", "copy", "zip_extract", "zip_rezip"]:
+        assert data["phases"][phase]["calls"] > 0, phase
+
+    files = {entry["path"]: entry["phases"] for entry in data["files"]}
+    assert "apply" in files["changed.txt"]
+    assert "zip_rezip" in files["changed.zip"]
+    assert "download" in files["v2_to_v1.tar.xz"]
+
+
+def _client_with_graph(tmpdir, version_graph: networkx.DiGraph) -> ClientRepository:
+    path = Path(tmpdir.strpath, "client")
+    path.joinpath(".bireus").mkdir(parents=True)
+    with path.joinpath(".bireus", "info.json").open("w") as file:
+        json.dump({"name": "repo_demo", "first_version": "v1", "latest_version": "v4", "strategy": "inst-bi",
+                   "protocol": 1, "url": test_url, "current_version": "v1"}, file)
+    networkx.write_gml(version_graph, str(path.joinpath(".bireus", "versions.gml")))
+
+    return ClientRepository(path, MockDownloadService(), file_logging=False)
+
+
+def test_find_patch_path_by_size(tmpdir):
+    version_graph = networkx.DiGraph()
+    version_graph.add_edge("v1", "v4", size=800 * 1024 * 1024)
+    for version_from, version_to in [("v1", "v2"), ("v2", "v3"), ("v3", "v4")]:
+        version_graph.add_edge(version_from, version_to, size=5 * 1024 * 1024)
+    client_repo = _client_with_graph(tmpdir, version_graph)
+
+    # three small patches beat a huge one
+    assert client_repo.find_patch_path("v1", "v4") == ["v1", "v2", "v3", "v4"]
+
+    # without sizes the path with the fewest patches wins
+    client_repo.version_graph = networkx.DiGraph(version_graph.edges())
+    assert client_repo.find_patch_path("v1", "v4") == ["v1", "v4"]
+
+    with pytest.raises(networkx.NetworkXNoPath):
+        client_repo.find_patch_path("v4", "v1")
+
+
+def test_find_patch_path_prefers_cached(tmpdir):
+    version_graph = networkx.DiGraph()
+    version_graph.add_edge("v1", "v4", size=20 * 1024 * 1024)
+    for version_from, version_to in [("v1", "v2"), ("v2", "v3"), ("v3", "v4")]:
+        version_graph.add_edge(version_from, version_to, size=5 * 1024 * 1024)
+    client_repo = _client_with_graph(tmpdir, version_graph)
+
+    assert client_repo.find_patch_path("v1", "v4") == ["v1", "v2", "v3", "v4"]
+
+    client_repo.get_patch_path("v1", "v4").write_bytes(b"downloaded before")
+    assert client_repo.find_patch_path("v1", "v4") == ["v1", "v4"]
+
+
+def test_find_patch_path_huge_patch(tmpdir):
+    version_graph = networkx.DiGraph()
+    # GML stores integers of 2^31 or more as strings
+    version_graph.add_edge("v1", "v4", size=3 * 1024 * 1024 * 1024)
+    for version_from, version_to in [("v1", "v2"), ("v2", "v3"), ("v3", "v4")]:
+        version_graph.add_edge(version_from, version_to, size=5 * 1024 * 1024)
+    version_graph.add_edge("v4", "v1")
+    client_repo = _client_with_graph(tmpdir, version_graph)
+
+    assert client_repo.find_patch_path("v1", "v4") == ["v1", "v2", "v3", "v4"]
+    assert client_repo.find_patch_path("v4", "v1") == ["v4", "v1"]
+
+
+def _incremental_server(tmpdir) -> Path:
+    path = Path(tmpdir.strpath, "server")
+    path.mkdir()
+    create_demo_repository(path, ["v1", "v2", "v3", "v4"], "inc-bi").full_update()
+    return path.joinpath("repo_demo")
+
+
+def _incremental_client(tmpdir, repo_path: Path, downloader: MockDownloadService) -> ClientRepository:
+    downloader.add_read_action(lambda url: repo_path.joinpath("info.json").read_bytes())
+    downloader.add_download_action(lambda url, path: copy_file(repo_path.joinpath("versions.gml"), path))
+    downloader.add_download_action(lambda url, path: copy_file(repo_path.joinpath("latest.tar.xz"), path))
+    return ClientRepository.get_from_url(Path(tmpdir.strpath, "client"), test_url, downloader, file_logging=False)
+
+
+def test_checkout_version_prefetch(tmpdir):
+    repo_path = _incremental_server(tmpdir)
+    downloader = MockDownloadService()
+    client_repo = _incremental_client(tmpdir, repo_path, downloader)
+    client_repo.prefetch = 3
+
+    # each download only finishes once all three of them are running
+    barrier = threading.Barrier(3, timeout=10)
+
+    def download(url, path):
+        barrier.wait()
+        copy_file(repo_path.joinpath("__patches__", url.rsplit("/", 1)[1]), path)
+
+    for _ in range(3):
+        downloader.add_download_action(download)
+
+    client_repo.checkout_version("v1")
+
+    assert sorted(downloader.urls_called[3:]) == [test_url + "/__patches__/v2_to_v1.tar.xz",
+                                                   test_url + "/__patches__/v3_to_v2.tar.xz",
+                                                   test_url + "/__patches__/v4_to_v3.tar.xz"]
+    assert client_repo.current_version == "v1"
+    assert_file_equals(client_repo.absolute_path, repo_path.joinpath("v1"), "changed.txt")
+
+
+def test_checkout_version_prefetch_failure(tmpdir):
+    repo_path = _incremental_server(tmpdir)
+    downloader = MockDownloadService()
+    client_repo = _incremental_client(tmpdir, repo_path, downloader)
+    client_repo.prefetch = 2
+
+    def download(url, path):
+        if url.endswith("v3_to_v2.tar.xz"):
+            raise DownloadError(Exception("connection lost"), url)
+        copy_file(repo_path.joinpath("__patches__", url.rsplit("/", 1)[1]), path)
+
+    for _ in range(3):
+        downloader.add_download_action(download)
+
+    with pytest.raises(DownloadError):
+        client_repo.checkout_version("v1")
+
+    assert not client_repo.get_patch_path("v3", "v2").exists()
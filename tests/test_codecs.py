@@ -0,0 +1,67 @@
+# coding=utf-8
+import pytest
+
+from bireus.server.codec_policy import CodecPolicy
+from bireus.server.delta_cache import DeltaCache
+from bireus.shared import *
+from bireus.shared.codecs import Codec, UnknownCodecError
+
+
+@pytest.mark.parametrize("name", ["bsdiff", "blockdiff", "store"])
+def test_codec_roundtrip(tmpdir, name):
+    base_path = Path(tmpdir.strpath, "base.txt")
+    target_path = Path(tmpdir.strpath, "target.txt")
+    delta_path = Path(tmpdir.strpath, "delta")
+    result_path = Path(tmpdir.strpath, "result.txt")
+    base_path.write_text("Das ist die alte Version!" * 100)
+    target_path.write_text("Das ist die neue Version!" * 100)
+
+    codec = Codec.get(name)
+    codec.diff(base_path, target_path, delta_path)
+    codec.patch(base_path, result_path, delta_path)
+
+    assert compare_files(target_path, result_path)
+
+
+def test_unknown_codec():
+    with pytest.raises(UnknownCodecError):
+        Codec.get("vcdiff")
+
+    with pytest.raises(UnknownCodecError):
+        CodecPolicy(["bsdiff", "vcdiff"])
+
+
+def test_policy_candidates():
+    policy = CodecPolicy(["bsdiff", "blockdiff", "store"], time_budget=10, bsdiff_max_size=1000)
+
+    assert [codec.name for codec in policy.candidates(100)] == ["bsdiff", "blockdiff", "store"]
+    # bsdiff is excluded for large files
+    assert [codec.name for codec in policy.candidates(2000)] == ["blockdiff", "store"]
+    # trying all codecs would exceed the time budget
+    assert [codec.name for codec in policy.candidates(1024 ** 3)] == ["store"]
+
+    assert [codec.name for codec in CodecPolicy(["bsdiff"], bsdiff_max_size=1000).candidates(2000)] == ["blockdiff"]
+
+
+def test_policy_keeps_smallest(tmpdir):
+    base_path = Path(tmpdir.strpath, "base.bin")
+    target_path = Path(tmpdir.strpath, "target.bin")
+    delta_cache = DeltaCache(Path(tmpdir.strpath, "cache"))
+    policy = CodecPolicy(["bsdiff", "store"])
+
+    # a small change: the delta wins and ends up in the cache
+    base_path.write_bytes(b"0123456789" * 1000)
+    target_path.write_bytes(b"0123456789" * 500 + b"changed" + b"0123456789" * 500)
+    codec, delta_path = policy.diff(base_path, target_path, "a", "b", delta_cache)
+    assert codec == "bsdiff"
+    assert delta_path == delta_cache.lookup("a", "b", "bsdiff")
+
+    # completely different content: the target file itself is the delta
+    target_path.write_bytes(b"x")
+    assert policy.diff(base_path, target_path, "a", "c", delta_cache) == ("store", target_path)
+
+    # unless the target is a temporary file
+    codec, delta_path = policy.diff(base_path, target_path, "a", "c", delta_cache, persistent_inputs=False)
+    assert codec == "store"
+    assert delta_path.parent.parent == delta_cache.path
+    assert delta_path.read_bytes() == b"x"
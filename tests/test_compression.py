@@ -0,0 +1,78 @@
+# coding=utf-8
+import lzma
+import os
+
+import pytest
+
+from bireus.server.compression import ArchiveWriter, CompressionSettings, ESTIMATE_SAMPLES, ESTIMATE_SAMPLE_SIZE, \
+    MIN_STORE_SIZE, estimate_compressed_size, stored_xz, write_archive
+from bireus.shared import *
+
+
+@pytest.mark.parametrize("size", [1, 65536, 65537, 300000])
+def test_stored_xz(size):
+    data = os.urandom(size)
+
+    assert lzma.decompress(stored_xz(data)) == data
+    # consecutive streams are read as one file
+    assert lzma.decompress(stored_xz(data) + lzma.compress(b"next block")) == data + b"next block"
+
+
+def test_archive_roundtrip(tmpdir):
+    source = Path(tmpdir.strpath, "source")
+    source.joinpath("sub", "empty").mkdir(parents=True)
+    source.joinpath("text.txt").write_text("Das ist die neue Version!" * 10000)
+    source.joinpath("sub", "empty.txt").touch()
+    precompressed = b"BSDIFF40" + os.urandom(MIN_STORE_SIZE)
+    source.joinpath("sub", "patch.bin").write_bytes(precompressed)
+
+    archive_path = Path(tmpdir.strpath, "archive.tar.xz")
+    write_archive(archive_path, source, CompressionSettings(level=1, threads=4, block_size=64 * 1024))
+
+    # the precompressed file is stored as it is (split into LZMA2 chunks of 64 KiB)
+    assert precompressed[:32 * 1024] in archive_path.read_bytes()
+
+    target = Path(tmpdir.strpath, "target")
+    unpack_archive(archive_path, target, 'xztar')
+    assert compare_files(source.joinpath("text.txt"), target.joinpath("text.txt"))
+    assert compare_files(source.joinpath("sub", "patch.bin"), target.joinpath("sub", "patch.bin"))
+    assert target.joinpath("sub", "empty.txt").exists()
+    assert target.joinpath("sub", "empty").is_dir()
+
+
+def test_archive_abort(tmpdir):
+    archive_path = Path(tmpdir.strpath, "archive.tar.xz")
+
+    with pytest.raises(RuntimeError):
+        with ArchiveWriter(archive_path) as archive:
+            archive.add_directory("folder", Path(tmpdir.strpath))
+            raise RuntimeError()
+
+    assert list(Path(tmpdir.strpath).iterdir()) == []
+
+
+def test_settings():
+    settings = CompressionSettings.from_settings({"compression": {"level": 9, "threads": 3}})
+    assert settings.level == 9
+    assert settings.threads == 3
+    assert settings.block_size == 3 * 64 * 1024 * 1024
+
+    assert CompressionSettings.from_settings(dict()).level == 6
+
+    with pytest.raises(ValueError):
+        CompressionSettings(level=10)
+
+
+def test_estimate_compressed_size(tmpdir):
+    text = Path(tmpdir.strpath, "text.txt")
+    text.write_bytes(b"compressible " * 100000)
+    assert estimate_compressed_size(text) < text.stat().st_size // 10
+
+    # large files are estimated from samples
+    large = Path(tmpdir.strpath, "large.bin")
+    large.write_bytes(os.urandom(ESTIMATE_SAMPLES * ESTIMATE_SAMPLE_SIZE * 2))
+    assert abs(estimate_compressed_size(large) - large.stat().st_size) < large.stat().st_size // 100
+
+    precompressed = Path(tmpdir.strpath, "precompressed.xz")
+    precompressed.write_bytes(lzma.compress(os.urandom(MIN_STORE_SIZE)))
+    assert estimate_compressed_size(precompressed) == precompressed.stat().st_size
@@ -0,0 +1,81 @@
+# coding=utf-8
+import os
+
+import pytest
+
+from bireus.server.delta_cache import DeltaCache
+from bireus.server.repository_manager import RepositoryManager
+from bireus.shared import *
+from tests import create_simplefile
+
+
+def _write(content: bytes):
+    return lambda path: path.write_bytes(content)
+
+
+def test_lookup_store(tmpdir):
+    cache = DeltaCache(Path(tmpdir.strpath, "cache"))
+
+    assert cache.lookup("aaaa", "bbbb", "bsdiff") is None
+    entry_path = cache.store("aaaa", "bbbb", "bsdiff", _write(b"delta content"))
+    assert cache.lookup("aaaa", "bbbb", "other_codec") is None
+    assert cache.lookup("aaaa", "bbbb", "bsdiff") == entry_path
+    assert entry_path.read_bytes() == b"delta content"
+
+    assert cache.hits == 1
+    assert cache.misses == 2
+    assert list(entry_path.parent.glob("*.tmp")) == []
+
+
+def test_store_failure(tmpdir):
+    cache = DeltaCache(Path(tmpdir.strpath, "cache"))
+
+    def write(path):
+        path.write_bytes(b"half a delta")
+        raise IOError("disk full")
+
+    with pytest.raises(IOError):
+        cache.store("aaaa", "bbbb", "bsdiff", write)
+
+    assert cache.lookup("aaaa", "bbbb", "bsdiff") is None
+    assert list(cache.path.joinpath("aa").iterdir()) == []
+
+
+def test_evict_least_recently_used(tmpdir):
+    cache = DeltaCache(Path(tmpdir.strpath, "cache"))
+
+    for i, key in enumerate(["aa01", "aa02", "aa03"]):
+        entry_path = cache.store(key, key, "bsdiff", _write(b"x" * 100))
+        os.utime(str(entry_path), (i, i))
+
+    # an entry being written is never evicted
+    in_flight = cache.path.joinpath("aa", "aa04_aa04.bsdiff.0123.tmp")
+    in_flight.write_bytes(b"x" * 1000)
+    os.utime(str(in_flight), (0, 0))
+
+    # a lookup marks the entry as recently used
+    assert cache.lookup("aa01", "aa01", "bsdiff") is not None
+
+    assert cache.evict(250) == 1
+    assert cache.lookup("aa01", "aa01", "bsdiff") is not None
+    assert cache.lookup("aa02", "aa02", "bsdiff") is None
+    assert cache.lookup("aa03", "aa03", "bsdiff") is not None
+    assert in_flight.exists()
+
+
+def test_cache_shared_across_patches(empty_repo_with_2_version):
+    tmpdir, repo_folder, v1_folder, v2_folder = empty_repo_with_2_version
+
+    create_simplefile(v1_folder.strpath, "test.txt", "Das ist die alte Version!")
+    create_simplefile(v2_folder.strpath, "test.txt", "Das ist die neue Version!")
+    v3_folder = repo_folder.mkdir("v3")
+    create_simplefile(v3_folder.strpath, "test.txt", "Das ist die neue Version!")
+
+    repo_manager = RepositoryManager(Path(tmpdir.strpath))
+    repo_manager.full_update()
+
+    # v1 -> v3 equals v1 -> v2 and v3 -> v1 equals v2 -> v1
+    repository = repo_manager.repositories[0]
+    assert repository.delta_cache_hits == 2
+    assert repository.delta_cache_misses == 2
+    assert Path(repo_folder.strpath, "__patches__", "v1_to_v3.tar.xz").exists()
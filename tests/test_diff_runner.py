@@ -0,0 +1,119 @@
+# coding=utf-8
+import os
+import subprocess
+import sys
+import threading
+
+import pytest
+
+from bireus.server.diff_runner import DiffMemoryError, DiffRunner, EXIT_OUT_OF_MEMORY, _KILLED, resource
+from bireus.shared import *
+from bireus.shared.codecs import Codec
+
+
+@pytest.fixture()
+def file_pair(tmpdir):
+    base_path = Path(tmpdir.strpath, "base.txt")
+    target_path = Path(tmpdir.strpath, "target.txt")
+    base_path.write_text("Das ist die alte Version!" * 100)
+    target_path.write_text("Das ist die neue Version!" * 100)
+    return base_path, target_path
+
+
+def test_in_process(tmpdir, file_pair):
+    base_path, target_path = file_pair
+    runner = DiffRunner()
+
+    runner.diff(Codec.get("bsdiff"), base_path, target_path, Path(tmpdir.strpath, "delta"))
+
+    assert runner.isolated == 0
+    assert runner.in_process(Codec.get("bsdiff").estimate_memory(2500))
+
+
+def test_isolated(tmpdir, file_pair):
+    base_path, target_path = file_pair
+    delta_path = Path(tmpdir.strpath, "delta")
+    result_path = Path(tmpdir.strpath, "result.txt")
+    runner = DiffRunner(isolation_threshold=1)
+
+    runner.diff(Codec.get("bsdiff"), base_path, target_path, delta_path)
+    Codec.get("bsdiff").patch(base_path, result_path, delta_path)
+
+    assert runner.isolated == 1
+    assert runner.retried_alone == 0
+    assert compare_files(target_path, result_path)
+
+
+def test_memory_budget_exceeded(tmpdir, file_pair):
+    base_path, target_path = file_pair
+    runner = DiffRunner(memory_budget=1000)
+
+    with pytest.raises(DiffMemoryError):
+        runner.diff(Codec.get("bsdiff"), base_path, target_path, Path(tmpdir.strpath, "delta"))
+
+    # blockdiff needs no memory worth mentioning
+    runner.diff(Codec.get("blockdiff"), base_path, target_path, Path(tmpdir.strpath, "delta"))
+    assert runner.isolated == 0
+
+
+@pytest.mark.skipif(resource is None, reason="memory limits require the resource module")
+def test_child_out_of_memory(tmpdir):
+    base_path = Path(tmpdir.strpath, "base.bin")
+    target_path = Path(tmpdir.strpath, "target.bin")
+    base = os.urandom(16 * 1024 * 1024)
+    base_path.write_bytes(base)
+    target_path.write_bytes(base[:1000] + b"changed" + base[1000:])
+
+    # bsdiff needs ~270 MiB for these files
+    result = subprocess.run([sys.executable, "-m", "bireus.server.diff_runner", "bsdiff", str(base_path),
+                             str(target_path), str(Path(tmpdir.strpath, "delta")), str(160 * 1024 * 1024)])
+
+    assert result.returncode == EXIT_OUT_OF_MEMORY
+
+
+def test_killed_alone(tmpdir, file_pair, monkeypatch):
+    base_path, target_path = file_pair
+    runner = DiffRunner(isolation_threshold=1)
+    runs = []
+
+    def run_child(*args):
+        runs.append(runner._gate.running)
+        return _KILLED, ""
+
+    monkeypatch.setattr(runner, "_run_child", run_child)
+
+    # nothing else ran, retrying alone would be killed again
+    with pytest.raises(DiffMemoryError):
+        runner.diff(Codec.get("bsdiff"), base_path, target_path, Path(tmpdir.strpath, "delta"))
+
+    assert runs == [1]
+    assert runner.retried_alone == 0
+
+
+def test_killed_with_others(tmpdir, file_pair, monkeypatch):
+    base_path, target_path = file_pair
+    runner = DiffRunner(isolation_threshold=1)
+    runs = []
+
+    def run_child(*args):
+        runs.append(runner._gate.running)
+        if len(runs) > 1:
+            return 0, ""
+        # another isolated diff is still running when this one is killed
+        with runner._gate._condition:
+            runner._gate._running += 1
+        threading.Timer(0.1, release).start()
+        return _KILLED, ""
+
+    def release():
+        with runner._gate._condition:
+            runner._gate._running -= 1
+            runner._gate._condition.notify_all()
+
+    monkeypatch.setattr(runner, "_run_child", run_child)
+
+    runner.diff(Codec.get("bsdiff"), base_path, target_path, Path(tmpdir.strpath, "delta"))
+
+    # the retry waited for the other diff to finish
+    assert runs == [1, 0]
+    assert runner.retried_alone == 1
@@ -0,0 +1,104 @@
+# coding=utf-8
+import json
+import threading
+
+from bireus.shared import *
+from bireus.shared.instrumentation import DISABLED, Instrumentation, to_prometheus, write_metrics
+
+
+def test_timer_and_counter():
+    instrumentation = Instrumentation("v1_to_v2")
+
+    with instrumentation.timer("bsdiff", "big.bin"):
+        pass
+    instrumentation.add_time("bsdiff", 2.0, "big.bin")
+    instrumentation.add_time("hash", 0.5, "small.txt")
+    instrumentation.add_time("walk", 0.25)
+    instrumentation.count("deltas_checked")
+    instrumentation.count("deltas_checked", 2)
+
+    data = instrumentation.to_dict()
+    assert data["phases"]["bsdiff"]["calls"] == 2
+    assert data["phases"]["bsdiff"]["seconds"] >= 2.0
+    assert data["phases"]["walk"] == {"seconds": 0.25, "calls": 1}
+    assert data["counters"] == {"deltas_checked": 3}
+    assert [entry["path"] for entry in data["files"]] == ["big.bin", "small.txt"]
+    assert instrumentation.top_phases()[0][0] == "bsdiff"
+    assert instrumentation.summary().startswith("v1_to_v2: bsdiff")
+
+
+def test_threads():
+    instrumentation = Instrumentation("threads")
+
+    def work():
+        for _ in range(1000):
+            instrumentation.add_time("hash", 0.001, "file")
+            instrumentation.count("files")
+
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert instrumentation.to_dict()["phases"]["hash"]["calls"] == 4000
+    assert instrumentation.counter("files") == 4000
+
+
+def test_merge_runs():
+    repository = Instrumentation("repo_demo")
+
+    run = Instrumentation("v1_to_v2")
+    run.duration = 3.0
+    run.add_time("bsdiff", 1.0, "a.bin")
+    run.count("delta_fallbacks")
+
+    # runs of worker processes come back as dict
+    repository.merge(Instrumentation.load_dict(run.to_dict(None)))
+    repository.merge(run)
+
+    assert repository.phase_time("bsdiff") == 2.0
+    assert repository.counter("delta_fallbacks") == 2
+    assert repository.top_files() == [("a.bin", 2.0)]
+    assert repository.to_dict()["runs"] == [{"name": "v1_to_v2", "duration": 3.0, "phases": {"bsdiff": 1.0}}] * 2
+
+
+def test_disabled():
+    with DISABLED.timer("bsdiff", "file"):
+        pass
+    DISABLED.count("deltas_checked")
+    DISABLED.merge(Instrumentation("run"))
+
+    assert not DISABLED.enabled
+    assert DISABLED.to_dict()["phases"] == {}
+    assert DISABLED.to_dict()["counters"] == {}
+
+
+def test_prometheus():
+    instrumentation = Instrumentation('repo "demo"')
+    instrumentation.duration = 1.5
+    instrumentation.add_time("bsdiff", 1.0, "dir/file.bin")
+    instrumentation.count("deltas_checked", 3)
+
+    text = to_prometheus([instrumentation, Instrumentation("other")])
+    lines = text.splitlines()
+
+    assert lines.count("# TYPE bireus_phase_seconds_total counter") == 1
+    assert 'bireus_phase_seconds_total{repository="repo \\"demo\\"",phase="bsdiff"} 1.0' in lines
+    assert 'bireus_phase_calls_total{repository="repo \\"demo\\"",phase="bsdiff"} 1' in lines
+    assert 'bireus_events_total{repository="repo \\"demo\\"",event="deltas_checked"} 3' in lines
+    assert 'bireus_file_seconds_total{repository="repo \\"demo\\"",file="dir/file.bin",phase="bsdiff"} 1.0' in lines
+    assert 'bireus_run_duration_seconds{repository="other"} 0.0' in lines
+
+
+def test_write_metrics(tmpdir):
+    instrumentation = Instrumentation("repo_demo")
+    instrumentation.add_time("walk", 0.5)
+
+    path = Path(tmpdir.strpath, "metrics.json")
+    write_metrics(path, [instrumentation])
+    assert json.loads(path.read_text())["repositories"][0]["phases"]["walk"]["seconds"] == 0.5
+
+    path = Path(tmpdir.strpath, "metrics.prom")
+    write_metrics(path, [instrumentation], "prometheus")
+    assert 'bireus_phase_seconds_total{repository="repo_demo",phase="walk"} 0.5' in path.read_text()
@@ -0,0 +1,68 @@
+# coding=utf-8
+import os
+
+from bireus.server.compare_tasks import v1
+from bireus.server.compare_tasks.v1 import CompareTaskV1
+from bireus.server.manifest import VersionManifest, get_manifest_path
+from bireus.server.repository_manager import RepositoryManager
+from bireus.shared import *
+from tests.create_test_server_data import create_test_server_data
+
+
+def test_refresh_incremental(tmpdir):
+    version_path = Path(tmpdir.strpath, "v1")
+    version_path.joinpath("sub").mkdir(parents=True)
+    version_path.joinpath("a.txt").write_text("content a")
+    version_path.joinpath("sub", "b.txt").write_text("content b")
+    version_path.joinpath("empty.txt").touch()
+    manifest_path = Path(tmpdir.strpath, "manifest.json")
+
+    manifest = VersionManifest(version_path)
+    assert manifest.refresh() == 3
+    assert manifest.entries["a.txt"].crc32 == crc32_from_file(version_path.joinpath("a.txt"))
+    assert manifest.entries["sub/b.txt"].crc32 == crc32_from_file(version_path.joinpath("sub", "b.txt"))
+    assert manifest.entries["empty.txt"].crc32 == "#EMPTY"
+    manifest.save(manifest_path)
+
+    manifest = VersionManifest.load(version_path, manifest_path)
+    assert manifest.refresh() == 0
+
+    version_path.joinpath("a.txt").write_text("modified content a")
+    version_path.joinpath("sub", "b.txt").unlink()
+    assert manifest.refresh() == 2
+    assert manifest.entries["a.txt"].crc32 == crc32_from_file(version_path.joinpath("a.txt"))
+    assert "sub/b.txt" not in manifest.entries
+
+
+def test_invalid_entry_ignored(tmpdir):
+    version_path = Path(tmpdir.strpath, "v1")
+    version_path.mkdir()
+    version_path.joinpath("a.txt").write_text("content a")
+
+    manifest = VersionManifest(version_path)
+    manifest.refresh()
+    assert manifest.get(Path("a.txt")) is not None
+
+    os.utime(str(version_path.joinpath("a.txt")), ns=(0, 0))
+    assert manifest.get(Path("a.txt")) is None
+    assert manifest.get(Path("unknown.txt")) is None
+
+
+def test_compare_with_manifest(tmpdir, mocker):
+    server_path = Path(tmpdir.strpath, "example-server")
+    create_test_server_data(server_path, "inst-bi")
+    repo_path = server_path.joinpath("repo_demo")
+
+    expected = CompareTaskV1(repo_path, "repo_demo", "v1", "v2").generate_diff(False).to_dict()
+
+    RepositoryManager(server_path).repositories[0].refresh_manifests(["v1", "v2"])
+    assert get_manifest_path(repo_path, "v1").exists()
+    assert get_manifest_path(repo_path, "v2").exists()
+
+    compare_files = mocker.spy(v1, "compare_files")
+    actual = CompareTaskV1(repo_path, "repo_demo", "v1", "v2").generate_diff(False).to_dict()
+
+    # only the zip content has no manifest
+    for call in compare_files.call_args_list:
+        assert "bireus_" in str(call[0][0])
+    assert actual == expected
@@ -0,0 +1,177 @@
+# coding=utf-8
+import asyncio
+import functools
+import os
+import threading
+
+import networkx
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+
+from bireus.server import patching_strategies
+from bireus.server.patch_store import PatchStore
+from bireus.server.repository import ServerRepository, UnknownPatchError
+from bireus.server.repository_manager import RepositoryManager
+from bireus.server.update_service import UpdateService
+from bireus.server.web_api import WebApi
+from bireus.shared import *
+from tests import add_demo_version, create_demo_repository, run_until_complete
+
+
+@pytest.fixture()
+def lazy_repo(tmpdir) -> RepositoryManager:
+    return create_demo_repository(Path(tmpdir.strpath), ["v1", "v2", "v3"])
+
+
+def _patches(repository: ServerRepository):
+    return sorted(path.name for path in repository.absolute_path.joinpath('__patches__').glob('*.tar.xz'))
+
+
+def test_lazy_update(lazy_repo):
+    repository = lazy_repo.repositories[0]
+    repository.update(lazy=True, hot_versions={"v1"})
+
+    # all patches are advertised, only those from hot versions exist
+    assert sorted(repository.version_graph.edges()) == [("v1", "v2"), ("v1", "v3"), ("v2", "v1"), ("v2", "v3"),
+                                                         ("v3", "v1"), ("v3", "v2")]
+    assert _patches(repository) == ["v1_to_v2.tar.xz", "v1_to_v3.tar.xz"]
+
+    assert "size" not in repository.version_graph.edges["v3", "v2"]
+    assert repository.generate_patch("v3", "v2") == repository.patch_path("v3", "v2")
+    assert repository.patch_path("v3", "v2").exists()
+    # clients weigh their patch paths by the sizes in versions.gml
+    version_graph = networkx.read_gml(str(repository.version_graph_path))
+    assert version_graph.edges["v3", "v2"]["size"] == repository.patch_path("v3", "v2").stat().st_size
+
+    with pytest.raises(UnknownPatchError):
+        repository.generate_patch("v3", "v4")
+
+
+def test_patch_store(lazy_repo):
+    repository = lazy_repo.repositories[0]
+    repository.update(lazy=True)
+    assert _patches(repository) == []
+
+    patch_store = PatchStore(lazy_repo.repositories, hot_threshold=3, concurrency=2)
+
+    async def run():
+        # concurrent requests wait for a single generation
+        paths = await asyncio.gather(*[patch_store.get(repository, "v1", "v3") for _ in range(3)])
+        assert paths == [repository.patch_path("v1", "v3")] * 3
+        await patch_store.get(repository, "v1", "v3")
+
+        with pytest.raises(UnknownPatchError):
+            await patch_store.get(repository, "v1", "v4")
+
+    run_until_complete(run())
+    patch_store.close()
+
+    assert patch_store.misses == 1
+    assert patch_store.coalesced == 2
+    assert patch_store.hits == 1
+    assert _patches(repository) == ["v1_to_v3.tar.xz"]
+    # four requests of patches from v1
+    assert patch_store.hot_versions(repository) == {"v1"}
+
+
+def test_patch_store_eviction(lazy_repo):
+    repository = lazy_repo.repositories[0]
+    repository.update()
+    assert len(_patches(repository)) == 6
+
+    for i, name in enumerate(_patches(repository)):
+        os.utime(str(repository.absolute_path.joinpath('__patches__', name)), (i, i))
+    remaining = ["v1_to_v2.tar.xz", "v3_to_v1.tar.xz", "v3_to_v2.tar.xz"]
+    size = sum(repository.absolute_path.joinpath('__patches__', name).stat().st_size for name in remaining)
+
+    patch_store = PatchStore(lazy_repo.repositories, max_size=size)
+    patch_store.close()
+
+    # the least recently requested patches are removed first
+    assert patch_store.evict({repository.patch_path("v1", "v2")}) == 3
+    assert _patches(repository) == remaining
+    assert patch_store.evicted == 3
+
+
+def test_lazy_web_server(lazy_repo):
+    async def run():
+        update_service = UpdateService(patch_store=PatchStore(lazy_repo.repositories))
+        client = TestClient(TestServer(WebApi(lazy_repo, update_service).create_app()))
+        await client.start_server()
+
+        response = await client.post('/update', json={"repository": "repo_demo", "payload": {},
+                                                      "callback_url": str(client.make_url('/callback'))})
+        assert response.status == 202
+        await update_service.join()
+        patches_after_update = _patches(lazy_repo.repositories[0])
+
+        patch = await client.get('/repo_demo/__patches__/v2_to_v3.tar.xz')
+        content = await patch.read()
+        statuses = [
+            (await client.get('/repo_demo/versions.gml')).status,
+            (await client.get('/repo_demo/latest.tar.xz')).status,
+            (await client.get('/repo_demo/__patches__/v2_to_v4.tar.xz')).status,
+            (await client.get('/repo_demo/__patches__/v2.tar.xz')).status,
+            (await client.get('/repo_demo/secret.txt')).status,
+            (await client.get('/unknown/info.json')).status
+        ]
+        metrics = await (await client.get('/metrics')).text()
+
+        await client.close()
+        return patches_after_update, patch.status, content, statuses, metrics
+
+    patches_after_update, status, content, statuses, metrics = run_until_complete(run())
+
+    assert patches_after_update == []
+    assert status == 200
+    assert content == lazy_repo.repositories[0].patch_path("v2", "v3").read_bytes()
+    assert statuses == [200, 200, 404, 404, 404, 404]
+    assert 'bireus_patch_requests_total{outcome="generated"} 1' in metrics
+
+
+def test_patch_request_during_update(tmpdir, monkeypatch):
+    repo_manager = create_demo_repository(Path(tmpdir.strpath), ["v1", "v2", "v3"], "inc-bi")
+    repository = repo_manager.repositories[0]
+    repository.update(lazy=True)
+    for _ in range(2):
+        repository.checkout_log.record("v1", "v3")
+    repository.update_shortcuts(min_checkouts=2)
+    add_demo_version(Path(tmpdir.strpath), "v4")
+
+    # the update pauses in the patching strategy
+    entered = threading.Event()
+    release = threading.Event()
+    strategy = patching_strategies[repository.strategy]
+
+    class PausedStrategy(object):
+        def add_version(self, *args):
+            entered.set()
+            release.wait(5)
+            return strategy.add_version(*args)
+
+    monkeypatch.setitem(patching_strategies, repository.strategy, PausedStrategy())
+    patch_store = PatchStore(repo_manager.repositories)
+
+    async def run():
+        loop = asyncio.get_event_loop()
+        update = loop.run_in_executor(None, functools.partial(repository.update, lazy=True))
+        await loop.run_in_executor(None, entered.wait, 5)
+
+        # the shortcut stays advertised, the deferred patch waits for the update
+        shortcut = await patch_store.get(repository, "v1", "v3")
+        deferred = asyncio.ensure_future(patch_store.get(repository, "v3", "v2"))
+        await asyncio.sleep(0.2)
+        waited = not deferred.done()
+
+        release.set()
+        await update
+        return shortcut, await deferred, waited
+
+    shortcut, deferred, waited = run_until_complete(run())
+    patch_store.close()
+
+    assert shortcut == repository.patch_path("v1", "v3")
+    assert waited
+    assert deferred.exists()
+    assert repository.shortcuts() == [("v1", "v3")]
+    assert repository.has_version("v4")
@@ -0,0 +1,56 @@
+# coding=utf-8
+import os
+import tarfile
+
+import pytest
+
+from bireus.server.compare_tasks.patch_writer import PatchWriter
+from bireus.server.compare_tasks.work_queue import WorkQueue
+from bireus.server.compression import ArchiveWriter
+from bireus.shared import *
+
+
+def _fail() -> Path:
+    raise ValueError("diff failed")
+
+
+@pytest.mark.parametrize("jobs", [1, 4])
+def test_entries_in_plan_order(tmpdir, jobs):
+    source = Path(tmpdir.strpath, "source.txt")
+    source.write_text("content")
+    hard_link = Path(tmpdir.strpath, "hard_link.txt")
+    os.link(str(source), str(hard_link))
+
+    work_queue = WorkQueue(jobs)
+    patch_writer = PatchWriter()
+    patch_writer.add_directory("folder")
+    patch_writer.add_result("folder/result.txt", work_queue.add('test', lambda: source), mtime=0)
+    patch_writer.add_file("folder/source.txt", source)
+    patch_writer.add_file("folder/hard_link.txt", hard_link)
+
+    archive_path = Path(tmpdir.strpath, "patch.tar.xz")
+    with ArchiveWriter(archive_path) as archive:
+        patch_writer.write(archive, work_queue)
+
+    with tarfile.open(str(archive_path)) as tar_file:
+        members = tar_file.getmembers()
+
+    assert [member.name for member in members] == ["folder", "folder/result.txt", "folder/source.txt",
+                                                   "folder/hard_link.txt"]
+    # hard linked files are stored as regular files
+    assert all(member.isfile() for member in members[1:])
+
+
+@pytest.mark.parametrize("jobs", [1, 4])
+def test_failed_work_item(tmpdir, jobs):
+    work_queue = WorkQueue(jobs)
+    patch_writer = PatchWriter()
+    patch_writer.add_result("failed.txt", work_queue.add('test', _fail), mtime=0)
+    patch_writer.add_result("never_run.txt", work_queue.add('test', _fail), mtime=0)
+
+    archive_path = Path(tmpdir.strpath, "patch.tar.xz")
+    with pytest.raises(ValueError):
+        with ArchiveWriter(archive_path) as archive:
+            patch_writer.write(archive, work_queue)
+
+    assert list(Path(tmpdir.strpath).iterdir()) == []
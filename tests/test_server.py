@@ -1,46 +1,25 @@
 # coding=utf-8
 import json
+import os
+import tarfile
+import zipfile
+import zlib
 
 import bsdiff4
 import networkx
 import pytest
 
+from bireus.server.compare_tasks.v1 import CompareTaskV1
+from bireus.server.repository import ServerRepository
 from bireus.server.repository_manager import RepositoryManager, InvalidRepositoryPathError
 from bireus.shared import *
+from bireus.shared import blockdiff
 from bireus.shared.diff_head import DiffHead
+from bireus.shared.diff_item import DiffItem
+from bireus.shared.instrumentation import Instrumentation
 from bireus.shared.repository import ProtocolException
-
-
-def create_simplefile(path: str, name: str, content: str) -> str:
-    abs_path = Path(path, name)
-    abs_path.write_text(content)
-    return str(abs_path)
-
-
-@pytest.fixture()
-def empty_repo_with_2_version(tmpdir):
-    repo_folder = tmpdir.mkdir("repo_demo")
-    v1_folder = repo_folder.mkdir("v1")
-    v2_folder = repo_folder.mkdir("v2")
-
-    info_json = repo_folder.join("info.json")
-    with info_json.open("w") as file:
-        json.dump(
-            {
-                "name": "repo_demo",
-                "first_version": "v1",
-                "latest_version": "v1",
-                "strategy": "inst-bi",
-                "protocol": 1
-            },
-            file
-        )
-
-    version_graph = networkx.DiGraph()
-    version_graph.add_node("v1")
-    networkx.write_gml(version_graph, str(repo_folder.join("versions.gml")))
-
-    return tmpdir, repo_folder, v1_folder, v2_folder
+from tests import create_simplefile
+from tests.create_test_server_data import create_test_server_data
 
 
 def test_load_empty_repo(tmpdir):
@@ -451,3 +430,548 @@ def test_protocol_exception(tmpdir):
 
     with pytest.raises(ProtocolException):
         repo_manager = RepositoryManager(Path(tmpdir.strpath))
+
+
+def test_update_3_repos_parallel(empty_repo_with_2_version):
+    tmpdir, repo_folder, v1_folder, v2_folder = empty_repo_with_2_version
+
+    v3_folder = repo_folder.mkdir("v3")
+    create_simplefile(v1_folder.strpath, "test.txt", "Das ist die alte Version!")
+    create_simplefile(v2_folder.strpath, "test.txt", "Das ist die neue Version!")
+    create_simplefile(v3_folder.strpath, "test.txt", "Das ist die neueste Version!")
+
+    repo_manager = RepositoryManager(Path(tmpdir.strpath))
+    repo_manager.full_update(jobs=4)
+
+    for patch in ["v1_to_v2", "v2_to_v1", "v1_to_v3", "v3_to_v1", "v2_to_v3", "v3_to_v2"]:
+        assert Path(repo_folder.strpath, "__patches__", patch + ".tar.xz").exists()
+
+    # staging folders of the concurrent tasks are gone
+    assert not Path(v1_folder.strpath, '.delta_to').exists()
+    assert not Path(v2_folder.strpath, '.delta_to').exists()
+    assert not Path(v3_folder.strpath, '.delta_to').exists()
+
+    filename = Path(repo_folder.strpath, '__patches__', 'v1_to_v3.tar.xz')
+    targetfolder = Path(v1_folder.strpath, '.delta_to', 'v3')
+    unpack_archive(filename, targetfolder, 'xztar')
+
+    result = DiffHead.load_json_file(targetfolder.joinpath('.bireus')).items[0]
+    assert result.items[0].name == "test.txt"
+    assert result.items[0].action == "bsdiff"
+
+
+def test_compare_parallel_equals_serial(tmpdir):
+    server_path = Path(tmpdir.strpath, "example-server")
+    create_test_server_data(server_path, "inst-bi")
+    repo_path = server_path.joinpath("repo_demo")
+
+    patch_path = repo_path.joinpath("__patches__", "v1_to_v2.tar.xz")
+
+    serial_diff = CompareTaskV1(repo_path, "repo_demo", "v1", "v2").generate_diff()
+    serial_patch = patch_path.read_bytes()
+    parallel_diff = CompareTaskV1(repo_path, "repo_demo", "v1", "v2", jobs=4).generate_diff()
+
+    assert json.dumps(serial_diff.to_dict()) == json.dumps(parallel_diff.to_dict())
+    assert serial_patch == patch_path.read_bytes()
+
+    # the patch is written without a staging folder
+    assert not repo_path.joinpath("v1", ".delta_to").exists()
+    with tarfile.open(str(patch_path)) as tar_file:
+        names = tar_file.getnames()
+    assert names[-1] == ".bireus"
+    assert "changed.txt" in names
+    assert "new_folder/new_file.txt" in names
+    assert "zip_sub/changed-subfolder.test/subfolder" in names
+
+
+def test_zipdelta_members(empty_repo_with_2_version):
+    tmpdir, repo_folder, v1_folder, v2_folder = empty_repo_with_2_version
+
+    with zipfile.ZipFile(str(Path(v1_folder.strpath, "test.zip")), 'w') as zip_file:
+        zip_file.writestr("unchanged.txt", "unchanged")
+        zip_file.writestr("changed.txt", "Das ist die alte Version!")
+        zip_file.writestr("removed.txt", "removed")
+        zip_file.writestr("sub/removed.txt", "removed")
+
+    with zipfile.ZipFile(str(Path(v2_folder.strpath, "test.zip")), 'w') as zip_file:
+        zip_file.writestr("unchanged.txt", "unchanged")
+        zip_file.writestr("changed.txt", "Das ist die neue Version!")
+        zip_file.writestr("new/added.txt", "added")
+
+    repo_manager = RepositoryManager(Path(tmpdir.strpath))
+    repo_manager.full_update()
+
+    filename = Path(repo_folder.strpath, '__patches__', 'v1_to_v2.tar.xz')
+    targetfolder = Path(v1_folder.strpath, '.delta_to', 'v2')
+    unpack_archive(filename, targetfolder, 'xztar')
+
+    result = DiffHead.load_json_file(targetfolder.joinpath('.bireus')).items[0]
+    assert result.items[0].name == "test.zip"
+    assert result.items[0].action == "zipdelta"
+
+    items = {item.name: item for item in result.items[0].items}
+    assert len(items) == 5
+    assert items["unchanged.txt"].action == "unchanged"
+    assert items["unchanged.txt"].target_crc == hex(zlib.crc32(b"unchanged"))
+    assert items["changed.txt"].action == "bsdiff"
+    assert items["removed.txt"].action == "remove"
+    assert items["sub"].action == "remove"
+    assert items["sub"].items[0].action == "remove"
+    assert items["new"].action == "add"
+    assert items["new"].items[0].action == "add"
+
+    assert not targetfolder.joinpath("test.zip", "unchanged.txt").exists()
+    assert targetfolder.joinpath("test.zip", "new", "added.txt").read_text() == "added"
+    assert bsdiff4.patch(b"Das ist die alte Version!", targetfolder.joinpath("test.zip", "changed.txt").read_bytes()) \
+        == b"Das ist die neue Version!"
+
+
+def test_blockdiff_threshold(empty_repo_with_2_version):
+    tmpdir, repo_folder, v1_folder, v2_folder = empty_repo_with_2_version
+
+    info_json = Path(repo_folder.strpath, "info.json")
+    settings = json.loads(info_json.read_text())
+    settings["blockdiff_threshold"] = 1000
+    # protocol 1 clients of this repository know the blockdiff action
+    settings["blockdiff_action"] = True
+    info_json.write_text(json.dumps(settings))
+
+    base = "".join("line %s\n" % i for i in range(2000))
+    create_simplefile(v1_folder.strpath, "large.txt", base)
+    create_simplefile(v2_folder.strpath, "large.txt", base.replace("line 1000\n", "changed\n"))
+    create_simplefile(v1_folder.strpath, "small.txt", "Das ist die alte Version!")
+    create_simplefile(v2_folder.strpath, "small.txt", "Das ist die neue Version!")
+
+    repo_manager = RepositoryManager(Path(tmpdir.strpath))
+    repo_manager.full_update()
+
+    filename = Path(repo_folder.strpath, '__patches__', 'v1_to_v2.tar.xz')
+    targetfolder = Path(v1_folder.strpath, '.delta_to', 'v2')
+    unpack_archive(filename, targetfolder, 'xztar')
+
+    result = DiffHead.load_json_file(targetfolder.joinpath('.bireus')).items[0]
+    items = {item.name: item for item in result.items}
+    assert items["large.txt"].action == "blockdiff"
+    assert items["small.txt"].action == "bsdiff"
+    assert json.loads(info_json.read_text())["blockdiff_threshold"] == 1000
+
+    blockdiff.file_patch(Path(v1_folder.strpath, 'large.txt'), targetfolder.joinpath('large.txt.patched'),
+                         targetfolder.joinpath('large.txt'))
+    assert compare_files(Path(v2_folder.strpath, 'large.txt'), targetfolder.joinpath('large.txt.patched'))
+
+
+def test_blockdiff_threshold_protocol_1(empty_repo_with_2_version):
+    tmpdir, repo_folder, v1_folder, v2_folder = empty_repo_with_2_version
+
+    info_json = Path(repo_folder.strpath, "info.json")
+    settings = json.loads(info_json.read_text())
+    settings["blockdiff_threshold"] = 1000
+    info_json.write_text(json.dumps(settings))
+
+    base = "".join("line %s\n" % i for i in range(2000))
+    create_simplefile(v1_folder.strpath, "large.txt", base)
+    create_simplefile(v2_folder.strpath, "large.txt", base.replace("line 1000\n", "changed\n"))
+    for folder, content in [(v1_folder, base), (v2_folder, base.replace("line 1000\n", "changed\n"))]:
+        with zipfile.ZipFile(str(Path(folder.strpath, "test.zip")), "w") as zip_file:
+            zip_file.writestr("large.txt", content)
+
+    repo_manager = RepositoryManager(Path(tmpdir.strpath))
+    repo_manager.full_update()
+
+    filename = Path(repo_folder.strpath, '__patches__', 'v1_to_v2.tar.xz')
+    targetfolder = Path(v1_folder.strpath, '.delta_to', 'v2')
+    unpack_archive(filename, targetfolder, 'xztar')
+
+    # older clients don't know the blockdiff action, the large files are shipped in full
+    result = DiffHead.load_json_file(targetfolder.joinpath('.bireus')).items[0]
+    items = {item.name: item for item in result.items}
+    assert items["large.txt"].action == "replace"
+    assert items["test.zip"].items[0].action == "replace"
+    assert compare_files(Path(v2_folder.strpath, 'large.txt'), targetfolder.joinpath('large.txt'))
+    assert targetfolder.joinpath('test.zip', 'large.txt').read_text() == base.replace("line 1000\n", "changed\n")
+
+
+def test_diff_memory_budget(empty_repo_with_2_version):
+    tmpdir, repo_folder, v1_folder, v2_folder = empty_repo_with_2_version
+
+    info_json = Path(repo_folder.strpath, "info.json")
+    settings = json.loads(info_json.read_text())
+    settings["diff_memory_budget"] = 17 * 1000
+    settings["blockdiff_action"] = True
+    info_json.write_text(json.dumps(settings))
+
+    base = "".join("line %s\n" % i for i in range(2000))
+    create_simplefile(v1_folder.strpath, "large.txt", base)
+    create_simplefile(v2_folder.strpath, "large.txt", base.replace("line 1000\n", "changed\n"))
+    create_simplefile(v1_folder.strpath, "small.txt", "Das ist die alte Version!")
+    create_simplefile(v2_folder.strpath, "small.txt", "Das ist die neue Version!")
+
+    task = CompareTaskV1(Path(repo_folder.strpath), "repo_demo", "v1", "v2", jobs=4)
+    task.instrumentation = Instrumentation("v1_to_v2")
+    result = task.generate_diff().items[0]
+
+    # bsdiff would need more memory than the budget for the large file
+    items = {item.name: item for item in result.items}
+    assert items["large.txt"].action == "blockdiff"
+    assert items["small.txt"].action == "bsdiff"
+    assert task.instrumentation.counter("memory_fallbacks") == 1
+
+    filename = Path(repo_folder.strpath, '__patches__', 'v1_to_v2.tar.xz')
+    targetfolder = Path(v1_folder.strpath, '.delta_to', 'v2')
+    unpack_archive(filename, targetfolder, 'xztar')
+
+    blockdiff.file_patch(Path(v1_folder.strpath, 'large.txt'), targetfolder.joinpath('large.txt.patched'),
+                         targetfolder.joinpath('large.txt'))
+    assert compare_files(Path(v2_folder.strpath, 'large.txt'), targetfolder.joinpath('large.txt.patched'))
+
+
+def test_diff_memory_budget_protocol_1(empty_repo_with_2_version):
+    tmpdir, repo_folder, v1_folder, v2_folder = empty_repo_with_2_version
+
+    info_json = Path(repo_folder.strpath, "info.json")
+    settings = json.loads(info_json.read_text())
+    settings["diff_memory_budget"] = 17 * 1000
+    info_json.write_text(json.dumps(settings))
+
+    base = "".join("line %s\n" % i for i in range(2000))
+    target = base.replace("line 1000\n", "changed\n")
+    create_simplefile(v1_folder.strpath, "large.txt", base)
+    create_simplefile(v2_folder.strpath, "large.txt", target)
+    for folder, content in [(v1_folder, base), (v2_folder, target)]:
+        with zipfile.ZipFile(str(Path(folder.strpath, "test.zip")), "w") as zip_file:
+            zip_file.writestr("large.txt", content)
+
+    task = CompareTaskV1(Path(repo_folder.strpath), "repo_demo", "v1", "v2")
+    task.instrumentation = Instrumentation("v1_to_v2")
+    result = task.generate_diff().items[0]
+
+    # older clients don't know the blockdiff action, the files are shipped in full
+    items = {item.name: item for item in result.items}
+    assert items["large.txt"].action == "replace"
+    assert items["test.zip"].items[0].action == "replace"
+    assert task.instrumentation.counter("memory_fallbacks") == 2
+
+    filename = Path(repo_folder.strpath, '__patches__', 'v1_to_v2.tar.xz')
+    targetfolder = Path(v1_folder.strpath, '.delta_to', 'v2')
+    unpack_archive(filename, targetfolder, 'xztar')
+    assert targetfolder.joinpath('large.txt').read_text() == target
+    assert targetfolder.joinpath('test.zip', 'large.txt').read_text() == target
+
+
+def test_protocol_2_codec_policy(empty_repo_with_2_version):
+    tmpdir, repo_folder, v1_folder, v2_folder = empty_repo_with_2_version
+
+    info_json = Path(repo_folder.strpath, "info.json")
+    settings = json.loads(info_json.read_text())
+    settings["protocol"] = 2
+    settings["codec_policy"] = {"codecs": ["bsdiff", "store"]}
+    info_json.write_text(json.dumps(settings))
+
+    create_simplefile(v1_folder.strpath, "test.txt", "Das ist die alte Version!" * 100)
+    create_simplefile(v2_folder.strpath, "test.txt", "Das ist die neue Version!" * 100)
+    create_simplefile(v1_folder.strpath, "rewritten.txt", "Das ist die alte Version!" * 100)
+    create_simplefile(v2_folder.strpath, "rewritten.txt", "x")
+
+    with zipfile.ZipFile(str(Path(v1_folder.strpath, "test.zip")), 'w') as zip_file:
+        zip_file.writestr("changed.txt", "Das ist die alte Version!")
+    with zipfile.ZipFile(str(Path(v2_folder.strpath, "test.zip")), 'w') as zip_file:
+        zip_file.writestr("changed.txt", "Das ist die neue Version!")
+
+    repo_manager = RepositoryManager(Path(tmpdir.strpath))
+    repo_manager.full_update()
+
+    filename = Path(repo_folder.strpath, '__patches__', 'v1_to_v2.tar.xz')
+    targetfolder = Path(v1_folder.strpath, '.delta_to', 'v2')
+    unpack_archive(filename, targetfolder, 'xztar')
+
+    diff_head = DiffHead.load_json_file(targetfolder.joinpath('.bireus'))
+    assert diff_head.protocol == 2
+
+    items = {item.name: item for item in diff_head.items[0].items}
+    assert items["test.txt"].action == "delta"
+    assert items["test.txt"].codec == "bsdiff"
+    assert items["rewritten.txt"].action == "delta"
+    assert items["rewritten.txt"].codec == "store"
+    assert targetfolder.joinpath("rewritten.txt").read_text() == "x"
+    assert items["test.zip"].items[0].action == "delta"
+    assert items["test.zip"].items[0].codec in ["bsdiff", "store"]
+
+    # the protocol version is kept when the repository is saved
+    assert json.loads(info_json.read_text())["protocol"] == 2
+
+
+def _set_move_detection(repo_folder, enabled: bool) -> None:
+    info_json = Path(repo_folder.strpath, "info.json")
+    settings = json.loads(info_json.read_text())
+    settings["move_detection"] = enabled
+    info_json.write_text(json.dumps(settings))
+
+
+def test_moved_files(empty_repo_with_2_version):
+    tmpdir, repo_folder, v1_folder, v2_folder = empty_repo_with_2_version
+    # protocol 1 clients of this repository know the move and copy actions
+    _set_move_detection(repo_folder, True)
+
+    content = "".join("line %s\n" % i for i in range(200))
+    Path(v1_folder.strpath, "old_folder").mkdir()
+    create_simplefile(str(Path(v1_folder.strpath, "old_folder")), "moved.txt", content)
+    create_simplefile(str(Path(v1_folder.strpath, "old_folder")), "similar.txt", content + "old ending\n")
+    create_simplefile(v1_folder.strpath, "kept.txt", "This file exists twice in v2.")
+
+    Path(v2_folder.strpath, "new_folder").mkdir()
+    create_simplefile(str(Path(v2_folder.strpath, "new_folder")), "moved.txt", content)
+    create_simplefile(str(Path(v2_folder.strpath, "new_folder")), "similar.txt", content + "new ending\n")
+    create_simplefile(v2_folder.strpath, "kept.txt", "This file exists twice in v2.")
+    create_simplefile(v2_folder.strpath, "copied.txt", "This file exists twice in v2.")
+
+    repo_manager = RepositoryManager(Path(tmpdir.strpath))
+    repo_manager.full_update()
+
+    filename = Path(repo_folder.strpath, '__patches__', 'v1_to_v2.tar.xz')
+    with tarfile.open(str(filename)) as tar_file:
+        names = tar_file.getnames()
+    assert "new_folder" in names
+    assert "new_folder/moved.txt" not in names
+    assert "copied.txt" not in names
+
+    targetfolder = Path(v1_folder.strpath, '.delta_to', 'v2')
+    unpack_archive(filename, targetfolder, 'xztar')
+
+    result = DiffHead.load_json_file(targetfolder.joinpath('.bireus')).items[0]
+    items = {item.name: item for item in result.items}
+    assert items["old_folder"].action == "remove"
+    assert items["new_folder"].action == "add"
+    assert items["copied.txt"].action == "copy"
+    assert items["copied.txt"].source == "kept.txt"
+
+    folder_items = {item.name: item for item in items["new_folder"].items}
+    assert folder_items["moved.txt"].action == "move"
+    assert folder_items["moved.txt"].source == "old_folder/moved.txt"
+    assert folder_items["moved.txt"].base_crc == folder_items["moved.txt"].target_crc
+    assert folder_items["similar.txt"].action == "bsdiff"
+    assert folder_items["similar.txt"].source == "old_folder/similar.txt"
+
+    bsdiff4.file_patch(str(Path(v1_folder.strpath, 'old_folder', 'similar.txt')),
+                       str(targetfolder.joinpath('similar.txt.patched')),
+                       str(targetfolder.joinpath('new_folder', 'similar.txt')))
+    assert compare_files(Path(v2_folder.strpath, 'new_folder', 'similar.txt'),
+                         targetfolder.joinpath('similar.txt.patched'))
+
+
+@pytest.mark.parametrize("move_detection", [False, None])
+def test_move_detection_disabled(empty_repo_with_2_version, move_detection):
+    tmpdir, repo_folder, v1_folder, v2_folder = empty_repo_with_2_version
+    # older protocol 1 clients skip the unknown move action, so it is off by default
+    if move_detection is not None:
+        _set_move_detection(repo_folder, move_detection)
+
+    create_simplefile(v1_folder.strpath, "old.txt", "This file is renamed.")
+    create_simplefile(v2_folder.strpath, "new.txt", "This file is renamed.")
+
+    repo_manager = RepositoryManager(Path(tmpdir.strpath))
+    repo_manager.full_update()
+
+    filename = Path(repo_folder.strpath, '__patches__', 'v1_to_v2.tar.xz')
+    targetfolder = Path(v1_folder.strpath, '.delta_to', 'v2')
+    unpack_archive(filename, targetfolder, 'xztar')
+
+    result = DiffHead.load_json_file(targetfolder.joinpath('.bireus')).items[0]
+    items = {item.name: item for item in result.items}
+    assert items["new.txt"].action == "add"
+    assert items["new.txt"].source is None
+    assert targetfolder.joinpath("new.txt").exists()
+
+
+def test_similar_file_added(empty_repo_with_2_version):
+    tmpdir, repo_folder, v1_folder, v2_folder = empty_repo_with_2_version
+    _set_move_detection(repo_folder, True)
+
+    content = "".join("unit %s speed %s\n" % (i, i * 7) for i in range(500))
+    create_simplefile(v1_folder.strpath, "unit.bp", content)
+    create_simplefile(v2_folder.strpath, "unit.bp", content)
+    create_simplefile(v2_folder.strpath, "unit_v2.bp", content.replace("speed 7", "speed 8"))
+
+    repo_manager = RepositoryManager(Path(tmpdir.strpath))
+    repo_manager.full_update()
+
+    filename = Path(repo_folder.strpath, '__patches__', 'v1_to_v2.tar.xz')
+    targetfolder = Path(v1_folder.strpath, '.delta_to', 'v2')
+    unpack_archive(filename, targetfolder, 'xztar')
+
+    result = DiffHead.load_json_file(targetfolder.joinpath('.bireus')).items[0]
+    items = {item.name: item for item in result.items}
+    assert items["unit_v2.bp"].action == "bsdiff"
+    assert items["unit_v2.bp"].source == "unit.bp"
+
+    bsdiff4.file_patch(str(Path(v1_folder.strpath, 'unit.bp')), str(targetfolder.joinpath('unit_v2.bp.patched')),
+                       str(targetfolder.joinpath('unit_v2.bp')))
+    assert compare_files(Path(v2_folder.strpath, 'unit_v2.bp'), targetfolder.joinpath('unit_v2.bp.patched'))
+
+
+def test_delta_larger_than_file(tmpdir):
+    target = Path(tmpdir.strpath, "target.txt")
+    target.write_bytes(b"new version " * 1000)
+    delta = Path(tmpdir.strpath, "delta")
+    delta.write_bytes(os.urandom(4000))
+
+    compare_task = CompareTaskV1(Path(tmpdir.strpath), "repo_demo", "v1", "v2")
+    diff = DiffItem(iotype="file", name="target.txt", base_crc="0x1", target_crc="0x2", action="bsdiff",
+                    source="similar.txt")
+    assert compare_task._delta_or_file(diff, target, 'file', lambda: delta) == target
+    assert diff.action == "add"
+    assert diff.source is None
+    assert compare_task.delta_fallbacks == 1
+
+
+
+def test_similar_delta_larger_than_file_without_guard(tmpdir):
+    Path(tmpdir.strpath, "info.json").write_text(json.dumps({"min_delta_savings": None}))
+    target = Path(tmpdir.strpath, "target.txt")
+    target.write_bytes(b"new version " * 1000)
+    delta = Path(tmpdir.strpath, "delta")
+    delta.write_bytes(os.urandom(4000))
+
+    compare_task = CompareTaskV1(Path(tmpdir.strpath), "repo_demo", "v1", "v2")
+    # a delta against the file at the same path is kept, the guard is disabled
+    diff = DiffItem(iotype="file", name="target.txt", base_crc="0x1", target_crc="0x2", action="bsdiff")
+    assert compare_task._delta_or_file(diff, target, 'file', lambda: delta) == delta
+    assert diff.action == "bsdiff"
+
+    # a delta against a similar file must at least be smaller than the file
+    diff = DiffItem(iotype="file", name="target.txt", base_crc="0x1", target_crc="0x2", action="bsdiff",
+                    source="similar.txt")
+    assert compare_task._delta_or_file(diff, target, 'file', lambda: delta) == target
+    assert diff.action == "add"
+    assert diff.source is None
+
+def test_delta_size_guard(empty_repo_with_2_version):
+    tmpdir, repo_folder, v1_folder, v2_folder = empty_repo_with_2_version
+
+    info_json = Path(repo_folder.strpath, "info.json")
+    settings = json.loads(info_json.read_text())
+    settings["min_delta_savings"] = 20
+    info_json.write_text(json.dumps(settings))
+
+    # re-encoded, nothing in common
+    Path(v1_folder.strpath, "audio.ogg").write_bytes(os.urandom(20000))
+    Path(v2_folder.strpath, "audio.ogg").write_bytes(os.urandom(20000))
+    # a small change in a large file
+    content = os.urandom(20000)
+    Path(v1_folder.strpath, "data.bin").write_bytes(content)
+    Path(v2_folder.strpath, "data.bin").write_bytes(content[:10000] + b"changed" + content[10000:])
+
+    repo_manager = RepositoryManager(Path(tmpdir.strpath))
+    repo_manager.full_update()
+
+    filename = Path(repo_folder.strpath, '__patches__', 'v1_to_v2.tar.xz')
+    targetfolder = Path(v1_folder.strpath, '.delta_to', 'v2')
+    unpack_archive(filename, targetfolder, 'xztar')
+
+    result = DiffHead.load_json_file(targetfolder.joinpath('.bireus')).items[0]
+    items = {item.name: item for item in result.items}
+    assert items["audio.ogg"].action == "replace"
+    assert compare_files(Path(v2_folder.strpath, "audio.ogg"), targetfolder.joinpath("audio.ogg"))
+    assert items["data.bin"].action == "bsdiff"
+
+    repository = repo_manager.repositories[0]
+    assert repository.deltas_checked == 4
+    assert repository.delta_fallbacks == 2
+
+
+def test_latest_archive_unchanged(empty_repo_with_2_version):
+    tmpdir, repo_folder, v1_folder, v2_folder = empty_repo_with_2_version
+
+    create_simplefile(v2_folder.strpath, "test.txt", "Das ist die neue Version!")
+
+    repo_manager = RepositoryManager(Path(tmpdir.strpath))
+    repo_manager.full_update()
+
+    latest_path = Path(repo_folder.strpath, "latest.tar.xz")
+    latest_inode = latest_path.stat().st_ino
+
+    # nothing changed, the archive is kept
+    repo_manager.full_update()
+    assert latest_path.stat().st_ino == latest_inode
+
+    # the content of the latest version changed, the archive is replaced
+    create_simplefile(v2_folder.strpath, "test.txt", "Das ist die neueste Version!")
+    repo_manager.full_update()
+    assert latest_path.stat().st_ino != latest_inode
+
+    with tarfile.open(str(latest_path)) as tar_file:
+        assert tar_file.extractfile("test.txt").read() == b"Das ist die neueste Version!"
+    assert [path.name for path in Path(repo_folder.strpath).iterdir() if path.name.endswith(".tmp")] == []
+
+
+def test_update_failure_is_isolated(empty_repo_with_2_version):
+    tmpdir, repo_folder, v1_folder, v2_folder = empty_repo_with_2_version
+    create_simplefile(v2_folder.strpath, "test.txt", "Das ist die neue Version!")
+
+    broken_folder = tmpdir.mkdir("repo_broken")
+    broken_folder.mkdir("v1")
+    broken_folder.mkdir("v2")
+    with broken_folder.join("info.json").open("w") as file:
+        json.dump({"name": "repo_broken", "first_version": "v1", "latest_version": "v1",
+                   "strategy": "unknown", "protocol": 1}, file)
+    version_graph = networkx.DiGraph()
+    version_graph.add_node("v1")
+    networkx.write_gml(version_graph, str(broken_folder.join("versions.gml")))
+
+    repo_manager = RepositoryManager(Path(tmpdir.strpath))
+    results = {result.name: result for result in repo_manager.full_update(cpu_budget=2)}
+
+    assert not results["repo_broken"].success
+    assert results["repo_demo"].success
+    assert results["repo_demo"].new_versions == ["v2"]
+    assert Path(repo_folder.strpath, "__patches__", "v1_to_v2.tar.xz").exists()
+
+
+def test_instrumentation(empty_repo_with_2_version):
+    tmpdir, repo_folder, v1_folder, v2_folder = empty_repo_with_2_version
+
+    create_simplefile(v1_folder.strpath, "changed.txt", "Das ist die alte Version!")
+    create_simplefile(v2_folder.strpath, "changed.txt", "Das ist die neue Version!")
+    with zipfile.ZipFile(str(Path(v1_folder.strpath, "test.zip")), 'w') as zip_file:
+        zip_file.writestr("changed.txt", "Das ist die alte Version im Zip!")
+    with zipfile.ZipFile(str(Path(v2_folder.strpath, "test.zip")), 'w') as zip_file:
+        zip_file.writestr("changed.txt", "Das ist die neue Version im Zip!")
+
+    repository = ServerRepository(Path(repo_folder.strpath))
+    repository.instrumentation = Instrumentation("repo_demo")
+    repository.update()
+
+    data = repository.instrumentation.to_dict(None)
+    assert data["duration"] > 0
+    assert [run["name"] for run in data["runs"]] == ["v1_to_v2", "v2_to_v1"]
+    for phase in ["latest_archive", "manifest", "moves", "walk", "bsdiff", "zip_extract", "archive"]:
+        assert data["phases"][phase]["calls"] > 0, phase
+    assert data["counters"]["delta_cache_hits"] + data["counters"]["delta_cache_misses"] == 4
+
+    files = {entry["path"]: entry["phases"] for entry in data["files"]}
+    assert "bsdiff" in files["changed.txt"]
+    assert "bsdiff" in files["test.zip/changed.txt"]
+
+
+def test_patch_size_in_version_graph(empty_repo_with_2_version):
+    tmpdir, repo_folder, v1_folder, v2_folder = empty_repo_with_2_version
+    create_simplefile(v1_folder.strpath, "test.txt", "Das ist die alte Version!")
+    create_simplefile(v2_folder.strpath, "test.txt", "Das ist die neue Version!")
+
+    repository = ServerRepository(Path(repo_folder.strpath))
+    repository.update(jobs=2)
+
+    version_graph = networkx.read_gml(str(repository.version_graph_path))
+    for version_from, version_to in [("v1", "v2"), ("v2", "v1")]:
+        assert version_graph.edges[version_from, version_to]["size"] == \
+            repository.patch_path(version_from, version_to).stat().st_size
+
+
+def test_instrumentation_disabled(empty_repo_with_2_version):
+    tmpdir, repo_folder, v1_folder, v2_folder = empty_repo_with_2_version
+    create_simplefile(v2_folder.strpath, "test.txt", "Das ist die neue Version!")
+
+    repository = ServerRepository(Path(repo_folder.strpath))
+    repository.update()
+
+    assert not repository.instrumentation.enabled
+    assert repository.instrumentation.to_dict()["phases"] == {}
@@ -0,0 +1,150 @@
+# coding=utf-8
+import json
+import threading
+
+import networkx
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+
+from bireus.client.repository import ClientRepository
+from bireus.server.checkout_log import CheckoutLog
+from bireus.server.repository import ServerRepository
+from bireus.server.repository_manager import RepositoryManager
+from bireus.server.update_service import UpdateService
+from bireus.server.web_api import WebApi
+from bireus.shared import *
+from tests import add_demo_version, create_demo_repository, run_until_complete
+from tests.mocks.mock_download_service import MockDownloadService
+
+
+@pytest.fixture()
+def incremental_repo(tmpdir) -> RepositoryManager:
+    repo_manager = create_demo_repository(Path(tmpdir.strpath), ["v1", "v2", "v3", "v4"], "inc-bi")
+    repo_manager.repositories[0].update()
+
+    return repo_manager
+
+
+def test_checkout_log(tmpdir):
+    path = Path(tmpdir.strpath, "checkouts.json")
+    checkout_log = CheckoutLog(path)
+    assert checkout_log.record("v1", "v3") == 1
+    assert checkout_log.record("v1", "v3") == 2
+    checkout_log.record("v3", "v1")
+    checkout_log.save()
+
+    assert CheckoutLog(path).counts() == {("v1", "v3"): 2, ("v3", "v1"): 1}
+
+
+def test_update_shortcuts(incremental_repo):
+    repository = incremental_repo.repositories[0]
+    for version_from, version_to, count in [("v1", "v4", 3), ("v4", "v1", 2), ("v2", "v4", 1), ("v1", "v2", 5)]:
+        for _ in range(count):
+            repository.checkout_log.record(version_from, version_to)
+
+    # direct patches and rare checkouts get no shortcut
+    assert repository.update_shortcuts(min_checkouts=2) == [("v1", "v4"), ("v4", "v1")]
+    assert repository.patch_path("v1", "v4").exists()
+    assert repository.patch_path("v4", "v1").exists()
+
+    version_graph = networkx.read_gml(str(repository.version_graph_path))
+    assert networkx.shortest_path(version_graph, "v1", "v4") == ["v1", "v4"]
+    assert version_graph.edges["v1", "v4"]["shortcut"] == "yes"
+    assert sorted(ServerRepository(repository.absolute_path).shortcuts()) == [("v1", "v4"), ("v4", "v1")]
+
+    # the shortcut saving the most patch applications stays within the budget
+    repository._metadata["shortcut_budget"] = repository.patch_path("v1", "v4").stat().st_size
+    assert repository.update_shortcuts(min_checkouts=2) == [("v1", "v4")]
+    assert not repository.patch_path("v4", "v1").exists()
+    assert not repository.version_graph.has_edge("v4", "v1")
+
+
+def test_shortcuts_survive_update(incremental_repo):
+    repository = incremental_repo.repositories[0]
+    for _ in range(2):
+        repository.checkout_log.record("v1", "v4")
+    repository.update_shortcuts(min_checkouts=2)
+
+    add_demo_version(repository.absolute_path.parent, "v5")
+    repository.update()
+
+    assert repository.shortcuts() == [("v1", "v4")]
+    assert sorted(repository.version_graph.successors("v4")) == ["v3", "v5"]
+    # refreshing keeps the shortcut and its patch
+    assert repository.update_shortcuts(min_checkouts=2) == [("v1", "v4")]
+
+
+def test_client_reports_checkout(incremental_repo, tmpdir):
+    repository = incremental_repo.repositories[0]
+    url = "http://localhost:12345/repo_demo"
+    client_path = Path(tmpdir.strpath, "client")
+
+    downloader = MockDownloadService()
+    downloader.add_read_action(lambda url: repository.info_path.read_bytes())
+    downloader.add_download_action(lambda url, path: copy_file(repository.version_graph_path, path))
+    downloader.add_download_action(lambda url, path: copy_file(repository.absolute_path.joinpath("latest.tar.xz"),
+                                                               path))
+    client_repo = ClientRepository.get_from_url(client_path, url, downloader, file_logging=False)
+
+    for version_from, version_to in [("v4", "v3"), ("v3", "v2"), ("v2", "v3")]:
+        downloader.add_download_action(
+            lambda url, path, patch=repository.patch_path(version_from, version_to): copy_file(patch, path))
+
+    client_repo.checkout_version("v2")
+    client_repo.checkout_version("v3")
+
+    # only checkouts over several patches are reported
+    assert [(url, json.loads(data.decode("utf-8"))) for url, data in downloader.posted] == [
+        ("http://localhost:12345/repo_demo/checkouts", {"from": "v4", "to": "v2"})]
+
+
+def test_checkout_endpoint(incremental_repo):
+    repository = incremental_repo.repositories[0]
+
+    async def run():
+        update_service = UpdateService(shortcut_checkouts=2)
+        client = TestClient(TestServer(WebApi(incremental_repo, update_service).create_app()))
+        await client.start_server()
+
+        statuses = []
+        for body in [{"from": "v1", "to": "v4"}, {"from": "v1", "to": "v4"}, {"from": "v1"},
+                     {"from": "v1", "to": "v9"}]:
+            statuses.append((await client.post('/repo_demo/checkouts', json=body)).status)
+        statuses.append((await client.post('/unknown/checkouts', json={"from": "v1", "to": "v4"})).status)
+        jobs = await (await client.get('/jobs')).json()
+        await update_service.join()
+
+        patch = await client.get('/repo_demo/__patches__/v1_to_v4.tar.xz')
+        await client.close()
+        return statuses, jobs, patch.status
+
+    statuses, jobs, patch_status = run_until_complete(run())
+
+    assert statuses == [204, 204, 400, 404, 404]
+    # the second checkout queued the shortcut
+    assert len(jobs["jobs"]) == 1
+    assert patch_status == 200
+    assert repository.shortcuts() == [("v1", "v4")]
+    assert CheckoutLog(repository.checkout_log_path).counts() == {("v1", "v4"): 2}
+
+
+def test_checkout_saved_off_the_event_loop(incremental_repo, monkeypatch):
+    repository = incremental_repo.repositories[0]
+    save = repository.checkout_log.save
+    threads = []
+
+    def record_thread():
+        threads.append(threading.current_thread())
+        save()
+
+    monkeypatch.setattr(repository.checkout_log, "save", record_thread)
+
+    async def run():
+        await UpdateService().report_checkout(repository, "v1", "v4")
+        return threading.current_thread()
+
+    loop_thread = run_until_complete(run())
+
+    assert len(threads) == 1
+    assert threads[0] is not loop_thread
+    assert CheckoutLog(repository.checkout_log_path).counts() == {("v1", "v4"): 1}
@@ -0,0 +1,56 @@
+# coding=utf-8
+import random
+
+from bireus.server.compare_tasks.similarity import SimilarityIndex, similarity, sketch_file, SAMPLE_BLOCKS, \
+    SAMPLE_BLOCK_SIZE
+from bireus.shared import *
+
+
+def _lines(seed: int, count: int) -> bytes:
+    generator = random.Random(seed)
+    return b"".join(b"unit %d speed %d\n" % (generator.randrange(10 ** 6), generator.randrange(10 ** 6))
+                    for _ in range(count))
+
+
+def _write(path: Path, data: bytes) -> Path:
+    path.write_bytes(data)
+    return path
+
+
+def test_sketch_similarity(tmpdir):
+    data = _lines(1, 2000)
+    original = _write(Path(tmpdir.strpath, "unit.bp"), data)
+    variant = _write(Path(tmpdir.strpath, "unit_v2.bp"), data[:10000] + b"inserted line\n" + data[10000:])
+    other = _write(Path(tmpdir.strpath, "other.bp"), _lines(2, 2000))
+
+    original_sketch = sketch_file(original, original.stat().st_size)
+    assert similarity(original_sketch, sketch_file(variant, variant.stat().st_size)) > 0.8
+    assert similarity(original_sketch, sketch_file(other, other.stat().st_size)) < 0.1
+    assert similarity(original_sketch, original_sketch) == 1.0
+
+
+def test_sketch_large_file(tmpdir):
+    data = _lines(3, (SAMPLE_BLOCKS * SAMPLE_BLOCK_SIZE) // 10)
+    original = _write(Path(tmpdir.strpath, "large.bin"), data)
+    variant = _write(Path(tmpdir.strpath, "large_v2.bin"), b"new header\n" + data)
+
+    assert original.stat().st_size > SAMPLE_BLOCKS * SAMPLE_BLOCK_SIZE
+    assert similarity(sketch_file(original, original.stat().st_size),
+                      sketch_file(variant, variant.stat().st_size)) > 0.5
+
+
+def test_index_closest(tmpdir):
+    base = Path(tmpdir.strpath, "base")
+    base.mkdir()
+    data = _lines(4, 1000)
+    _write(base.joinpath("unit.bp"), data)
+    _write(base.joinpath("other.bp"), _lines(5, 1000))
+    _write(base.joinpath("tiny.bp"), b"tiny")
+
+    index = SimilarityIndex(base, {path.name: path.stat().st_size for path in base.iterdir()})
+
+    variant = _write(Path(tmpdir.strpath, "unit_v2.bp"), data.replace(b"speed 1", b"speed 2"))
+    assert index.closest(variant, variant.stat().st_size) == "unit.bp"
+
+    unrelated = _write(Path(tmpdir.strpath, "unrelated.bp"), _lines(6, 1000))
+    assert index.closest(unrelated, unrelated.stat().st_size) is None
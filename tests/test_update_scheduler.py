@@ -0,0 +1,114 @@
+# coding=utf-8
+import threading
+import time
+
+from bireus.server.update_scheduler import UpdateScheduler
+
+
+class FakeRepository(object):
+    def __init__(self, name: str, work: int, memory: int = 0, error: Exception = None,
+                 estimate_error: Exception = None):
+        self.name = name
+        self.work = work
+        self.memory = memory
+        self.error = error
+        self.estimate_error = estimate_error
+
+    def estimate_work(self) -> int:
+        if self.estimate_error is not None:
+            raise self.estimate_error
+        return self.work
+
+    def estimate_memory(self, jobs: int) -> int:
+        return self.memory * jobs
+
+    def new_versions(self):
+        return ["v2"]
+
+    def update(self, jobs: int) -> None:
+        tracker.enter(self.name)
+        time.sleep(0.05)
+        tracker.leave()
+
+        if self.error is not None:
+            raise self.error
+
+
+class Tracker(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.order = []
+        self.running = 0
+        self.max_running = 0
+
+    def enter(self, name: str) -> None:
+        with self.lock:
+            self.order.append(name)
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+
+    def leave(self) -> None:
+        with self.lock:
+            self.running -= 1
+
+
+tracker = None
+
+
+def setup_function(function):
+    global tracker
+    tracker = Tracker()
+
+
+def test_largest_first():
+    repos = [FakeRepository("small", 1), FakeRepository("large", 100), FakeRepository("medium", 10)]
+
+    results = UpdateScheduler(cpu_budget=1).run(repos)
+
+    assert tracker.order == ["large", "medium", "small"]
+    assert tracker.max_running == 1
+    assert [result.name for result in results] == ["small", "large", "medium"]
+    assert all(result.success for result in results)
+
+
+def test_cpu_budget():
+    repos = [FakeRepository("repo%s" % i, i) for i in range(6)]
+
+    UpdateScheduler(jobs=2, cpu_budget=4).run(repos)
+
+    assert tracker.max_running == 2
+    assert len(tracker.order) == 6
+
+
+def test_memory_budget():
+    repos = [FakeRepository("huge", 3, memory=500), FakeRepository("small1", 2, memory=40),
+             FakeRepository("small2", 1, memory=40)]
+
+    UpdateScheduler(cpu_budget=8, memory_budget=100).run(repos)
+
+    # the huge repository exceeds the budget alone, it runs without the others
+    assert tracker.order[0] == "huge"
+    assert tracker.max_running == 2
+
+
+def test_failure_is_isolated():
+    repos = [FakeRepository("broken", 10, error=ValueError("broken")), FakeRepository("fine", 1)]
+
+    results = UpdateScheduler(cpu_budget=2).run(repos)
+
+    assert not results[0].success
+    assert isinstance(results[0].error, ValueError)
+    assert results[0].to_dict()["success"] is False
+    assert results[1].success
+    assert results[1].new_versions == ["v2"]
+
+
+def test_estimate_failure_is_isolated():
+    repos = [FakeRepository("unreadable", 10, estimate_error=PermissionError("v3")), FakeRepository("fine", 1)]
+
+    results = UpdateScheduler(cpu_budget=2).run(repos)
+
+    assert tracker.order == ["fine"]
+    assert not results[0].success
+    assert isinstance(results[0].error, PermissionError)
+    assert results[1].success
@@ -0,0 +1,177 @@
+# coding=utf-8
+import asyncio
+import threading
+import time
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from typing import Any, List
+
+from bireus.server.update_service import CallbackClient, UpdateService
+from tests import run_until_complete
+
+
+class _FakeRepository(object):
+    def __init__(self, name: str, duration: float = 0.05, release: threading.Event = None):
+        self.name = name
+        self.duration = duration
+        self.release = release  # blocks the update until it is set
+        self.started = threading.Event()
+        self.updates = 0
+
+    def update(self, jobs: int = 1) -> None:
+        self.started.set()
+        if self.release is not None:
+            self.release.wait(5)
+        time.sleep(self.duration)
+        self.updates += 1
+
+
+class _Probe(_FakeRepository):
+    """
+    Records how many updates run at the same time
+    """
+
+    lock = threading.Lock()
+    running = 0
+    peak = 0
+
+    def update(self, jobs: int = 1) -> None:
+        with _Probe.lock:
+            _Probe.running += 1
+            _Probe.peak = max(_Probe.peak, _Probe.running)
+        try:
+            super().update(jobs)
+        finally:
+            with _Probe.lock:
+                _Probe.running -= 1
+
+
+async def _callback_server(statuses: List[int], received: List[Any]) -> TestServer:
+    async def handle(request):
+        received.append(await request.text())
+        return web.Response(status=statuses.pop(0) if len(statuses) > 0 else 200)
+
+    app = web.Application()
+    app.router.add_post('/callback', handle)
+    server = TestServer(app)
+    await server.start_server()
+    return server
+
+
+def test_updates_do_not_block_the_event_loop():
+    async def run():
+        release = threading.Event()
+        received = []
+        server = await _callback_server([], received)
+        service = UpdateService()
+        await service.start()
+
+        repo = _FakeRepository("repo", release=release)
+        service.submit(repo, str(server.make_url('/callback')), {"id": 1})
+
+        # the loop keeps running while the update is blocked
+        start = time.monotonic()
+        await asyncio.sleep(0.1)
+        assert time.monotonic() - start < 1
+        assert repo.updates == 0
+
+        release.set()
+        await service.join()
+        await service.close()
+        await server.close()
+        return repo, received
+
+    repo, received = run_until_complete(run())
+    assert repo.updates == 1
+    assert received == ['{"id": 1}']
+
+
+def test_concurrency():
+    async def run():
+        release = threading.Event()
+        received = []
+        server = await _callback_server([], received)
+        service = UpdateService(concurrency=2)
+        await service.start()
+
+        url = str(server.make_url('/callback'))
+        repos = [_Probe(name, release=release) for name in ["a", "b", "c"]]
+        for repo in repos:
+            service.submit(repo, url, {"repo": repo.name})
+
+        # two repositories are updated side by side, the third one waits for a free slot
+        for repo in repos[:2]:
+            await asyncio.get_event_loop().run_in_executor(None, repo.started.wait, 5)
+        await asyncio.sleep(0.1)
+        third_started = repos[2].started.is_set()
+
+        release.set()
+        await service.join()
+        await service.close()
+        await server.close()
+        return repos, third_started, received
+
+    _Probe.peak = 0
+    repos, third_started, received = run_until_complete(run())
+
+    assert not third_started
+    assert [repo.updates for repo in repos] == [1, 1, 1]
+    assert _Probe.peak == 2
+    assert sorted(received) == ['{"repo": "%s"}' % name for name in ["a", "b", "c"]]
+
+
+def test_coalesce_requests():
+    async def run():
+        release = threading.Event()
+        received = []
+        server = await _callback_server([], received)
+        service = UpdateService()
+        await service.start()
+
+        url = str(server.make_url('/callback'))
+        repo = _FakeRepository("repo", release=release)
+        service.submit(repo, url, {"id": 1})
+        await asyncio.get_event_loop().run_in_executor(None, repo.started.wait, 5)
+
+        # arrive while the first update is running
+        for i in range(2, 5):
+            service.submit(repo, url, {"id": i})
+
+        release.set()
+        await service.join()
+        await service.close()
+        await server.close()
+        return repo, service, received
+
+    repo, service, received = run_until_complete(run())
+
+    # a single follow-up update serves all requests that arrived during the first one
+    assert repo.updates == 2
+    assert service.updates == 2
+    assert service.coalesced == 2
+    assert sorted(received) == ['{"id": %s}' % i for i in range(1, 5)]
+
+
+def test_callback_retries():
+    async def run():
+        received = []
+        server = await _callback_server([503, 502], received)
+        client = CallbackClient(retries=2, backoff=0)
+        await client.start()
+
+        accepted = await client.post(str(server.make_url('/callback')), {"id": 1})
+        rejected = await client.post(str(server.make_url('/missing')), {"id": 2})
+        unreachable = await client.post('http://127.0.0.1:1/callback', {"id": 3})
+
+        await client.close()
+        await server.close()
+        return accepted, rejected, unreachable, received
+
+    accepted, rejected, unreachable, received = run_until_complete(run())
+
+    assert accepted
+    assert len(received) == 3
+    # client errors are not retried
+    assert not rejected
+    assert not unreachable
@@ -0,0 +1,98 @@
+# coding=utf-8
+import json
+
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+from bireus.server.update_service import CallbackClient, UpdateService
+from bireus.server.web_api import WebApi
+from bireus.shared import *
+from tests import create_demo_repository, run_until_complete
+
+
+async def _client(tmpdir, received):
+    async def callback(request):
+        received.append(await request.json())
+        return web.Response()
+
+    callback_app = web.Application()
+    callback_app.router.add_post('/callback', callback)
+    callback_server = TestServer(callback_app)
+    await callback_server.start_server()
+
+    repo_manager = create_demo_repository(Path(tmpdir.strpath), ["v1", "v2"])
+    update_service = UpdateService(callback_client=CallbackClient(backoff=0))
+    client = TestClient(TestServer(WebApi(repo_manager, update_service, event_interval=0.01).create_app()))
+    await client.start_server()
+    return client, callback_server, update_service
+
+
+def test_job_status(tmpdir):
+    async def run():
+        received = []
+        client, callback_server, update_service = await _client(tmpdir, received)
+
+        response = await client.post('/update', json={"repository": "repo_demo", "payload": {"build": 1},
+                                                      "callback_url": str(callback_server.make_url('/callback'))})
+        assert response.status == 202
+        jobs = (await response.json())["jobs"]
+        assert len(jobs) == 1
+        assert jobs[0]["state"] == "queued"
+        assert jobs[0]["queue_position"] == 1
+
+        # the events end once the job is done
+        response = await client.get('/jobs/%s/events' % jobs[0]["id"])
+        assert response.headers["Content-Type"] == "text/event-stream"
+        events = [json.loads(line[len("data: "):]) for line in (await response.text()).splitlines()
+                  if line.startswith("data: ")]
+        await update_service.join()
+
+        job = await (await client.get('/jobs/%s' % jobs[0]["id"])).json()
+        listing = await (await client.get('/jobs')).json()
+        metrics = await (await client.get('/metrics')).text()
+
+        await client.close()
+        await callback_server.close()
+        return events, job, listing, metrics, received
+
+    events, job, listing, metrics, received = run_until_complete(run())
+
+    assert events[-1]["state"] == "done"
+    assert job["state"] == "done"
+    assert job["duration"] > 0
+    assert job["callback_delivered"]
+    assert job["progress"]["phase"] == "done"
+    # inst-bi patches in both directions
+    assert job["progress"]["pairs_total"] == 2
+    assert job["progress"]["pairs_done"] == 2
+    assert job["progress"]["current_pair"] is None
+    assert job["progress"]["percent"] == 100
+    assert job["progress"]["bytes_written"] > 0
+
+    assert listing["queue_depth"] == 0
+    assert [entry["id"] for entry in listing["jobs"]] == [job["id"]]
+    assert received == [{"build": 1}]
+
+    assert "bireus_update_queue_depth 0" in metrics
+    assert 'bireus_update_jobs_total{state="done"} 1' in metrics
+    assert 'bireus_diff_bytes_total{codec="bsdiff"} 3800' in metrics
+    assert 'bireus_diff_throughput_bytes_per_second{codec="bsdiff"}' in metrics
+
+
+def test_invalid_requests(tmpdir):
+    async def run():
+        client, callback_server, update_service = await _client(tmpdir, [])
+
+        statuses = [
+            (await client.post('/update', json={"repository": "repo_demo"})).status,
+            (await client.post('/update', json={"repository": "unknown", "payload": {},
+                                                "callback_url": "http://localhost/"})).status,
+            (await client.get('/jobs/unknown')).status,
+            (await client.get('/jobs/unknown/events')).status
+        ]
+
+        await client.close()
+        await callback_server.close()
+        return statuses
+
+    assert run_until_complete(run()) == [400, 404, 404, 404]
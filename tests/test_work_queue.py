@@ -0,0 +1,62 @@
+# coding=utf-8
+import threading
+import time
+
+import pytest
+
+from bireus.server.compare_tasks.work_queue import WorkQueue
+
+
+class _Probe(object):
+    """
+    Records the memory of the items running at the same time
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.running = 0
+        self.peak = 0
+        self.overlapped = []
+
+    def run(self, memory: int) -> int:
+        with self._lock:
+            self.running += memory
+            self.peak = max(self.peak, self.running)
+            if self.running > memory:
+                self.overlapped.append(memory)
+        time.sleep(0.02)
+        with self._lock:
+            self.running -= memory
+        return memory
+
+
+def test_memory_budget():
+    probe = _Probe()
+    work_queue = WorkQueue(4, memory_budget=100)
+    items = [work_queue.add('test', probe.run, memory, memory=memory) for memory in [40, 40, 40, 150, 10, 10]]
+
+    work_queue.execute()
+
+    assert [item.result for item in items] == [40, 40, 40, 150, 10, 10]
+    # items exceeding the budget run alone
+    assert 150 not in probe.overlapped
+    assert probe.peak == 150
+    # small items still run side by side
+    assert len(probe.overlapped) > 0
+
+
+def _fail() -> None:
+    raise ValueError("diff failed")
+
+
+def test_memory_budget_failure():
+    probe = _Probe()
+    work_queue = WorkQueue(2, memory_budget=100)
+    work_queue.add('test', _fail, cost=10, memory=100)
+    work_queue.add('test', probe.run, 100, memory=100)
+
+    with pytest.raises(ValueError):
+        work_queue.execute()
+
+    # no new items are started after a failure
+    assert probe.peak == 0